@@ -7,6 +7,8 @@ from logging.handlers import TimedRotatingFileHandler
 import json
 from astropy.io import fits
 # from utils.transfer_to_remote import transfer
+from utils.write_queue import WriteQueue
+from utils.sedmHeader import addHeader
 from utils.transfer_to_remote import transfer
 
 SITE_ROOT = os.path.abspath(os.path.dirname(__file__) + '/../..')
@@ -42,7 +44,8 @@ class Controller:
     def __init__(self, cam_prefix="ifu", serial_number="test",
                  camera_handle=None, output_dir="",
                  force_serial=True, set_temperature=-50, send_to_remote=False,
-                 remote_config='nemea.config.json'):
+                 remote_config='nemea.config.json', async_write=False,
+                 write_queue_depth=4):
         """
         Initialize the controller for the ANDOR camera and
         :param cam_prefix:
@@ -50,6 +53,11 @@ class Controller:
         :param output_dir:
         :param force_serial:
         :param set_temperature:
+        :param async_write: return from take_image as soon as the frame is
+                            read out and hold it until write_image adds
+                            the robot's header
+        :param write_queue_depth: max number of frames held, waiting to be
+                                  written or being transferred
         """
 
         self.camPrefix = cam_prefix
@@ -92,12 +100,17 @@ class Controller:
         self.camspeed = 0.
         self.camtemp = 0
         # what to do with images
+        self.transfer = None
         if self.send_to_remote:
             with open(os.path.join(SITE_ROOT, 'config',
                                    remote_config)) as conf_data_file:
                 tparams = json.load(conf_data_file)
                 print(tparams, "params")
             self.transfer = transfer(**tparams)
+        self.async_write = async_write
+        self.writer = WriteQueue(transfer=self.transfer,
+                                 max_depth=write_queue_depth, logger=logger,
+                                 set_header=addHeader().update_header)
         # possible values
         self.shutter_dict = {
             'normal': 0,  # Values are index as per andor SDK documentation
@@ -442,9 +455,9 @@ class Controller:
                 acq_status = self.opt.GetStatus()
             logger.info("Ready to get data: %(acq_status)s",
                         {'acq_status': acq_status})
-            imdata = []
-            self.opt.GetAcquiredData16(imdata, width=self.ROI[3],
+            self.opt.GetAcquiredData16(width=self.ROI[3],
                                        height=self.ROI[5])
+            imdata = self.opt.imageArray
             end_time = datetime.utcnow()
         except Exception as e:
             self.lastError = str(e)
@@ -453,7 +466,7 @@ class Controller:
             return {'elaptime': -1 * (time.time() - s),
                     'error': "Failed to gather data from camera",
                     'send_alert': True}
-        if len(imdata) <= 0:
+        if imdata is None or imdata.size <= 0:
             logger.error("GetAcquiredData16 produced empty array!",
                          exc_info=True)
             self.exposip = False
@@ -479,8 +492,10 @@ class Controller:
         try:
             datetimestr = start_time.isoformat()
             datestr, timestr = datetimestr.split('T')
-            hdul = fits.PrimaryHDU(self.opt.imageArray, uint=True)
+            hdul = fits.PrimaryHDU(imdata, uint=True)
             hdul.scale('int16', bzero=32768)
+            # scale() leaves the HDU with its own int16 copy of the frame
+            self.opt.ReleaseImageBuffer(imdata)
             hdul.header.set("EXPTIME", float(exptime),
                             "Exposure Time in seconds")
             hdul.header.set("ADCSPEED", readout, "Readout speed in MHz")
@@ -520,41 +535,45 @@ class Controller:
             hdul.header.set("CDELT2", self.cdelt2, self.cdelt2_comment)
             hdul.header.set("CTYPE1", self.ctype1)
             hdul.header.set("CTYPE2", self.ctype2)
-            hdul.writeto(save_as, output_verify="fix", )
-            logger.info("%s created", save_as)
-            if self.send_to_remote:
-                ret = self.transfer.send(save_as)
-                if 'data' in ret:
-                    save_as = ret['data']
-                elif 'error' in ret:
-                    retries = 1
-                    transfer_worked = False
-                    while retries < 5 and not transfer_worked:
-                        print(ret)
-                        print("Transfer ERROR: wait 5s, try again")
-                        time.sleep(5)
-                        ret = self.transfer.send(save_as)
-                        if 'error' in ret:
-                            print("Transfer try %d failed" % retries)
-                            retries += 1
-                        else:
-                            save_as = ret['data']
-                            print("Transfer succeeded after %d retries"
-                                  % retries)
-                            transfer_worked = True
-                    if not transfer_worked:
-                        print("Unable to transfer andor file to remote")
-                else:
-                    print("Error transferring andor file to remote")
+            save_as = self.writer.submit(hdul, save_as,
+                                         hold=self.async_write)
             self.exposip = False
-            return {'elaptime': time.time() - s, 'data': save_as}
+            if self.async_write:
+                return {'elaptime': time.time() - s, 'data': save_as,
+                        'held': True}
+            ret = self.writer.wait(save_as)
+            if ret.get('data'):
+                return {'elaptime': time.time() - s, 'data': ret['data']}
+            return {'elaptime': time.time() - s,
+                    'error': 'Error writing andor file: %s' % save_as}
         except Exception as e:
             self.lastError = str(e)
-            logger.error("Error transferring andor data to remote: %s"
-                         % save_as, exc_info=True)
+            logger.error("Error queueing andor data: %s" % save_as,
+                         exc_info=True)
             self.exposip = False
             return {'elaptime': time.time() - s,
-                    'error': 'Error transferring andor file to remote: %s' % save_as}
+                    'error': 'Error queueing andor file: %s' % save_as}
+
+    def get_file_status(self, filename):
+        """Return the write/transfer status of an image from take_image"""
+        return self.writer.get_status(filename)
+
+    def write_image(self, filename, header=None):
+        """
+        Add the robot's observation keywords to an image held by
+        take_image and queue it to be written and transferred
+
+        :param filename: path returned by take_image
+        :param header: obsdict of the observation
+        :return: dict with the path the file will have once it is done
+        """
+        return self.writer.release(filename, header=header)
+
+    def close_writer(self):
+        """Finish writing and transferring all queued images"""
+        self.writer.shutdown()
+        if self.transfer:
+            self.transfer.close()
 
 
 if __name__ == "__main__":
@@ -253,6 +253,8 @@ class Andor:
 
         self.telescope = '60'
         self.imageArray = None
+        # Readout buffers keyed by (height, width), overscan included
+        self.buffer_pool = {}
 
     def loadLibrary(self):
         if platform.system() == "Linux":
@@ -271,15 +273,33 @@ class Andor:
         status = check_call(self.lib.CoolerOFF())
         return ERROR_STRING[status]
 
-    def GetAcquiredData16(self, imageArray, width, height):
+    def _acquire_buffer(self, shape):
+        """Return a free uint16 readout buffer of the given (height, width)"""
+        free = self.buffer_pool.setdefault(shape, [])
+        if free:
+            return free.pop()
+        status_msg(f'Allocating readout buffer {shape}')
+        return np.empty(shape, dtype=np.uint16)
+
+    def ReleaseImageBuffer(self, imageArray):
+        """Hand a readout buffer back to the pool once it has been saved"""
+        if imageArray is None:
+            return
+        free = self.buffer_pool.setdefault(imageArray.shape, [])
+        if not any(buf is imageArray for buf in free):
+            free.append(imageArray)
+
+    def GetAcquiredData16(self, width, height):
         status_msg(f'Getting Acquired Data')
-        dim = int(width * height / 1 / 1)
-        cimageArray = c_int16 * dim
-        cimage = cimageArray()
-        status = check_call(self.lib.GetAcquiredData16(pointer(cimage), dim))
-        for i in range(len(cimage)):
-            imageArray.append(cimage[i])
-        self.imageArray = np.reshape(imageArray, (height, width))
+        dim = int(width * height)
+        image = self._acquire_buffer((height, width))
+        try:
+            status = check_call(self.lib.GetAcquiredData16(
+                image.ctypes.data_as(POINTER(c_uint16)), c_ulong(dim)))
+        except Exception:
+            self.ReleaseImageBuffer(image)
+            raise
+        self.imageArray = image
         return ERROR_STRING[status]
 
     def GetAcquisitionTimings(self):
@@ -7,6 +7,8 @@ from logging.handlers import TimedRotatingFileHandler
 import json
 from astropy.io import fits
 from utils.transfer_to_remote import transfer
+from utils.write_queue import WriteQueue
+from utils.sedmHeader import addHeader
 
 SITE_ROOT = os.path.abspath(os.path.dirname(__file__)+'/../..')
 
@@ -22,7 +24,8 @@ _remote_config = cam_cfg["remote_config"]  # default remote config file
 class Controller:
     def __init__(self, cam_prefix="rc", serial_number="test", output_dir="",
                  force_serial=True, set_temperature=-50, send_to_remote=False,
-                 remote_config=_remote_config, setup_logging=True):
+                 remote_config=_remote_config, setup_logging=True,
+                 async_write=False, write_queue_depth=4):
         """
         Initialize the controller for the PIXIS camera and
         :param cam_prefix:
@@ -32,6 +35,11 @@ class Controller:
         :param set_temperature:
         :param send_to_remote:
         :param remote_config:
+        :param async_write: return from take_image as soon as the frame is
+                            read out and hold it until write_image adds
+                            the robot's header
+        :param write_queue_depth: max number of frames held, waiting to be
+                                  written or being transferred
         """
 
         self.camPrefix = cam_prefix
@@ -63,12 +71,15 @@ class Controller:
         self.ctype1 = 'RA---TAN'
         self.ctype2 = 'DEC--TAN'
         self.send_to_remote = send_to_remote
+        self.transfer = None
         if self.send_to_remote:
             with open(os.path.join(SITE_ROOT, 'config',
                                    remote_config)) as cfg_file:
                 trans_cfg = json.load(cfg_file)
                 print("transfer configuration:\n", trans_cfg)
             self.transfer = transfer(**trans_cfg)
+        self.async_write = async_write
+        self.write_queue_depth = write_queue_depth
         self.shutter_dict = {
             'normal': 'Normal',
             'closed': 'AlwaysClosed',
@@ -98,6 +109,13 @@ class Controller:
             logHandler.setLevel(logging.DEBUG)
             self.logger.addHandler(logHandler)
             self.logger.info("Starting Logger: Logger file is %s", log_file)
+        else:
+            self.logging = False
+            self.logger = None
+        self.writer = WriteQueue(transfer=self.transfer,
+                                 max_depth=self.write_queue_depth,
+                                 logger=self.logger,
+                                 set_header=addHeader().update_header)
 
     def _set_output_dir(self):
         """
@@ -470,40 +488,44 @@ class Controller:
             hdul.header.set("CDELT2", self.cdelt2, self.cdelt2_comment)
             hdul.header.set("CTYPE1", self.ctype1)
             hdul.header.set("CTYPE2", self.ctype2)
-            hdul.writeto(save_as, output_verify="fix", )
-            if self.logging:
-                self.logger.info("%s created", save_as)
-            if self.send_to_remote:
-                ret = self.transfer.send(save_as)
-                if 'data' in ret:
-                    save_as = ret['data']
-                elif 'error' in ret:
-                    retries = 1
-                    transfer_worked = False
-                    while retries < 5 and not transfer_worked:
-                        print(ret)
-                        print("Transfer ERROR: wait 5s, try again")
-                        time.sleep(5)
-                        ret = self.transfer.send(save_as)
-                        if 'error' in ret:
-                            print("Transfer retry %d failed" % retries)
-                            retries += 1
-                        else:
-                            save_as = ret['data']
-                            print("Transfer succeeded after %d retries"
-                                  % retries)
-                            transfer_worked = True
-                    if not transfer_worked:
-                        print("Unable to transfer pixis file to remote")
-                else:
-                    print("Error transferring pixis file to remote: no return")
-            return {'elaptime': time.time()-s, 'data': save_as}
+            save_as = self.writer.submit(hdul, save_as,
+                                         hold=self.async_write)
+            if self.async_write:
+                return {'elaptime': time.time()-s, 'data': save_as,
+                        'held': True}
+            ret = self.writer.wait(save_as)
+            if ret.get('data'):
+                return {'elaptime': time.time()-s, 'data': ret['data']}
+            return {'elaptime': time.time()-s,
+                    'error': 'Error writing pixis file: %s' % save_as}
         except Exception as e:
             self.lastError = str(e)
             if self.logging:
-                self.logger.error("Error transferring pixis data to remote: %s" % save_as, exc_info=True)
+                self.logger.error("Error queueing pixis data: %s" % save_as,
+                                  exc_info=True)
             return {'elaptime': time.time()-s,
-                    'error': 'Error transferring pixis file to remote: %s' % save_as}
+                    'error': 'Error queueing pixis file: %s' % save_as}
+
+    def get_file_status(self, filename):
+        """Return the write/transfer status of an image from take_image"""
+        return self.writer.get_status(filename)
+
+    def write_image(self, filename, header=None):
+        """
+        Add the robot's observation keywords to an image held by
+        take_image and queue it to be written and transferred
+
+        :param filename: path returned by take_image
+        :param header: obsdict of the observation
+        :return: dict with the path the file will have once it is done
+        """
+        return self.writer.release(filename, header=header)
+
+    def close_writer(self):
+        """Finish writing and transferring all queued images"""
+        self.writer.shutdown()
+        if self.transfer:
+            self.transfer.close()
 
 
 if __name__ == "__main__":
@@ -7,6 +7,7 @@ import time
 import socket
 import threading
 from cameras.andor import andor
+from utils import framing
 
 SITE_ROOT = os.path.abspath(os.path.dirname(__file__)+'/../..')
 
@@ -57,22 +58,21 @@ class CamServer:
             response = {'test': 'test'}
             try:
                 start = time.time()
-                data = connection.recv(2048)
-
-                data = data.decode("utf8")
-                logger.info("Received: %s", str(data))
-
-                if not data:
-                    break
-
                 try:
-                    data = json.loads(data)
-                except Exception as e:
+                    data = framing.recv_message(connection)
+                except framing.FramingError:
+                    logger.error("Connection lost mid-message", exc_info=True)
+                    break
+                except ValueError as e:
                     logger.error("Load error", exc_info=True)
-                    error_dict = json.dumps(
-                        {'elaptime': time.time()-start,
-                         "error": "error message %s" % str(e)})
-                    connection.sendall(error_dict)
+                    framing.send_message(connection,
+                                         {'elaptime': time.time()-start,
+                                          "error": "error message %s"
+                                                   % str(e)})
+                    break
+                logger.info("Received: %s", data)
+
+                if data is None:
                     break
 
                 if 'command' in data:
@@ -82,6 +82,8 @@ class CamServer:
                             if self.port == cam_cfg['rc_port']:
                                 cam_prefix = "rc"
                                 send_to_remote = cam_cfg['rc_send_to_remote']
+                                async_write = cam_cfg.get('rc_async_write',
+                                                          False)
                                 output_dir = cam_cfg['cam_image_dir']
                                 set_temperature = cam_cfg['rc_set_temperature']
                                 camera_handle = None
@@ -90,6 +92,8 @@ class CamServer:
                             else:
                                 cam_prefix = "ifu"
                                 send_to_remote = cam_cfg['ifu_send_to_remote']
+                                async_write = cam_cfg.get('ifu_async_write',
+                                                          False)
                                 output_dir = cam_cfg['cam_image_dir']
                                 set_temperature = cam_cfg[
                                     'ifu_set_temperature']
@@ -100,6 +104,7 @@ class CamServer:
                                 self.cam = andor.Controller(
                                     serial_number="", cam_prefix=cam_prefix,
                                     send_to_remote=send_to_remote,
+                                    async_write=async_write,
                                     set_temperature=set_temperature,
                                     camera_handle=camera_handle,
                                     output_dir=output_dir,)
@@ -142,6 +147,12 @@ class CamServer:
                         logger.info("Log rollover")
                     elif data['command'].upper() == 'STATUS':
                         response = self.cam.get_status()
+                    elif data['command'].upper() == 'FILESTATUS':
+                        response = self.cam.get_file_status(
+                            **data['parameters'])
+                    elif data['command'].upper() == 'WRITEIMAGE':
+                        response = self.cam.write_image(
+                            **data['parameters'])
                     elif data['command'].upper() == 'GETTEMPSTATUS':
                         response = self.cam.get_temp_status()
                         logger.info(str(response))
@@ -170,6 +181,7 @@ class CamServer:
                         response = self.cam.opt.disconnect()
                         logger.info(str(response))
                     elif data['command'].upper() == "SHUTDOWN":
+                        self.cam.close_writer()
                         # _ = self.cam.opt.disconnect()
                         # _ = self.cam.opt.unloadLibrary()
                         _ = self.cam.opt.ShutDown()
@@ -181,8 +193,7 @@ class CamServer:
                     response = {'elaptime': time.time()-start,
                                 'error': "Command not found"}
 
-                jsonstr = json.dumps(response)
-                connection.sendall(jsonstr.encode('utf-8'))
+                framing.send_message(connection, response)
             except Exception as e:
                 logger.error("Camera error: %s" % str(time.gmtime()))
                 logger.error(str(e))
@@ -229,6 +240,9 @@ class CamServer:
         except KeyboardInterrupt:
             q = input("Warm up before shutdown "
                       "(only for long-term shutdown)? (N/y): ")
+            if self.cam:
+                logger.info("Flushing image write queue")
+                self.cam.close_writer()
             if 'Y' in q.upper():
                 self.execute_warmup()
                 logger.info("Executing camera shutdown")
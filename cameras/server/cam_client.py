@@ -2,6 +2,7 @@ import socket
 import time
 import json
 import os
+from utils import framing
 
 SITE_ROOT = os.path.abspath(os.path.dirname(__file__)+'/../..')
 
@@ -39,26 +40,21 @@ class Camera:
                 self.socket.settimeout(timeout)
 
             if parameters:
-                send_str = json.dumps({'command': cmd,
-                                       'parameters': parameters})
+                message = {'command': cmd, 'parameters': parameters}
             else:
-                send_str = json.dumps({'command': cmd})
+                message = {'command': cmd}
                 
-            self.socket.send(b"%s" % send_str.encode('utf-8'))
+            framing.send_message(self.socket, message)
 
             if return_before_done:
                 return {"elaptime": time.time()-start,
                         "data": "exiting the loop early"}
 
-            data = self.socket.recv(2048)
-            counter = 0
-            while not data:
-                time.sleep(.1)
-                data = self.socket.recv(2048)
-                counter += 1
-                if counter > 100:
-                    break
-            return json.loads(data.decode('utf-8'))
+            data = framing.recv_message(self.socket)
+            if data is None:
+                return {'elaptime': time.time() - start,
+                        'error': 'socket disconnect'}
+            return data
         except Exception as e:
             return {'elaptime': time.time()-start,
                     'error': str(e)}
@@ -78,6 +74,17 @@ class Camera:
     def prefix(self):
         return self.__send_command(cmd="PREFIX")
 
+    def file_status(self, filename):
+        """Write/transfer status of an image returned by take_image"""
+        return self.__send_command(cmd="FILESTATUS",
+                                   parameters={'filename': filename})
+
+    def write_image(self, filename, header=None):
+        """Write an image held by take_image with the given obsdict"""
+        return self.__send_command(cmd="WRITEIMAGE",
+                                   parameters={'filename': filename,
+                                               'header': header})
+
     def take_image(self, shutter='normal', exptime=0.0, readout=2.0,
                    save_as="", return_before_done=False):
 
@@ -87,17 +94,11 @@ class Camera:
                                    return_before_done=return_before_done)
 
     def listen(self):
-        data = self.socket.recv(2048)
-        counter = 0
-        while not data:
-            time.sleep(.1)
-            data = self.socket.recv(2048)
-            counter += 1
-            if counter > 100:
-                break
         try:
-            ret = json.loads(data.decode('utf-8'))
-        except json.decoder.JSONDecodeError:
+            ret = framing.recv_message(self.socket)
+        except (ValueError, framing.FramingError):
+            ret = None
+        if ret is None:
             ret = {'error': 'socket disconnect'}
         return ret
 
@@ -7,6 +7,7 @@ import socket
 import threading
 from cameras.pixis import pixis
 import paramiko
+from utils import framing
 
 SITE_ROOT = os.path.abspath(os.path.dirname(__file__)+'/../..')
 
@@ -45,22 +46,21 @@ class CamServer:
             response = {'test': 'test'}
             try:
                 start = time.time()
-                data = connection.recv(2048)
-
-                data = data.decode("utf8")
-                logger.info("Received: %s", data)
-
-                if not data:
-                    break
-                print(data)
                 try:
-                    data = json.loads(data)
-                except Exception as e:
+                    data = framing.recv_message(connection)
+                except framing.FramingError:
+                    logger.error("Connection lost mid-message", exc_info=True)
+                    break
+                except ValueError as e:
                     logger.error("Load error", exc_info=True)
-                    error_dict = json.dumps({'elaptime': time.time()-start,
-                                             "error": "error message %s"
-                                                      % str(e)})
-                    connection.sendall(error_dict)
+                    framing.send_message(connection,
+                                         {'elaptime': time.time()-start,
+                                          "error": "error message %s"
+                                                   % str(e)})
+                    break
+                logger.info("Received: %s", data)
+
+                if data is None:
                     break
 
                 if 'command' in data:
@@ -100,6 +100,12 @@ class CamServer:
                         response = self.cam.take_image(**data['parameters'])
                     elif data['command'].upper() == 'STATUS':
                         response = self.cam.get_status()
+                    elif data['command'].upper() == 'FILESTATUS':
+                        response = self.cam.get_file_status(
+                            **data['parameters'])
+                    elif data['command'].upper() == 'WRITEIMAGE':
+                        response = self.cam.write_image(
+                            **data['parameters'])
                     elif data['command'].upper() == 'PING':
                         response = {'data': 'PONG'}
                     elif data['command'].upper() == "LASTERROR":
@@ -112,6 +118,7 @@ class CamServer:
                     elif data['command'].upper() == "REINIT":
                         response = self.cam.opt.disconnect()
                     elif data['command'].upper() == "SHUTDOWN":
+                        self.cam.close_writer()
                         _ = self.cam.opt.disconnect()
                         _ = self.cam.opt.unloadLibrary()
                         self.cam = None
@@ -120,8 +127,7 @@ class CamServer:
                 else:
                     response = {'elaptime': time.time()-start,
                                 'error': "Command not found"}
-                jsonstr = json.dumps(response)
-                connection.sendall(jsonstr.encode('utf-8'))
+                framing.send_message(connection, response)
             except Exception as e:
                 logger.error("Big error", exc_info=True)
                 pass
@@ -5,6 +5,7 @@ import os
 import sys
 import time
 import socket
+import threading
 import SEDM_robot_version as Version
 
 with open(os.path.join(Version.CONFIG_DIR, 'logging.json')) as data_file:
@@ -61,6 +62,7 @@ class Lamp:
         self.plug = int(self.lamp_config[lamp.lower()]['outlet'])
         self.socket = None
         self.state = "UNKNOWN"
+        self.lock = threading.Lock()
 
     def send_cmd(self, cmd=""):
         """
@@ -74,6 +76,10 @@ class Lamp:
         """
         start = time.time()
 
+        with self.lock:
+            return self.__send_cmd(cmd, start)
+
+    def __send_cmd(self, cmd, start):
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.connect((self.host, self.port))
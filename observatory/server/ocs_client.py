@@ -1,6 +1,6 @@
 import socket
 import time
-import json
+from utils import framing
 
 
 class Observatory:
@@ -32,27 +32,21 @@ class Observatory:
                 self.socket.settimeout(timeout)
 
             if parameters:
-                send_str = json.dumps({'command': cmd,
-                                       'parameters': parameters})
+                message = {'command': cmd, 'parameters': parameters}
             else:
-                send_str = json.dumps({'command': cmd})
+                message = {'command': cmd}
 
-            self.socket.send(b"%s" % send_str.encode('utf-8'))
+            framing.send_message(self.socket, message)
 
             if return_before_done:
                 return {"elaptime": time.time()-start,
                         "data": "exiting the loop early"}
 
-            data = self.socket.recv(2048)
-            counter = 0
-            while not data:
-                time.sleep(.5)
-                data = self.socket.recv(2048)
-                counter += 1
-                if counter > 100:
-                    break
-
-            return json.loads(data.decode('utf-8'))
+            data = framing.recv_message(self.socket)
+            if data is None:
+                return {'elaptime': time.time() - start,
+                        'error': 'socket disconnect'}
+            return data
         except Exception as e:
             return {'elaptime': time.time() - start,
                     'error': str(e)}
@@ -91,6 +85,15 @@ class Observatory:
     def check_weather(self):
         return self.__send_command(cmd="OBSWEATHER")
 
+    def get_snapshot(self):
+        """
+        Latest background-polled status:
+        {field: {'data': ..., 'time': ..., 'age': ...}} for pos, weather,
+        status, winter, <lamp>_lamp and stage<id>.  age is seconds by the
+        server clock, None for a field invalidated by a command.
+        """
+        return self.__send_command(cmd="GETSNAPSHOT")
+
     # STAGE COMMANDS
     def stage_state(self, stage_id=1):
         parameters = {
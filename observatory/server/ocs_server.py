@@ -1,5 +1,6 @@
 import os
 import sys
+import argparse
 import logging
 import json
 from logging.handlers import TimedRotatingFileHandler
@@ -7,9 +8,11 @@ import time
 from observatory.arclamps import controller as lamps
 from observatory.stages import controller as stages
 from observatory.telescope import tcs
+from observatory.telescope import winter
 import socket
 import threading
 import SEDM_robot_version as Version
+from utils import framing
 
 with open(os.path.join(Version.CONFIG_DIR, 'logging.json')) as data_file:
     params = json.load(data_file)
@@ -37,7 +40,16 @@ logger.info("Starting Logger: Logger file is %s", 'ocs_server.log')
 
 
 class ocsServer:
-    def __init__(self, hostname, port):
+    def __init__(self, hostname, port, status_interval=5, device_interval=60,
+                 use_winter=False):
+        """
+
+        :param hostname:
+        :param port:
+        :param status_interval: seconds between TCS/weather status polls
+        :param device_interval: seconds between lamp and stage status polls
+        :param use_winter: also poll the WINTER weather server
+        """
         self.hostname = hostname
         self.port = port
         self.socket = ""
@@ -45,6 +57,95 @@ class ocsServer:
         self.lamp_controller = None
         self.lamps_dict = None
         self.tcs = None
+        self.winter = None
+        self.use_winter = use_winter
+        # Latest status of each field, refreshed in the background
+        self.snapshot = {}
+        self.snapshot_lock = threading.Lock()
+        self.poll_intervals = {'pos': status_interval,
+                               'weather': status_interval,
+                               'status': status_interval,
+                               'winter': status_interval,
+                               'xe_lamp': device_interval,
+                               'cd_lamp': device_interval,
+                               'hg_lamp': device_interval,
+                               'stage1': device_interval,
+                               'stage2': device_interval}
+        self.stop_polling = threading.Event()
+        self.poller = None
+
+    def _update_snapshot(self, field, ret):
+        """Store a successful device return in the status snapshot"""
+        if isinstance(ret, dict) and 'data' in ret:
+            with self.snapshot_lock:
+                self.snapshot[field] = {'data': ret['data'],
+                                        'time': time.time()}
+        return ret
+
+    def _invalidate_snapshot(self, *fields):
+        """Mark fields stale so they are refreshed on the next poll"""
+        with self.snapshot_lock:
+            for field in fields:
+                if field in self.snapshot:
+                    self.snapshot[field]['time'] = 0
+
+    def _snapshot_age(self, field):
+        with self.snapshot_lock:
+            if field not in self.snapshot:
+                return float('inf')
+            return time.time() - self.snapshot[field]['time']
+
+    def _poll_field(self, field):
+        if field == 'pos' and self.tcs:
+            self._update_snapshot(field, self.tcs.get_pos())
+        elif field == 'weather' and self.tcs:
+            self._update_snapshot(field, self.tcs.get_weather())
+        elif field == 'status' and self.tcs:
+            self._update_snapshot(field, self.tcs.get_status())
+        elif field == 'winter' and self.winter:
+            self._update_snapshot(field, self.winter.get_weather())
+        elif field.endswith('_lamp') and self.lamps_dict:
+            lamp = field.split('_')[0]
+            if lamp in self.lamps_dict:
+                self._update_snapshot(
+                    field, self.lamps_dict[lamp].status(force_check=True))
+        elif field.startswith('stage') and self.stages:
+            self._update_snapshot(field, self.stages.get_position(
+                stage_id=int(field[-1])))
+
+    def poll_status(self):
+        """Keep the status snapshot fresh until stop_polling is set"""
+        while not self.stop_polling.is_set():
+            for field, interval in self.poll_intervals.items():
+                if self._snapshot_age(field) < interval:
+                    continue
+                try:
+                    self._poll_field(field)
+                except Exception as e:
+                    logger.error("Error polling %s: %s", field, str(e))
+            self.stop_polling.wait(1)
+
+    def start_status_poller(self):
+        if self.use_winter and not self.winter:
+            self.winter = winter.Winter()
+        if self.poller is None or not self.poller.is_alive():
+            self.stop_polling.clear()
+            self.poller = threading.Thread(target=self.poll_status,
+                                           daemon=True)
+            self.poller.start()
+
+    def get_snapshot(self):
+        """
+        Return the latest value, time and age of every polled field.  The
+        age is worked out here so clients do not depend on their clock
+        agreeing with this one, it is None for invalidated fields.
+        """
+        start = time.time()
+        with self.snapshot_lock:
+            data = {k: dict(v) for k, v in self.snapshot.items()}
+        for v in data.values():
+            v['age'] = start - v['time'] if v['time'] else None
+        return {'elaptime': time.time() - start, 'data': data}
 
     def handle(self, connection, address):
         if address:
@@ -54,20 +155,21 @@ class ocsServer:
             response = None
             try:
 
-                data = connection.recv(2048)
-
-                data = data.decode("utf8")
-                logger.info("Received: %s", data)
-
-                if not data:
-                    break
                 try:
-                    data = json.loads(data)
-                except Exception as e:
+                    data = framing.recv_message(connection)
+                except framing.FramingError:
+                    logger.error("Connection lost mid-message", exc_info=True)
+                    break
+                except ValueError as e:
                     logger.error("Load error", exc_info=True)
-                    error_dict = json.dumps({"error": "error message %s"
-                                                      % str(e)})
-                    connection.sendall(error_dict)
+                    framing.send_message(connection,
+                                         {'elaptime': time.time()-start,
+                                          "error": "error message %s"
+                                                   % str(e)})
+                    break
+                logger.info("Received: %s", data)
+
+                if data is None:
                     break
 
                 if 'command' in data:
@@ -115,15 +217,22 @@ class ocsServer:
                             response = {'elaptime': time.time() - start,
                                         'data': 'Telescope initialized'}
                     elif cmd.upper() == "OBSSTATUS":
-                        response = self.tcs.get_status()
+                        response = self._update_snapshot(
+                            'status', self.tcs.get_status())
                     elif cmd.upper() == "OBSWEATHER":
-                        response = self.tcs.get_weather()
+                        response = self._update_snapshot(
+                            'weather', self.tcs.get_weather())
                     elif cmd.upper() == "OBSPOS":
-                        response = self.tcs.get_pos()
+                        response = self._update_snapshot(
+                            'pos', self.tcs.get_pos())
+                    elif cmd.upper() == "GETSNAPSHOT":
+                        response = self.get_snapshot()
                     elif cmd.upper() == "TELMOVE":
                         response = self.tcs.tel_move_sequence(**parameters)
+                        self._invalidate_snapshot('pos', 'status')
                     elif cmd.upper() == "TELOFFSET":
                         response = self.tcs.offset(**parameters)
+                        self._invalidate_snapshot('pos')
                     elif cmd.upper() == "TELGOFOC":
                         response = self.tcs.gofocus(**parameters)
                     elif cmd.upper() == "TELOFFSETFOC":
@@ -132,6 +241,7 @@ class ocsServer:
                         response = self.tcs.get_faults()
                     elif cmd.upper() == "TELX":
                         response = self.tcs.x()
+                        self._invalidate_snapshot('pos')
                     elif cmd.upper() == "TAKECONTROL":
                         response = self.tcs.takecontrol()
                     elif cmd.upper() == "TELHALON":
@@ -140,25 +250,41 @@ class ocsServer:
                         response = self.tcs.halogens_off()
                     elif cmd.upper() == "TELSTOW":
                         response = self.tcs.stow(**parameters)
+                        self._invalidate_snapshot('pos', 'status')
                     elif cmd.upper() == "DOME":
                         response = self.tcs.dome(**parameters)
+                        self._invalidate_snapshot('status')
                     elif cmd.upper() == "SETRATES":
                         response = self.tcs.irates(**parameters)
+                        self._invalidate_snapshot('pos')
                     elif cmd.upper() == "ARCLAMPON":
                         response = self.lamps_dict[parameters['lamp']].on()
+                        self._invalidate_snapshot('%s_lamp' %
+                                                  parameters['lamp'])
                     elif cmd.upper() == "ARCLAMPOFF":
                         response = self.lamps_dict[parameters['lamp']].off()
+                        self._invalidate_snapshot('%s_lamp' %
+                                                  parameters['lamp'])
                     elif cmd.upper() == "ARCLAMPSTATUS":
                         response = self.lamps_dict[parameters['lamp']].status(
                             parameters['force_check'])
+                        if parameters['force_check']:
+                            self._update_snapshot('%s_lamp' %
+                                                  parameters['lamp'], response)
                     elif cmd.upper() == "STAGEMOVE":
                         response = self.stages.move_focus(**parameters)
+                        self._invalidate_snapshot(
+                            'stage%s' % parameters.get('stage_id', 1))
                     elif cmd.upper() == "STAGEPOSITION":
-                        response = self.stages.get_position(**parameters)
+                        response = self._update_snapshot(
+                            'stage%s' % parameters.get('stage_id', 1),
+                            self.stages.get_position(**parameters))
                     elif cmd.upper() == "STAGESTATE":
                         response = self.stages.get_state(**parameters)
                     elif cmd.upper() == "STAGEHOME":
                         response = self.stages.home(**parameters)
+                        self._invalidate_snapshot(
+                            'stage%s' % parameters.get('stage_id', 1))
                     elif cmd.upper() == "PING":
                         response = {"elaptime": time.time()-start,
                                     "data": "Pong"}
@@ -169,13 +295,12 @@ class ocsServer:
                     response = {'elaptime': time.time()-start,
                                 'error': "Command not found"}
                 logger.info("Response: %s", response)
-                jsonstr = json.dumps(response)
-                connection.sendall(jsonstr.encode('utf-8'))
+                framing.send_message(connection, response)
             except Exception as e:
                 logger.error("Big error", exc_info=True)
-                jsonstr = json.dumps({'elaptime': time.time()-start,
+                framing.send_message(connection,
+                                     {'elaptime': time.time()-start,
                                       'error': str(e)})
-                connection.sendall(jsonstr.encode('utf-8'))
                 pass
 
     def start(self):
@@ -186,6 +311,7 @@ class ocsServer:
         self.socket.settimeout(None)
         self.socket.bind((self.hostname, self.port))
         self.socket.listen(5)
+        self.start_status_poller()
 
         try:
             while True:
@@ -196,12 +322,20 @@ class ocsServer:
                 new_thread.start()
                 logger.debug("Started process")
         except KeyboardInterrupt:
+            self.stop_polling.set()
             logger.info("Exiting ocs_server")
 
 
 if __name__ == "__main__":
-    #
-    server = ocsServer("localhost", 5003)
+    parser = argparse.ArgumentParser(
+        description="""Start the SEDM OCS server""",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('-w', '--winter', action="store_true", default=False,
+                        help='Also poll WINTER for weather data')
+    args = parser.parse_args()
+
+    server = ocsServer("localhost", 5003, use_winter=args.winter)
     logger.info("Starting ocsServer")
     server.start()
     logger.info("All done")
@@ -2,6 +2,7 @@ import logging
 from logging.handlers import TimedRotatingFileHandler
 import time
 import socket
+import threading
 import os
 import sys
 import json
@@ -126,6 +127,8 @@ class Stage:
                                                  'port': self.port})
 
         self.socket = socket.socket()
+        # Keep command/response pairs from different threads apart
+        self.lock = threading.Lock()
 
         # nominal positions
         self.stage1_nom = self.stage_config['stage1']
@@ -183,6 +186,13 @@ class Stage:
         :param cmd:
         :return:
         """
+        with self.lock:
+            return self.__serial_exchange(stage_id=stage_id, cmd=cmd)
+
+    def __serial_exchange(self, stage_id=1, cmd=''):
+        """
+        Send cmd and read back the reply, the caller must hold self.lock
+        """
 
         # Prep command
         cmd_send = "%s%s\r\n" % (stage_id, cmd)
@@ -5,6 +5,7 @@ import json
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import time
+import threading
 import SEDM_robot_version as Version
 
 with open(os.path.join(Version.CONFIG_DIR, 'logging.json')) as data_file:
@@ -29,6 +30,8 @@ class Telescope:
         self.status = {}
         self.faults = {}
         self.socket = None
+        # Serializes GXN traffic between command and status-poll threads
+        self.lock = threading.RLock()
         self.error_str = None
         self.error_tracker = 0
         with open(os.path.join(Version.CONFIG_DIR, 'tcs.json')) as cfile:
@@ -117,6 +120,15 @@ class Telescope:
         :param error_handling:
         :return: Bool,time to complete command in seconds
         """
+        with self.lock:
+            return self.__send_command(cmd=cmd, parameters=parameters,
+                                       error_handling=error_handling)
+
+    def __send_command(self, cmd="", parameters=None,
+                       error_handling=True):
+        """
+        Send a command to the GXN, the caller must hold self.lock
+        """
         # Start timer
         start = time.time()
         origin_command = cmd
@@ -1,12 +1,21 @@
-import glob
 import os
 import time
-from astropy.io import fits
+from sanity import header_index
 
 
 class Checker:
-    def __init__(self, data_dir='/home/sedm/images/'):
+    def __init__(self, data_dir='/home/sedm/images/', index_file=None):
         self.data_dir = data_dir
+        if not index_file:
+            index_file = os.path.join(data_dir, 'header_index.db')
+        self.index_file = index_file
+        self.index = None
+
+    def get_index(self):
+        """Open the header index on first use"""
+        if self.index is None:
+            self.index = header_index.HeaderIndex(self.index_file)
+        return self.index
 
     def check_for_images(self, camera, keywords, time_cut=None, data_dir=None):
         """
@@ -20,46 +29,44 @@ class Checker:
         if time_cut:
             pass
         start = time.time()
-        img_list = []
-        files = []
         if not data_dir:
             data_dir = self.data_dir
-
-        # 1. Get the images
-        if isinstance(data_dir, list):
-            for i in data_dir:
-                path = os.path.join(i, camera+"*.fits")
-                print("Checking %s" % path)
-                files += glob.glob(path)
-        else:
-            path = os.path.join(data_dir, camera + "*.fits")
-            print("Checking %s" % path)
-            files += glob.glob(path)
+        if not isinstance(data_dir, list):
+            data_dir = [data_dir]
 
         if not isinstance(keywords, dict):
             return {'elaptime': time.time()-start,
                     'error': "keywords are not in dict form"}
 
-        n_keys = len(keywords)
-        print("Checking %d keywords" % n_keys)
-        nfiles = 0
-        for f in files:
-            keys_there = 0
-            header = fits.getheader(f)
-            for k, v in keywords.items():
-                n_keys += 1
-                if k.upper() in header:
-                    if isinstance(v, str):
-                        if v.lower() in header[k.upper()]:
-                            keys_there += 1
-                    elif isinstance(v, float) or isinstance(v, int):
-                        if v == header[k.upper()]:
-                            keys_there += 1
-            if keys_there == n_keys:
-                img_list.append(f)
-                nfiles += 1
+        # 1. Bring the index up to date, only new or changed files are read
+        index = self.get_index()
+        img_list = []
+        print("Checking %d keywords" % len(keywords))
+        for d in data_dir:
+            print("Checking %s" % os.path.join(d, camera + "*.fits"))
+            index.update(d, prefix=camera)
+            img_list += index.find(d, prefix=camera, keywords=keywords)
+
+        return {'elaptime': time.time()-start, 'data': len(img_list)}
+
+    def latest_image(self, data_dir=None, prefix=''):
+        """
+        Most recently created fits file in data_dir
 
-        return {'elaptime': time.time()-start, 'data': nfiles}
+        :param data_dir:
+        :param prefix:
+        :return:
+        """
+        start = time.time()
+        if not data_dir:
+            data_dir = self.data_dir
+        index = self.get_index()
+        index.update(data_dir, prefix=prefix)
+        latest = index.latest(data_dir, prefix=prefix)
+        if not latest:
+            return {'elaptime': time.time()-start,
+                    'error': "No images found in %s" % data_dir}
+        return {'elaptime': time.time()-start, 'data': latest}
 
 
 if __name__ == "__main__":
@@ -67,4 +74,4 @@ if __name__ == "__main__":
     ret = x.check_for_images('ifu', keywords={'object': 'bias',
                                               'ADCSPEED': 2.0},
                              data_dir='/home/sedm/images/20191125')
-    print(len(ret['data']))
+    print(ret['data'])
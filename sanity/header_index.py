@@ -0,0 +1,165 @@
+import os
+import time
+import sqlite3
+import threading
+from astropy.io import fits
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    ctime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir, name);
+CREATE TABLE IF NOT EXISTS keywords (
+    path TEXT NOT NULL REFERENCES files (path) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    sval TEXT,
+    nval REAL
+);
+CREATE INDEX IF NOT EXISTS keywords_key ON keywords (key, path);
+"""
+
+SKIP_KEYS = ('', 'COMMENT', 'HISTORY')
+
+
+class HeaderIndex:
+    """
+    Persistent index of FITS headers in the nightly image directories.
+
+    Files are (re)read only when they are new or their mtime changed, so
+    headers that are updated after the frame is written are picked up.
+    """
+
+    def __init__(self, db_path):
+        """
+
+        :param db_path: sqlite file holding the index
+        """
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    @staticmethod
+    def _header_rows(path):
+        header = fits.getheader(path)
+        rows = []
+        for key, value in header.items():
+            if key in SKIP_KEYS:
+                continue
+            if isinstance(value, (bool, int, float)):
+                rows.append((path, key, str(value), float(value)))
+            else:
+                rows.append((path, key, str(value), None))
+        return rows
+
+    def update(self, directory, prefix=''):
+        """
+        Bring the index up to date with a directory
+
+        :param directory: directory holding the fits files
+        :param prefix: only look at files starting with prefix
+        :return: number of files (re)indexed
+        """
+        if not os.path.isdir(directory):
+            return 0
+        directory = os.path.abspath(directory)
+        with self.lock:
+            known = dict(self.conn.execute(
+                "SELECT path, mtime FROM files WHERE dir = ? AND name LIKE ?",
+                (directory, prefix.replace('%', '') + '%')))
+            changed = []
+            for entry in os.scandir(directory):
+                if not (entry.name.startswith(prefix) and
+                        entry.name.endswith('.fits')):
+                    continue
+                st = entry.stat()
+                if entry.path in known:
+                    mtime = known.pop(entry.path)
+                    if mtime == st.st_mtime:
+                        continue
+                changed.append((entry, st))
+
+            # Whatever is left in known has been removed from disk
+            self.conn.executemany("DELETE FROM files WHERE path = ?",
+                                  [(path,) for path in known])
+
+            for entry, st in changed:
+                try:
+                    rows = self._header_rows(entry.path)
+                except Exception as e:
+                    # Still being written, try again on the next update
+                    print("header_index: unable to read %s: %s"
+                          % (entry.path, str(e)))
+                    continue
+                self.conn.execute("DELETE FROM files WHERE path = ?",
+                                  (entry.path,))
+                self.conn.execute(
+                    "INSERT INTO files (path, dir, name, mtime, ctime) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (entry.path, directory, entry.name, st.st_mtime,
+                     st.st_ctime))
+                self.conn.executemany(
+                    "INSERT INTO keywords (path, key, sval, nval) "
+                    "VALUES (?, ?, ?, ?)", rows)
+            self.conn.commit()
+        return len(changed)
+
+    def find(self, directory, prefix='', keywords=None):
+        """
+        Files whose headers match every keyword.  String values match
+        when the lower cased value is contained in the header value,
+        numbers must be equal.
+
+        :param directory: directory holding the fits files
+        :param prefix: file name prefix (camera)
+        :param keywords: dict of header keyword: value
+        :return: list of matching paths
+        """
+        directory = os.path.abspath(directory)
+        sql = "SELECT f.path FROM files f WHERE f.dir = ? AND f.name LIKE ?"
+        args = [directory, prefix.replace('%', '') + '%']
+        for key, value in (keywords or {}).items():
+            if isinstance(value, str):
+                sql += (" AND EXISTS (SELECT 1 FROM keywords k WHERE "
+                        "k.path = f.path AND k.key = ? AND "
+                        "instr(k.sval, ?) > 0)")
+                args += [key.upper(), value.lower()]
+            else:
+                sql += (" AND EXISTS (SELECT 1 FROM keywords k WHERE "
+                        "k.path = f.path AND k.key = ? AND k.nval = ?)")
+                args += [key.upper(), float(value)]
+        with self.lock:
+            return [r[0] for r in self.conn.execute(sql, args)]
+
+    def latest(self, directory, prefix=''):
+        """
+        Most recently created indexed file in a directory
+
+        :return: path or None
+        """
+        directory = os.path.abspath(directory)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT path FROM files WHERE dir = ? AND name LIKE ? "
+                "ORDER BY ctime DESC LIMIT 1",
+                (directory, prefix.replace('%', '') + '%')).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+if __name__ == "__main__":
+    index = HeaderIndex('/tmp/header_index.db')
+    t = time.time()
+    print(index.update('/home/sedm/images/20191125'), time.time() - t)
+    print(len(index.find('/home/sedm/images/20191125', 'ifu',
+                         {'imgtype': 'bias', 'adcspeed': 2.0})))
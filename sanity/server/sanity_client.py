@@ -1,6 +1,6 @@
 import socket
 import time
-import json
+from utils import framing
 
 
 class Sanity:
@@ -32,27 +32,22 @@ class Sanity:
                 self.socket.settimeout(timeout)
 
             if parameters:
-                send_str = json.dumps({'command': cmd,
-                                       'parameters': parameters})
+                message = {'command': cmd, 'parameters': parameters}
             else:
-                send_str = json.dumps({'command': cmd})
+                message = {'command': cmd}
 
-            self.socket.send(b"%s" % send_str.encode('utf-8'))
+            framing.send_message(self.socket, message)
 
             if return_before_done:
 
                 return {"elaptime": time.time()-start,
                         "data": "exiting the loop early"}
 
-            data = self.socket.recv(2048)
-            counter = 0
-            while not data:
-                time.sleep(.1)
-                data = self.socket.recv(2048)
-                counter += 1
-                if counter > 100:
-                    break
-            return json.loads(data.decode('utf-8'))
+            data = framing.recv_message(self.socket)
+            if data is None:
+                return {'elaptime': time.time() - start,
+                        'error': 'socket disconnect'}
+            return data
         except Exception as e:
             return {'elaptime': time.time() - start, 'error': str(e)}
 
@@ -68,6 +63,14 @@ class Sanity:
                                    return_before_done=return_before_done,
                                    parameters=parameters)
 
+    def latest_file(self, data_dir, prefix=''):
+        parameters = {
+            'data_dir': data_dir,
+            'prefix': prefix
+        }
+
+        return self.__send_command(cmd="LATESTFILE", parameters=parameters)
+
     def check_socket(self):
         """
         Try sending a command to the camera program
@@ -76,15 +79,10 @@ class Sanity:
         return self.__send_command(cmd="PING")
 
     def listen(self):
-        data = self.socket.recv(2048)
-        counter = 0
-        while not data:
-            time.sleep(.1)
-            data = self.socket.recv(2048)
-            counter += 1
-            if counter > 100:
-                break
-        return json.loads(data.decode('utf-8'))
+        data = framing.recv_message(self.socket)
+        if data is None:
+            return {'error': 'socket disconnect'}
+        return data
 
 
 if __name__ == '__main__':
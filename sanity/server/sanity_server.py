@@ -8,6 +8,7 @@ import socket
 import threading
 from sanity import fileChecker
 import SEDM_robot_version as Version
+from utils import framing
 
 with open(os.path.join(Version.CONFIG_DIR, 'logging.json')) as data_file:
     params = json.load(data_file)
@@ -48,32 +49,34 @@ class SanityServer:
             response = {'test': 'test'}
             try:
                 start = time.time()
-                data = connection.recv(2048)
-
-                data = data.decode("utf8")
-                logger.info("Received: %s", data)
-
-                if not data:
-                    break
                 try:
-                    data = json.loads(data)
-                except Exception as e:
+                    data = framing.recv_message(connection)
+                except framing.FramingError:
+                    logger.error("Connection lost mid-message", exc_info=True)
+                    break
+                except ValueError as e:
                     logger.error("Load error", exc_info=True)
-                    error_dict = json.dumps({'elaptime': time.time()-start,
-                                             "error": "error message %s"
-                                                      % str(e)})
-                    connection.sendall(error_dict)
+                    framing.send_message(connection,
+                                         {'elaptime': time.time()-start,
+                                          "error": "error message %s"
+                                                   % str(e)})
+                    break
+                logger.info("Received: %s", data)
+
+                if data is None:
                     break
 
                 if 'command' in data:
                     if data['command'].upper() == 'CHECKFORFILES':
                         response = self.files.check_for_images(
                             **data['parameters'])
+                    elif data['command'].upper() == 'LATESTFILE':
+                        response = self.files.latest_image(
+                            **data['parameters'])
                 else:
                     response = {'elaptime': time.time()-start,
                                 'error': "Command not found"}
-                jsonstr = json.dumps(response)
-                connection.sendall(jsonstr.encode('utf-8'))
+                framing.send_message(connection, response)
             except Exception as e:
                 logger.error("Big error", exc_info=True)
                 pass
@@ -6,6 +6,7 @@ import paramiko
 import time
 import json
 import SEDM_robot_version as Version
+from utils import framing
 
 with open(os.path.join(Version.CONFIG_DIR, 'watcher.json')) as data_file:
     params = json.load(data_file)
@@ -114,14 +115,10 @@ def get_camera_info(conn, cam_string='ifu'):
     :return:
     """
     info_dict = {}
-    send_dict = json.dumps({'command': 'STATUS'})
-
-    conn.send(b"%s" % send_dict.encode('utf-8'))
-    time.sleep(.05)
-    ret = conn.recv(1024)
+    framing.send_message(conn, {'command': 'STATUS'})
 
     try:
-        cam_dict = json.loads(ret.decode('utf-8'))
+        cam_dict = framing.recv_message(conn)
         if 'ifu' in cam_string:
             expt = "%.1f" % cam_dict['camexptime']
         else:
@@ -132,13 +129,10 @@ def get_camera_info(conn, cam_string='ifu'):
     except Exception as ex:
         print(str(ex))
 
-    send_dict = json.dumps({'command': 'LASTEXPOSED'})
-    conn.send(b"%s" % send_dict.encode('utf-8'))
-    time.sleep(.05)
-    ret = conn.recv(1024)
+    framing.send_message(conn, {'command': 'LASTEXPOSED'})
     try:
 
-        exp_dict = json.loads(ret.decode('utf-8'))
+        exp_dict = framing.recv_message(conn)
         if 'data' in exp_dict:
             print(exp_dict)
             ob_time = exp_dict['data']
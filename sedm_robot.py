@@ -150,7 +150,9 @@ class SEDm:
                  run_ocs=True, run_telescope=True, run_sky=True,
                  run_sanity=True, configuration_file='', data_dir=None,
                  focus_temp=None, focus_pos=None, focus_time=None,
-                 focus_guess=False, use_winter=False):
+                 focus_guess=False, use_winter=False,
+                 use_status_snapshot=True, snapshot_max_age=10,
+                 use_lookahead=True):
         """
 
         :param observer:
@@ -168,6 +170,12 @@ class SEDm:
         :param focus_temp:
         :param focus_pos:
         :param focus_guess
+        :param use_winter:
+        :param use_status_snapshot: build exposure status from the OCS
+                                    background snapshot when it is fresh
+        :param snapshot_max_age: seconds before a TCS snapshot field is stale
+        :param use_lookahead: have the sky server prepare the next target
+                              while a science target is observed
         """
         logger.info("Robotic system initializing")
         self.observer = observer
@@ -180,6 +188,11 @@ class SEDm:
         self.run_arclamps = run_arclamps
         self.run_telescope = run_telescope
         self.use_winter = use_winter
+        self.use_status_snapshot = use_status_snapshot
+        self.snapshot_max_age = snapshot_max_age
+        self.use_lookahead = use_lookahead
+        self.overheads = {}
+        self.overheads_time = 0
         self.initialized = initialized
         self.data_dir = data_dir
         self.focus_temp = focus_temp
@@ -205,6 +218,8 @@ class SEDm:
         self.obj_id = -1
         self.req_id = -1
         self.guider_list = []
+        # (camera, filename) of frames still being written or sent
+        self.pending_files = []
         self.lamp_wait_time = dict(xe=120, cd=420, hg=120, hal=120)
 
         self.calibration_id_dict = {
@@ -436,7 +451,95 @@ class SEDm:
         self.initialized = True
         return {'elaptime': time.time() - start, 'data': "System initialized"}
 
+    @staticmethod
+    def _winter_weather(win_dict):
+        """Map WINTER weather keys onto the header weather keys"""
+        return {'windspeed_average': win_dict['Average_Wind_Speed'],
+                'wind_dir_current': win_dict['Wind_Direction'],
+                'outside_air_temp': win_dict['Outside_Temp'],
+                'inside_air_temp': win_dict['Outside_Temp'],
+                'outside_rel_hum': win_dict['Outside_RH'],
+                'inside_rel_hum': win_dict['Outside_RH'],
+                'outside_dewpt': win_dict['Outside_Dewpoint'],
+                'inside_dewpt': win_dict['Outside_Dewpoint']}
+
+    def _status_dict_from_snapshot(self, do_lamps=True, do_stages=True):
+        """
+        Build the exposure status dictionary from a single OCS snapshot
+        request.  Lamp and stage fields are invalidated by the server
+        whenever they are commanded, so they may be older than TCS fields.
+
+        :return: status dictionary or None if any needed field is stale
+        """
+        ret = self.ocs.get_snapshot()
+        if 'data' not in ret or not isinstance(ret['data'], dict):
+            logger.warning("Bad snapshot return: %s", ret)
+            return None
+        snap = ret['data']
+
+        # Ages come from the server clock, None once a field is commanded
+        def fresh(field, max_age):
+            return field in snap and snap[field].get('age') is not None \
+                and snap[field]['age'] < max_age
+
+        stat_dict = {}
+        for field in ['pos', 'weather', 'status']:
+            if not fresh(field, self.snapshot_max_age) or \
+                    not isinstance(snap[field]['data'], dict):
+                logger.info("Snapshot field %s is stale", field)
+                return None
+            stat_dict.update(snap[field]['data'])
+
+        if self.use_winter:
+            if fresh('winter', self.snapshot_max_age):
+                win_dict = snap['winter']['data']
+            else:
+                wret = self.winter.get_weather()
+                win_dict = wret['data'] if 'data' in wret else None
+            if win_dict:
+                stat_dict.update(self._winter_weather(win_dict))
+
+        # Commanded lamps and stages are invalidated (no age) by the server
+        device_max_age = max(self.snapshot_max_age, 120)
+        if do_lamps and self.run_arclamps:
+            for lamp in ['xe', 'cd', 'hg']:
+                field = '%s_lamp' % lamp
+                if not fresh(field, device_max_age):
+                    logger.info("Snapshot field %s is stale", field)
+                    return None
+                ld = snap[field]['data']
+                stat_dict[field] = ld if isinstance(ld, str) else 'UNKNOWN'
+                self.lamp_dict_status[lamp] = stat_dict[field]
+        else:
+            for lamp in ['xe', 'cd', 'hg']:
+                stat_dict['%s_lamp' % lamp] = self.lamp_dict_status[lamp]
+
+        if do_stages and self.run_stage:
+            for stage_id, key in [(1, 'ifufocus'), (2, 'ifufoc2')]:
+                field = 'stage%d' % stage_id
+                if not fresh(field, device_max_age):
+                    logger.info("Snapshot field %s is stale", field)
+                    return None
+                stat_dict[key] = snap[field]['data']
+                self.stage_dict[key] = stat_dict[key]
+        else:
+            stat_dict['ifufocus'] = self.stage_dict['ifufocus']
+            stat_dict['ifufoc2'] = self.stage_dict['ifufoc2']
+        return stat_dict
+
     def get_status_dict(self, do_lamps=True, do_stages=True):
+        if self.ocs is not None and self.use_status_snapshot:
+            try:
+                stat_dict = self._status_dict_from_snapshot(
+                    do_lamps=do_lamps, do_stages=do_stages)
+                if stat_dict is not None:
+                    return stat_dict
+            except Exception as e:
+                logger.error("Error reading status snapshot: %s", str(e))
+        return self._get_status_dict_direct(do_lamps=do_lamps,
+                                            do_stages=do_stages)
+
+    def _get_status_dict_direct(self, do_lamps=True, do_stages=True):
         stat_dict = {}
 
         # Are we NOT running the ocs?
@@ -469,20 +572,7 @@ class SEDm:
                 if self.use_winter:
                     wret = self.winter.get_weather()
                     if 'data' in wret:
-                        win_dict = wret['data']
-                        # stat_dict['weather_status'] = win_dict[
-                        #   'Weather_Status']
-                        stat_dict['windspeed_average'] = win_dict[
-                            'Average_Wind_Speed']
-                        stat_dict['wind_dir_current'] = win_dict[
-                            'Wind_Direction']
-                        stat_dict['outside_air_temp'] = win_dict['Outside_Temp']
-                        stat_dict['inside_air_temp'] = win_dict['Outside_Temp']
-                        stat_dict['outside_rel_hum'] = win_dict['Outside_RH']
-                        stat_dict['inside_rel_hum'] = win_dict['Outside_RH']
-                        stat_dict['outside_dewpt'] = win_dict[
-                            'Outside_Dewpoint']
-                        stat_dict['inside_dewpt'] = win_dict['Outside_Dewpoint']
+                        stat_dict.update(self._winter_weather(wret['data']))
                 sret = self.ocs.check_status()
                 if 'data' in sret:
                     sd = sret['data']
@@ -559,6 +649,84 @@ class SEDm:
                 stat_dict['ifufoc2'] = self.stage_dict['ifufoc2']
         return stat_dict
 
+    def _wait_for_file(self, cam, ret, timeout=120):
+        """
+        Poll the camera write queue until a queued frame is on disk here,
+        for steps that read the frame right away
+
+        :param cam: camera client the frame was taken with
+        :param ret: take_image return
+        :param timeout: seconds to wait before giving up
+        :return: take_image style return dict, the camera's local path if
+                 the transfer failed
+        """
+        if not isinstance(ret, dict) or not ret.get('queued'):
+            return ret
+        start = time.time()
+        filename = ret['data']
+        while time.time() - start < timeout:
+            fret = cam.file_status(filename)
+            status = fret.get('status')
+            if status == 'done':
+                return {'elaptime': ret['elaptime'] + time.time() - start,
+                        'data': fret['data']}
+            elif status == 'error' and fret.get('data'):
+                logger.error("Camera could not transfer %s: %s", filename,
+                             fret.get('error'))
+                return {'elaptime': ret['elaptime'] + time.time() - start,
+                        'data': fret['data']}
+            elif status == 'error' or status is None:
+                logger.error("Camera could not write %s: %s", filename,
+                             fret.get('error'))
+                return {'elaptime': ret['elaptime'] + time.time() - start,
+                        'error': "Camera could not write %s" % filename}
+            time.sleep(.1)
+        logger.error("Timed out waiting for %s to be written", filename)
+        return {'elaptime': ret['elaptime'] + time.time() - start,
+                'error': "Timed out waiting for %s" % filename}
+
+    def _wait_for_images(self, cam, img_list):
+        """
+        Wait for the queued frames of img_list before they are solved
+
+        :param cam: camera client the frames were taken with
+        :param img_list: paths returned by take_image
+        :return: paths of the frames that made it to disk
+        """
+        images = []
+        for img in img_list:
+            if (cam, img) in self.pending_files:
+                ret = self._wait_for_file(cam, {'elaptime': 0, 'data': img,
+                                                'queued': True})
+                if 'data' in ret:
+                    images.append(ret['data'])
+            else:
+                images.append(img)
+        return images
+
+    def _check_pending_files(self, cam):
+        """
+        Report frames of cam that failed to write or transfer since the
+        last check and forget the ones that are done
+        """
+        pending = []
+        for pcam, filename in self.pending_files:
+            if pcam is not cam:
+                pending.append((pcam, filename))
+                continue
+            fret = cam.file_status(filename)
+            status = fret.get('status')
+            if status == 'error':
+                logger.error("Camera could not save %s: %s", filename,
+                             fret.get('error'))
+                send_alert_email("Image %s failed to write or transfer: %s"
+                                 % (filename, fret.get('error')))
+            elif status in ('held', 'queued', 'writing', 'transferring'):
+                pending.append((pcam, filename))
+            elif status is None:
+                logger.warning("Lost track of %s: %s", filename, fret)
+        self.pending_files = pending
+
     def take_image(self, cam, exptime=0, shutter='normal', readout=2.0,
                    start=None, save_as=None, test='', imgtype='NA',
                    objtype='NA', object_ra=None, object_dec=None, email='',
@@ -678,6 +846,22 @@ class SEDm:
             logger.error(str(e))
             ret = None
 
+        # The camera holds the frame until it has the header, then writes
+        # and transfers it in the background while the next one is taken
+        if isinstance(ret, dict) and ret.get('held'):
+            obsdict['elaptime'] = time.time() - start
+            wret = cam.write_image(ret['data'], header=obsdict)
+            if 'data' in wret:
+                if 'warning' in wret:
+                    logger.warning("cam.write_image: %s", wret['warning'])
+                self.pending_files.append((cam, wret['data']))
+                self._check_pending_files(cam)
+                return {'elaptime': time.time() - start,
+                        'data': wret['data'], 'queued': True}
+            logger.error("Camera could not queue %s: %s", ret['data'],
+                         wret.get('error'))
+            ret = None
+
         # TODO: add obsdict verification routine
         if isinstance(ret, dict) and 'data' in ret:
             if not is_rc:
@@ -690,10 +874,16 @@ class SEDm:
             # This is a test to see if last image failed to write or the
             # connection timed out.
             # * means all if we need specific format then *.csv
-            list_of_files = glob.glob('/home/sedm/images/%s/*.fits' %
-                                      datetime.datetime.utcnow().strftime(
-                                          "%Y%m%d"))
-            latest_file = max(list_of_files, key=os.path.getctime)
+            night_dir = '/home/sedm/images/%s' % \
+                datetime.datetime.utcnow().strftime("%Y%m%d")
+            latest_file = None
+            if self.sanity is not None:
+                lret = self.sanity.latest_file(night_dir)
+                if 'data' in lret:
+                    latest_file = lret['data']
+            if not latest_file:
+                list_of_files = glob.glob(os.path.join(night_dir, '*.fits'))
+                latest_file = max(list_of_files, key=os.path.getctime)
 
             logger.info('Checking latest file: %s' % latest_file)
             base_file = os.path.basename(latest_file)
@@ -1577,6 +1767,7 @@ class SEDm:
                               objfilter='r', imgset='NA',
                               is_rc=False, abpair=False)
         logger.info(ret)
+        ret = self._wait_for_file(self.rc, ret)
         ret = self.sky.solve_offset_new(ret['data'], return_before_done=False)
         logger.info("sky.solve_offset_new status:\n%s", ret)
         if 'error' in ret:
@@ -1731,6 +1922,7 @@ class SEDm:
         logger.info("focus image list:\n%s", img_list)
         # send_alert_email("Focus sequence finished")
         if solve:
+            img_list = self._wait_for_images(self.rc, img_list)
             ret = self.sky.get_rc_focus(img_list,
                                         nominal_focus=nominal_rc_focus)
             logger.info("sky.get_focus status:\n%s", ret)
@@ -1854,6 +2046,7 @@ class SEDm:
         logger.info("focus image list:\n%s", img_list)
         # send_alert_email("Focus sequence finished")
         if solve:
+            img_list = self._wait_for_images(self.ifu, img_list)
             ret = self.sky.get_spec_focus(img_list, header_field='IFUFOCUS',
                                           nominal_focus=nominal_spec_focus,
                                           lamp=lamp)
@@ -1981,6 +2174,7 @@ class SEDm:
         logger.info("focus image list:\n%s", img_list)
         # send_alert_email("Focus sequence finished")
         if solve:
+            img_list = self._wait_for_images(self.ifu, img_list)
             ret = self.sky.get_focus(img_list, header_field='IFUFOC2',
                                      nominal_focus=nominal_ifu_focus)
             logger.info("sky.get_focus status:\n%s", ret)
@@ -2027,10 +2221,8 @@ class SEDm:
             seconds=guide_length - 5)
         filename = str(abs(req_id))
         save_dir = '/home/sedm/images/%s/' % end_time.strftime('%Y%m%d')
-        if readout == 2.0:
-            readout_time = 7
-        else:
-            readout_time = 47
+        readout_time = self._readout_time(
+            'rc', readout, default=7 if readout == 2.0 else 47)
 
         self.guider_list = []
         logger.info("Guider log file parameters: %s, %s", save_dir, filename)
@@ -2377,6 +2569,48 @@ class SEDm:
 
         return {'elaptime': time.time() - start, 'data': key_dict}
 
+    def _refresh_overheads(self, max_age=21600):
+        """
+        Fetch the overheads fitted by the sky server when ours are older
+        than max_age seconds.  Call from the main thread, the guider
+        thread shares the sky connection.
+        """
+        if not self.run_sky or time.time() - self.overheads_time < max_age:
+            return
+        self.overheads_time = time.time()
+        ret = self.sky.get_overheads()
+        if 'data' in ret:
+            self.overheads = ret['data']
+            logger.info("Overheads: %s", self.overheads)
+        else:
+            logger.warning("Unable to get the overheads: %s", ret)
+
+    def _readout_time(self, camera, readout=None, default=47.):
+        """
+        Seconds each frame takes beyond its exposure time
+
+        :param camera: 'rc' or 'ifu'
+        :param readout: readout speed, None for science frames
+        :param default: used until the sky server has a fitted value
+        """
+        key = camera if readout is None else "%s_%.1f" % (camera,
+                                                         float(readout))
+        return self.overheads.get('exposure', {}).get(key, default)
+
+    def _prepare_next_target(self, duration):
+        """
+        Let the sky server work out the next target while this one is
+        being observed
+
+        :param duration: expected seconds until this observation ends
+        """
+        if not self.use_lookahead or not self.run_sky:
+            return
+        end_time = (datetime.datetime.utcnow() +
+                    datetime.timedelta(seconds=duration))
+        ret = self.sky.prepare_next_target(obsdatetime=end_time.isoformat())
+        logger.info("sky.prepare_next_target status:\n%s", ret)
+
     def observe_by_dict(self, obsdict, move=True, run_acquisition_ifu=True,
                         run_acquisition_rc=False, guide=True, test="",
                         mark_status=True):
@@ -2488,6 +2722,8 @@ class SEDm:
         if mark_status:
             sky_ret = self.sky.update_target_request(req_id, status="ACTIVE")
             logger.info("sky.update_target_request(IFU) status:\n%s", sky_ret)
+            self._prepare_next_target(
+                exptime * 1.20 + (180 if move and run_acquisition else 30))
 
         if move:
             if run_acquisition:
@@ -2530,6 +2766,7 @@ class SEDm:
         exptime = exptime * 1.20
 
         if guide:
+            self._refresh_overheads()
             logger.debug("Beginning sequence for guiding IFU exposure")
             try:
                 t = Thread(target=self.run_guider_seq, kwargs={
@@ -2611,6 +2848,18 @@ class SEDm:
         if mark_status:
             sky_ret = self.sky.update_target_request(req_id, status="ACTIVE")
             logger.info("sky.update_target_request status:\n%s", sky_ret)
+            if obs_exptime and obs_repeat_filter:
+                self._refresh_overheads()
+                readout_time = self._readout_time('rc')
+                exptimes = obs_exptime.split(',') \
+                    if isinstance(obs_exptime, str) else obs_exptime
+                repeats = obs_repeat_filter.split(',') \
+                    if isinstance(obs_repeat_filter, str) \
+                    else obs_repeat_filter
+                self._prepare_next_target(
+                    repeat * sum((float(e) + readout_time) * int(r)
+                                 for e, r in zip(exptimes, repeats)) +
+                    (180 if move and run_acquisition else 30))
 
         if move:
             if run_acquisition:
@@ -2788,14 +3037,15 @@ class SEDm:
                               objfilter='r', imgset='NA',
                               is_rc=True, abpair=False)
         logger.info("take_image(ACQ) status:\n%s", ret)
+        ret = self._wait_for_file(cam, ret)
         if 'error' in ret:
             return {'elaptime': time.time() - start,
                     'error': 'Error acquiring acquisition image: error return'}
         elif 'data' in ret:
             # get offset to reference RC pixel
-            ret = self.sky.solve_offset_new(ret['data'],
-                                            return_before_done=True)
-            logger.info("sky.solve_offset_new status(ACQ):\n%s", ret)
+            ret = self.sky.submit_offset(ret['data'])
+            logger.info("sky.submit_offset status(ACQ):\n%s", ret)
+            job_id = ret.get('data')
             # Move to IFU position first?
             p_ra = p_dec = None
             if move and offset_to_ifu and not tcsx:
@@ -2816,8 +3066,9 @@ class SEDm:
                                 self.ocs.tel_offset(ifu_ra_offset,
                                                     ifu_dec_offset))
             # read offsets from sky solver
-            ret = self.sky.listen()
-            logger.info("sky.listen(ACQ) status:\n%s", ret)
+            if job_id:
+                ret = self.sky.job_result(job_id)
+            logger.info("sky.job_result(ACQ) status:\n%s", ret)
             if 'data' in ret:
                 ra_off = ret['data']['ra_offset']
                 dec_off = ret['data']['dec_offset']
@@ -2909,6 +3160,7 @@ class SEDm:
                               objfilter='r', imgset='NA',
                               is_rc=True, abpair=False)
         logger.info("take_image(TELX) status:\n%s", ret)
+        ret = self._wait_for_file(self.rc, ret)
         if 'error' in ret:
             logger.error("Bad image: error in return")
             return {'elaptime': time.time() - start,
@@ -2916,12 +3168,12 @@ class SEDm:
                              'error in return'}
         elif 'data' in ret:
             # get offset to reference RC pixel
-            ret = self.sky.solve_offset_new(ret['data'],
-                                            return_before_done=True)
-            logger.info("sky.solve_offset_new(TELX) status:\n%s", ret)
+            ret = self.sky.submit_offset(ret['data'])
+            logger.info("sky.submit_offset(TELX) status:\n%s", ret)
             # read offsets from sky solver
-            ret = self.sky.listen()
-            logger.info("sky.listen(TELX) status:\n%s", ret)
+            if 'data' in ret:
+                ret = self.sky.job_result(ret['data'])
+            logger.info("sky.job_result(TELX) status:\n%s", ret)
             if 'data' in ret:
                 ra_off = ret['data']['ra_offset']
                 dec_off = ret['data']['dec_offset']
@@ -52,7 +52,9 @@ def solve_astrometry(img, radius=2.5, with_pix=True, downsample="",
 
     print(cmd)
 
-    cmd = cmd + " > /tmp/astrometry_fail  2>/tmp/astrometry_fail"
+    # Per image log so concurrent solves do not share it
+    fail_log = "/tmp/astrometry_fail_%s" % os.path.basename(img)
+    cmd = cmd + " > %s  2>%s" % (fail_log, fail_log)
     try:
         subprocess.call(cmd, shell=True, timeout=120)
     except Exception as e:
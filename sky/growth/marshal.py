@@ -1,6 +1,8 @@
 import json
 import os
 import requests
+import sqlite3
+import threading
 import time
 
 SITE_ROOT = os.path.abspath(os.path.dirname(__file__)+'/../..')
@@ -8,12 +10,37 @@ SITE_ROOT = os.path.abspath(os.path.dirname(__file__)+'/../..')
 with open(os.path.join(SITE_ROOT, 'config', 'growth.config.json')) as data_file:
     params = json.load(data_file)
 
+OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    key TEXT PRIMARY KEY,
+    growth_id INTEGER,
+    request_id INTEGER,
+    message TEXT NOT NULL,
+    queued REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_try REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS marshal_ids (
+    request_id INTEGER PRIMARY KEY,
+    growth_id INTEGER NOT NULL
+);
+"""
+
+# One sender thread per outbox file in a process, see Interface._sender
+_senders = {}
+_senders_lock = threading.Lock()
+
 
 class Interface:
     def __init__(self, dbhost_get_url=params['get_id_url'],
                  growth_url=params['growth_url'], instrument_id=65,
                  user=params['growth_user'],
-                 passwd=params['growth_pwd']):
+                 passwd=params['growth_pwd'],
+                 outbox_file=params.get('outbox_file',
+                                        os.path.join(SITE_ROOT,
+                                                     'growth_outbox.db')),
+                 timeout=30, max_attempts=20, retry_delay=10,
+                 max_backoff=600):
         """
 
         :param dbhost_get_url:
@@ -21,6 +48,13 @@ class Interface:
         :param instrument_id:
         :param user:
         :param passwd:
+        :param outbox_file: sqlite file queueing status updates, None to
+                            send them synchronously
+        :param timeout: http timeout in seconds
+        :param max_attempts: failed sends before an update is dropped
+        :param retry_delay: seconds before the first retry, doubled for
+                            each one after
+        :param max_backoff: longest wait in seconds between retries
         """
 
         self.dbhost_url = dbhost_get_url
@@ -28,6 +62,43 @@ class Interface:
         self.instrument_id = instrument_id
         self.user = user
         self.passwd = passwd
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_backoff = max_backoff
+
+        # One keep-alive session for every request to the two hosts
+        self.session = requests.Session()
+        self.session_lock = threading.Lock()
+
+        self.outbox = None
+        self.outbox_file = outbox_file
+        self.stopped = threading.Event()
+        self.wake = threading.Event()
+        self.sender = None
+        if outbox_file:
+            self.outbox_lock = threading.Lock()
+            self.outbox = sqlite3.connect(outbox_file, timeout=30,
+                                          check_same_thread=False)
+            self.outbox.execute("PRAGMA journal_mode = WAL")
+            self.outbox.executescript(OUTBOX_SCHEMA)
+            self.outbox.commit()
+            self._sender()
+
+    def _sender(self):
+        """
+        The interface whose thread drains this outbox file, this one if
+        no other in the process is running
+        """
+        key = os.path.abspath(self.outbox_file)
+        with _senders_lock:
+            owner = _senders.get(key)
+            if owner is None or owner.stopped.is_set():
+                owner = self
+                _senders[key] = self
+                self.sender = threading.Thread(target=self._run, daemon=True)
+                self.sender.start()
+            return owner
 
     def get_marshal_id_from_dbhost(self, request_id):
         """
@@ -39,8 +110,10 @@ class Interface:
         payload = {'request_id': request_id}
         headers = {'content-type': 'application/json'}
         json_data = json.dumps(payload)
-        response = requests.post(self.dbhost_url, data=json_data,
-                                 headers=headers)
+        with self.session_lock:
+            response = self.session.post(self.dbhost_url, data=json_data,
+                                         headers=headers,
+                                         timeout=self.timeout)
         ret = json.loads(response.text)
         if 'error' in ret:
             return {'elaptime': time.time()-start,
@@ -49,20 +122,13 @@ class Interface:
             return {'elaptime': time.time()-start,
                     'data': ret['marshal_id']}
 
-    def update_growth_status(self, growth_id=None, request_id=None,
-                             message="PENDING"):
+    def _send_status(self, growth_id=None, request_id=None,
+                     message="PENDING"):
         """
-
-        :param growth_id:
-        :param request_id:
-        :param message:
-        :return:
+        Post a status update to the marshal now.  Network failures are
+        raised as requests.RequestException.
         """
         start = time.time()
-        if not growth_id and not request_id:
-            return {"elaptime": time.time()-start,
-                    "error": "No growth id or request id given"}
-
         if not growth_id and request_id:
             ret = self.get_marshal_id_from_dbhost(request_id)
             if 'error' in ret:
@@ -83,16 +149,205 @@ class Interface:
             'new_status': message
         }
 
-        out_file = open('json_file.txt', 'w')
-        out_file.write(json.dumps(status_config))
-        out_file.close()
+        with self.session_lock:
+            ret = self.session.post(
+                self.growth_url, auth=(self.user, self.passwd),
+                files={'jsonfile': ('json_file.txt',
+                                    json.dumps(status_config))},
+                timeout=self.timeout)
 
-        json_file = open('json_file.txt', 'r')
+        return {'elaptime': time.time()-start,
+                'data': ret.status_code}
 
-        ret = requests.post(self.growth_url, auth=(self.user, self.passwd),
-                            files={'jsonfile': json_file})
+    def update_growth_status(self, growth_id=None, request_id=None,
+                             message="PENDING"):
+        """
+        Queue a status update for the marshal.  A newer update for the
+        same target replaces one that has not been sent yet.  Updates are
+        keyed on the growth id, one given by request id is filed under
+        its request until the sender has looked the growth id up.
 
-        json_file.close()
+        :param growth_id:
+        :param request_id: used to look up the growth id when not given
+        :param message:
+        :return:
+        """
+        start = time.time()
+        if not growth_id and not request_id:
+            return {"elaptime": time.time()-start,
+                    "error": "No growth id or request id given"}
+
+        if growth_id and not isinstance(growth_id, int):
+            return {'elaptime': time.time()-start,
+                    'error': growth_id}
+
+        if self.outbox is None:
+            return self._send_status(growth_id=growth_id,
+                                     request_id=request_id, message=message)
 
+        with self.outbox_lock:
+            if not growth_id:
+                row = self.outbox.execute(
+                    "SELECT growth_id FROM marshal_ids WHERE request_id = ?",
+                    (request_id,)).fetchone()
+                growth_id = row[0] if row else None
+            key = 'g%s' % growth_id if growth_id else 'r%s' % request_id
+            self.outbox.execute(
+                "INSERT OR REPLACE INTO outbox (key, growth_id, request_id, "
+                "message, queued) VALUES (?, ?, ?, ?, ?)",
+                (key, growth_id, request_id, message, time.time()))
+            self.outbox.commit()
+        self._sender().wake.set()
         return {'elaptime': time.time()-start,
-                'data': ret.status_code}
+                'data': 'queued'}
+
+    def pending(self):
+        """Number of updates waiting in the outbox"""
+        if self.outbox is None:
+            return 0
+        with self.outbox_lock:
+            return self.outbox.execute(
+                "SELECT count(*) FROM outbox").fetchone()[0]
+
+    def _claim(self, key, queued):
+        """
+        Push the next try of a due update past the time it takes to send
+        it, so no other sender picks it up meanwhile
+
+        :return: True if this sender got the update
+        """
+        now = time.time()
+        with self.outbox_lock:
+            cur = self.outbox.execute(
+                "UPDATE outbox SET next_try = ? WHERE key = ? AND queued = ? "
+                "AND next_try <= ?",
+                (now + 3 * self.timeout, key, queued, now))
+            self.outbox.commit()
+        return cur.rowcount == 1
+
+    def _rekey(self, key, growth_id, request_id, message, queued, attempts):
+        """
+        File a claimed update queued by request id under the growth id it
+        was found to have
+
+        :return: True if it is still the newest update for the target
+        """
+        new_key = 'g%s' % growth_id
+        with self.outbox_lock:
+            self.outbox.execute(
+                "INSERT OR REPLACE INTO marshal_ids (request_id, growth_id) "
+                "VALUES (?, ?)", (request_id, growth_id))
+            cur = self.outbox.execute(
+                "DELETE FROM outbox WHERE key = ? AND queued = ?",
+                (key, queued))
+            newer = self.outbox.execute(
+                "SELECT count(*) FROM outbox WHERE key = ? AND queued > ?",
+                (new_key, queued)).fetchone()[0]
+            current = cur.rowcount == 1 and not newer
+            if current:
+                self.outbox.execute(
+                    "INSERT OR REPLACE INTO outbox (key, growth_id, "
+                    "request_id, message, queued, attempts, next_try) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (new_key, growth_id, request_id, message, queued,
+                     attempts, time.time() + 3 * self.timeout))
+            self.outbox.commit()
+        return current
+
+    def drain(self):
+        """
+        Send every update that is due, oldest first
+
+        :return: number of updates sent
+        """
+        with self.outbox_lock:
+            rows = self.outbox.execute(
+                "SELECT key, growth_id, request_id, message, queued, "
+                "attempts FROM outbox WHERE next_try <= ? ORDER BY queued",
+                (time.time(),)).fetchall()
+
+        sent = 0
+        for key, growth_id, request_id, message, queued, attempts in rows:
+            if self.stopped.is_set():
+                break
+            if not self._claim(key, queued):
+                continue
+            try:
+                if not growth_id:
+                    ret = self.get_marshal_id_from_dbhost(request_id)
+                    if not isinstance(ret.get('data'), int):
+                        ret = {'error': ret.get('error', ret.get('data'))}
+                    else:
+                        growth_id = ret['data']
+                        if not self._rekey(key, growth_id, request_id,
+                                           message, queued, attempts):
+                            # Replaced by a newer update for the target
+                            continue
+                        key = 'g%s' % growth_id
+                if growth_id:
+                    ret = self._send_status(growth_id=growth_id,
+                                            message=message)
+                retry = ret.get('data', 0) >= 500
+            except (requests.RequestException, ValueError) as e:
+                ret = {'error': str(e)}
+                retry = True
+
+            with self.outbox_lock:
+                if retry and attempts + 1 < self.max_attempts:
+                    delay = min(self.retry_delay * 2 ** attempts,
+                                self.max_backoff)
+                    print("marshal: %s %s failed, retry in %.0fs: %s" %
+                          (key, message, delay, ret))
+                    self.outbox.execute(
+                        "UPDATE outbox SET attempts = ?, next_try = ? "
+                        "WHERE key = ? AND queued = ?",
+                        (attempts + 1, time.time() + delay, key, queued))
+                else:
+                    if 'error' in ret or retry:
+                        print("marshal: dropping %s %s: %s" %
+                              (key, message, ret))
+                    else:
+                        sent += 1
+                    # Leave it if a newer update arrived while sending
+                    self.outbox.execute(
+                        "DELETE FROM outbox WHERE key = ? AND queued = ?",
+                        (key, queued))
+                self.outbox.commit()
+        return sent
+
+    def _next_try(self):
+        """Seconds until the next update is due, from 0.1 to 10"""
+        with self.outbox_lock:
+            next_try = self.outbox.execute(
+                "SELECT min(next_try) FROM outbox").fetchone()[0]
+        if next_try is None:
+            return 10
+        return min(max(next_try - time.time(), 0.1), 10)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.wake.wait(self._next_try())
+            self.wake.clear()
+            if self.stopped.is_set():
+                break
+            try:
+                self.drain()
+            except Exception as e:
+                print("marshal: outbox error %s" % str(e))
+
+    def close(self):
+        """Stop the outbox sender, unsent updates stay for the next one"""
+        self.stopped.set()
+        if self.outbox is None:
+            return
+        with _senders_lock:
+            key = os.path.abspath(self.outbox_file)
+            if _senders.get(key) is self:
+                del _senders[key]
+        self.wake.set()
+        if self.sender is not None:
+            self.sender.join(timeout=2 * self.timeout)
+        with self.outbox_lock:
+            self.outbox.close()
+        self.session.close()
+
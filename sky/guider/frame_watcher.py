@@ -0,0 +1,131 @@
+import os
+import queue
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# inotify event masks (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_inotify():
+    """Return libc if it provides inotify, otherwise None"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _ = libc.inotify_init1, libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError, TypeError):
+        return None
+
+
+class FrameWatcher:
+    """
+    Report new frames in a directory as soon as they are completely written.
+
+    Uses inotify (close-after-write and rename-into events) where the
+    platform has it and falls back to a cheap directory scan otherwise.
+    Frames can also be handed over directly with notify().
+    """
+
+    def __init__(self, directory, prefix='rc', suffix='.fits',
+                 poll_interval=1.0, seed=True):
+        """
+
+        :param directory: directory the frames land in
+        :param prefix: frame file name prefix
+        :param suffix: frame file name suffix
+        :param poll_interval: scan interval when inotify is not available
+        :param seed: queue frames already present when the watch starts
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.suffix = suffix
+        self.poll_interval = poll_interval
+        self.frames = queue.Queue()
+        self.seen = set()
+        self.fd = None
+
+        libc = _load_inotify()
+        if libc and os.path.isdir(directory):
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                wd = libc.inotify_add_watch(fd, directory.encode(),
+                                            IN_CLOSE_WRITE | IN_MOVED_TO)
+                if wd >= 0:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+
+        if seed or self.fd is None:
+            self._scan(queue_new=seed)
+
+    def _matches(self, name):
+        return name.startswith(self.prefix) and name.endswith(self.suffix)
+
+    def _add(self, path):
+        if path not in self.seen:
+            self.seen.add(path)
+            self.frames.put(path)
+
+    def _scan(self, queue_new=True):
+        if not os.path.isdir(self.directory):
+            return
+        for entry in sorted(os.scandir(self.directory), key=lambda e: e.name):
+            if self._matches(entry.name):
+                if queue_new:
+                    self._add(entry.path)
+                else:
+                    self.seen.add(entry.path)
+
+    def _read_events(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+        buf = os.read(self.fd, 65536)
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buf):
+            _, _, _, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0').decode()
+            offset += length
+            if self._matches(name):
+                self._add(os.path.join(self.directory, name))
+
+    def notify(self, path):
+        """Direct hand-off of a frame known to be complete"""
+        if self._matches(os.path.basename(path)):
+            self._add(path)
+
+    def get(self, timeout=1.0):
+        """
+        Next unseen frame, in arrival order
+
+        :param timeout: seconds to wait for a frame
+        :return: frame path or None if none arrived in time
+        """
+        try:
+            return self.frames.get_nowait()
+        except queue.Empty:
+            pass
+        if self.fd is not None:
+            self._read_events(timeout)
+        else:
+            try:
+                return self.frames.get(timeout=min(timeout,
+                                                   self.poll_interval))
+            except queue.Empty:
+                self._scan()
+        try:
+            return self.frames.get_nowait()
+        except queue.Empty:
+            return None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -1,9 +1,8 @@
 import datetime
 import os
 import glob
-import time
-from astropy.io import ascii
 from sky.sextractor import run
+from sky.guider import frame_watcher
 from scipy.spatial.distance import cdist
 import numpy as np
 import socket
@@ -34,10 +33,18 @@ class guide:
         self.ocs = ocs_client.Observatory()
         self.socket = socket.socket()
         self.too_big_count = 0
+        self.watcher = None
         self.do_connect = do_connect
         if self.do_connect:
             self.socket.connect((self.telescope_ip, self.telescope_port))
 
+    def notify_frame(self, filename):
+        """Hand a newly written frame straight to a running guider"""
+        if self.watcher is None:
+            return False
+        self.watcher.notify(filename)
+        return True
+
     def _get_catalog_positions(self, catalog, do_filter=True,
                                ellip_constraint=.2):
 
@@ -48,8 +55,7 @@ class guide:
             if 'data' in ret:
                 catalog = ret['data']
 
-        data = ascii.read(catalog)
-        df = data.to_pandas()
+        df = self.extractor.read_catalog(catalog)
 
         if do_filter:
             df = df[(df['X_IMAGE'] > 50) & (df['X_IMAGE']) < 2000]
@@ -160,7 +166,7 @@ class guide:
         # 4. Find or wait for the first image to get the initial points
 
         first_image = None
-        already_processed_list = []
+        already_processed_list = set()
         st_string = start_time.strftime("%Y%m%d_%H_%M_%S")
         log = open("%s%s_%s_guide.txt" % (save_dir, filename, st_string), 'w')
         self.too_big_count = 0
@@ -305,154 +311,157 @@ class guide:
         # log.close()
         # self.socket.send("GM %s %s 10 10 \n" % (x_offset, y_offset))
 
+        print("In the RC Guider Loop", start_time, end_time)
+        print("Watching", os.path.join(data_dir, image_prefix + "*.fits"))
+        if self.watcher is not None:
+            self.watcher.close()
+        self.watcher = frame_watcher.FrameWatcher(data_dir,
+                                                  prefix=image_prefix)
         while datetime.datetime.utcnow() < end_time:
-            print("In the RC Guider Loop", start_time, end_time)
-            print("Looking in", os.path.join(data_dir, image_prefix + "*.fits"))
-            time.sleep(5)
-            images = sorted(glob.glob(os.path.join(data_dir,
-                                                   image_prefix + "*.fits")))
-            for img in images:
-                if img in already_processed_list:
-                    continue
-                base = os.path.basename(img)
-                obstime = base.replace(image_prefix, "").split(".")[0]
-                obstime_str = obstime
-                obstime = datetime.datetime.strptime(obstime, "%Y%m%d_%H_%M_%S")
+            img = self.watcher.get(timeout=1.0)
+            if img is None or img in already_processed_list:
+                continue
+            base = os.path.basename(img)
+            obstime = base.replace(image_prefix, "").split(".")[0]
+            obstime_str = obstime
+            obstime = datetime.datetime.strptime(obstime, "%Y%m%d_%H_%M_%S")
+
+            if start_time < obstime < end_time:
+
+                new_x = None
+                new_y = None
+
+                if not first_image:
+                    print("Checking if first image")
+                    df = self._get_catalog_positions(img)
+                    if df.empty:
+                        already_processed_list.add(img)
+                        continue
+                    first_image = img
+                    xpos = df['X_IMAGE'].values
+                    ypos = df['Y_IMAGE'].values
 
-                if start_time < obstime < end_time:
+                    data = fits.getdata(img)
+                    refined_points = centroid_sources(
+                        data, xpos, ypos, box_size=30,
+                        centroid_func=centroid_2dg)
 
-                    new_x = None
-                    new_y = None
+                    x_offset = (xpos - refined_points[0]) * -.394
+                    y_offset = (ypos - refined_points[1]) * -.394
 
-                    if not first_image:
-                        print("Checking if first image")
-                        df = self._get_catalog_positions(img)
-                        if df.empty:
-                            already_processed_list.append(img)
-                            continue
-                        first_image = img
-                        xpos = df['X_IMAGE'].values
-                        ypos = df['Y_IMAGE'].values
+                    indexes = self.detect_outlier(x_offset, y_offset,
+                                                  return_index=True)
 
-                        data = fits.getdata(img)
-                        refined_points = centroid_sources(
-                            data, xpos, ypos, box_size=30,
-                            centroid_func=centroid_2dg)
+                    if len(indexes) >= 1:
+                        print(indexes, 'more than 1')
+                        for index in sorted(indexes, reverse=True):
+                            new_x = np.delete(refined_points[0], index)
+                            new_y = np.delete(refined_points[1], index)
 
-                        x_offset = (xpos - refined_points[0]) * -.394
-                        y_offset = (ypos - refined_points[1]) * -.394
-
-                        indexes = self.detect_outlier(x_offset, y_offset,
-                                                      return_index=True)
+                        orgin_points = [new_x, new_y]
+                    else:
+                        orgin_points = refined_points
 
-                        if len(indexes) >= 1:
-                            print(indexes, 'more than 1')
-                            for index in sorted(indexes, reverse=True):
-                                new_x = np.delete(refined_points[0], index)
-                                new_y = np.delete(refined_points[1], index)
+                    # Check to make sure valid points
+                    bkg = np.mean(data)
 
-                            orgin_points = [new_x, new_y]
-                        else:
-                            orgin_points = refined_points
+                    for j in range(orgin_points[0].size):
+                        print(orgin_points[0][j], orgin_points[1][j])
+                        x_1 = int(orgin_points[0][j] - 10)
+                        x_2 = int(orgin_points[0][j] + 10)
+                        y_1 = int(orgin_points[1][j] - 10)
+                        y_2 = int(orgin_points[1][j] + 10)
 
-                        # Check to make sure valid points
-                        bkg = np.mean(data)
+                        bkg_star = np.mean(data[y_1:y_2, x_1:x_2])
 
-                        for j in range(orgin_points[0].size):
-                            print(orgin_points[0][j], orgin_points[1][j])
-                            x_1 = int(orgin_points[0][j] - 10)
-                            x_2 = int(orgin_points[0][j] + 10)
-                            y_1 = int(orgin_points[1][j] - 10)
-                            y_2 = int(orgin_points[1][j] + 10)
-
-                            bkg_star = np.mean(data[y_1:y_2, x_1:x_2])
-
-                            print(bkg, bkg_star, 'star')
-                            if bkg_star < bkg:
-                                print(orgin_points[0][j], orgin_points[1][j],
-                                      'bad_star')
-
-                        print(orgin_points, "Orgin points")
-                        if create_region_file:
-                            reg = open(img + '.reg', 'w')
-                            for i in range(orgin_points[0].size):
-                                reg.write("point(%s, %s)\n"
-                                          % (orgin_points[0][i],
-                                             orgin_points[1][i]))
-                            reg.close()
-                        already_processed_list.append(img)
-                        continue
-                    try:
-                        data2 = fits.getdata(img)
-                    except Exception as e:
-                        print(str(e))
-                        already_processed_list.append(img)
-                        continue
-                    new_points = centroid_sources(data2, orgin_points[0],
-                                                  orgin_points[1],
-                                                  centroid_func=centroid_2dg,
-                                                  box_size=30)
-
-                    # print(orgin_points[0], orgin_points[1], "Orgin")
-                    # print(new_points[0], new_points[1], "NEW")
+                        print(bkg, bkg_star, 'star')
+                        if bkg_star < bkg:
+                            print(orgin_points[0][j], orgin_points[1][j],
+                                  'bad_star')
 
+                    print(orgin_points, "Orgin points")
                     if create_region_file:
                         reg = open(img + '.reg', 'w')
-                        for i in range(new_points[0].size):
-                            reg.write("point(%s, %s)\n" % (new_points[0][i],
-                                                           new_points[1][i]))
+                        for i in range(orgin_points[0].size):
+                            reg.write("point(%s, %s)\n"
+                                      % (orgin_points[0][i],
+                                         orgin_points[1][i]))
                         reg.close()
-
-                    x_offset = (new_points[0] - orgin_points[0]) * -.394
-                    y_offset = (new_points[1] - orgin_points[1]) * -.394
-
-                    _ = self.detect_outlier(x_offset, y_offset)
-
-                    # x_offset = self._reject_outliers((new_points[0] -
-                    #                               orgin_points[0]) * -.394)
-                    # y_offset = self._reject_outliers((new_points[1] -
-                    #                               orgin_points[1]) * -.394)
-
-                    x_offset = round(np.mean(x_offset), 3)
-                    y_offset = round(np.mean(y_offset), 3)
-                    print(obstime_str, x_offset, y_offset)   
-                    already_processed_list.append(img)
-
-                    cmd = ""
-                    if .05 < abs(x_offset) < 2.0 and .05 < abs(y_offset) < 2.0:
+                    already_processed_list.add(img)
+                    continue
+                try:
+                    data2 = fits.getdata(img)
+                except Exception as e:
+                    print(str(e))
+                    already_processed_list.add(img)
+                    continue
+                new_points = centroid_sources(data2, orgin_points[0],
+                                              orgin_points[1],
+                                              centroid_func=centroid_2dg,
+                                              box_size=30)
+
+                # print(orgin_points[0], orgin_points[1], "Orgin")
+                # print(new_points[0], new_points[1], "NEW")
+
+                if create_region_file:
+                    reg = open(img + '.reg', 'w')
+                    for i in range(new_points[0].size):
+                        reg.write("point(%s, %s)\n" % (new_points[0][i],
+                                                       new_points[1][i]))
+                    reg.close()
+
+                x_offset = (new_points[0] - orgin_points[0]) * -.394
+                y_offset = (new_points[1] - orgin_points[1]) * -.394
+
+                _ = self.detect_outlier(x_offset, y_offset)
+
+                # x_offset = self._reject_outliers((new_points[0] -
+                #                               orgin_points[0]) * -.394)
+                # y_offset = self._reject_outliers((new_points[1] -
+                #                               orgin_points[1]) * -.394)
+
+                x_offset = round(np.mean(x_offset), 3)
+                y_offset = round(np.mean(y_offset), 3)
+                print(obstime_str, x_offset, y_offset)   
+                already_processed_list.add(img)
+
+                cmd = ""
+                if .05 < abs(x_offset) < 2.0 and .05 < abs(y_offset) < 2.0:
+                    cmd = "PT %s %s" % (x_offset, y_offset)
+                    print(self.ocs.tel_offset(x_offset, y_offset))
+                elif abs(x_offset) > .05 > abs(y_offset):
+                    cmd = "PT %s 0" % x_offset
+                    print(self.ocs.tel_offset(x_offset, 0))
+                elif abs(x_offset) < .05 < abs(y_offset):
+                    cmd = "PT 0 %s" % y_offset
+                    print(self.ocs.tel_offset(0, y_offset))
+                elif abs(x_offset) > 2.0 and abs(y_offset) > 2.0:
+                    print("Offsets too bigx")
+                    self.too_big_count += 1
+                    if self.too_big_count >= 2 and \
+                            abs(x_offset) < 5.5 and abs(y_offset) < 5.5:
                         cmd = "PT %s %s" % (x_offset, y_offset)
                         print(self.ocs.tel_offset(x_offset, y_offset))
-                    elif abs(x_offset) > .05 > abs(y_offset):
-                        cmd = "PT %s 0" % x_offset
-                        print(self.ocs.tel_offset(x_offset, 0))
-                    elif abs(x_offset) < .05 < abs(y_offset):
-                        cmd = "PT 0 %s" % y_offset
-                        print(self.ocs.tel_offset(0, y_offset))
-                    elif abs(x_offset) > 2.0 and abs(y_offset) > 2.0:
-                        print("Offsets too bigx")
-                        self.too_big_count += 1
-                        if self.too_big_count >= 2 and \
-                                abs(x_offset) < 5.5 and abs(y_offset) < 5.5:
-                            cmd = "PT %s %s" % (x_offset, y_offset)
-                            print(self.ocs.tel_offset(x_offset, y_offset))
-                        elif self.too_big_count >= 2:
-                            print("Recentering")
-                            cmd = "PT %s %s No offset" % (x_offset, y_offset)
-                            self.too_big_count = 0
-                            first_image = ""
+                    elif self.too_big_count >= 2:
+                        print("Recentering")
+                        cmd = "PT %s %s No offset" % (x_offset, y_offset)
+                        self.too_big_count = 0
+                        first_image = ""
 
-                    else:
-                        print("NO OFFSET NEEDED FOR IMAGES:", img)
-                        # self.socket.send(b"PT %s 0 \r" % (x_offset))
-                        # data = self.socket.recv(2048)
-                        # print(data)
-                    print(cmd, "cmd")
-                    log.write("%s,%s,%s\n" % (obstime_str,
-                                              round(np.median(x_offset), 3),
-                                              round(np.median(y_offset), 3)))
                 else:
-                    already_processed_list.append(img)
-                    continue
+                    print("NO OFFSET NEEDED FOR IMAGES:", img)
+                    # self.socket.send(b"PT %s 0 \r" % (x_offset))
+                    # data = self.socket.recv(2048)
+                    # print(data)
+                print(cmd, "cmd")
+                log.write("%s,%s,%s\n" % (obstime_str,
+                                          round(np.median(x_offset), 3),
+                                          round(np.median(y_offset), 3)))
+            else:
+                already_processed_list.add(img)
+                continue
+        self.watcher.close()
+        self.watcher = None
         print("Closing log file")
         log.close()
 
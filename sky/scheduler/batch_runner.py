@@ -0,0 +1,150 @@
+import csv
+import json
+import time
+import datetime
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from sky.scheduler.dbscheduler import Scheduler
+
+# Scheduler settings a variant may change besides the simulate_night
+# arguments
+SCHEDULER_SETTINGS = ('slew_bin', 'slew_low', 'slew_settle', 'slew_rates')
+
+# One offline scheduler and its target tables per worker process
+_worker = {}
+
+
+def _init_worker(snapshot, config):
+    _worker['scheduler'] = Scheduler(config=config, snapshot=snapshot)
+    _worker['targets'] = {}
+
+
+def _targets(sched, night, start_time):
+    """Target table for a night, shared by every variant of that night"""
+    if night not in _worker['targets']:
+        ret = sched.get_active_targets(
+            startdate=start_time.datetime.replace(hour=23, minute=59,
+                                                  second=59),
+            enddate=night, save_copy=False)
+        _worker['targets'][night] = sched.initialize_targets(
+            ret['data'], obstime=start_time)['data']
+    return _worker['targets'][night]
+
+
+def simulate(night, name, variant):
+    """
+    Simulate one night with one variant in a worker process
+
+    :param night: 'YYYY-MM-DD' date of the evening
+    :param name: variant name
+    :param variant: simulate_night arguments and SCHEDULER_SETTINGS
+    :return: dict with the night, variant and the simulation summary
+    """
+    start = time.time()
+    sched = _worker['scheduler']
+    times = sched.night_times(night)
+    start_time = times['evening_nautical']
+    end_time = times['morning_astronomical']
+
+    kwargs = dict(variant)
+    saved = {}
+    for key in SCHEDULER_SETTINGS:
+        if key in kwargs:
+            saved[key] = getattr(sched, key)
+            setattr(sched, key, kwargs.pop(key))
+    try:
+        ret = sched.simulate_night(
+            start_time=start_time, end_time=end_time,
+            target_list=_targets(sched, night, start_time).copy(),
+            return_type='json', **kwargs)
+    finally:
+        for key, value in saved.items():
+            setattr(sched, key, value)
+
+    if 'data' not in ret or not ret['data']:
+        return {'night': night, 'variant': name,
+                'elaptime': time.time() - start,
+                'error': ret.get('error', 'No targets')}
+    return {'night': night, 'variant': name,
+            'elaptime': time.time() - start,
+            'summary': ret['data']['summary'],
+            'schedule': ret['data']['schedule']}
+
+
+def run_batch(snapshot, nights, variants, processes=4,
+              config='schedulerconfig.json'):
+    """
+    Simulate every night with every variant on a pool of worker
+    processes, all against the same frozen queue
+
+    :param snapshot: sqlite or csv file from Scheduler.save_snapshot
+    :param nights: list of 'YYYY-MM-DD' evening dates
+    :param variants: dict of variant name to simulate_night arguments,
+                     e.g. {'am2': {'airmass': (1, 2.0)}, 'base': {}}
+    :param processes: number of worker processes
+    :param config: scheduler config file
+    :return: list of result dicts in (night, variant) order
+    """
+    jobs = [(night, name, variant) for night in nights
+            for name, variant in variants.items()]
+    with ProcessPoolExecutor(max_workers=processes,
+                             initializer=_init_worker,
+                             initargs=(snapshot, config)) as pool:
+        futures = [pool.submit(simulate, *job) for job in jobs]
+        results = []
+        for (night, name, _), future in zip(jobs, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({'night': night, 'variant': name,
+                                'error': str(e)})
+    return results
+
+
+def write_results(results, path):
+    """One csv row of summary metrics per night and variant"""
+    fields = ['night', 'variant', 'targets', 'open_shutter_fraction',
+              'mean_airmass', 'mean_slew', 'science_time', 'idle_time',
+              'shutter_time', 'error']
+    with open(path, 'w', newline='') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=fields,
+                                extrasaction='ignore')
+        writer.writeheader()
+        for r in results:
+            row = {'night': r['night'], 'variant': r['variant'],
+                   'error': r.get('error', '')}
+            row.update(r.get('summary', {}))
+            writer.writerow(row)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare scheduling policies on a frozen queue")
+    parser.add_argument('snapshot', help="sqlite or csv queue snapshot")
+    parser.add_argument('-n', '--nights', nargs='+',
+                        default=[datetime.date.today().isoformat()],
+                        help="evening dates, YYYY-MM-DD")
+    parser.add_argument('-v', '--variants', default=None,
+                        help="json file of {name: simulate_night args}")
+    parser.add_argument('-p', '--processes', type=int, default=4)
+    parser.add_argument('-o', '--output', default='batch_results.csv')
+    parser.add_argument('-s', '--save', action="store_true", default=False,
+                        help="write the snapshot from the database first")
+    args = parser.parse_args()
+
+    if args.save:
+        print(Scheduler(writers=False).save_snapshot(args.snapshot))
+    if args.variants:
+        with open(args.variants) as data_file:
+            variant_dict = json.load(data_file)
+    else:
+        variant_dict = {'default': {}}
+
+    t = time.time()
+    res = run_batch(args.snapshot, args.nights, variant_dict,
+                    processes=args.processes)
+    write_results(res, args.output)
+    for res_row in res:
+        print(res_row['night'], res_row['variant'],
+              res_row.get('summary', res_row.get('error')))
+    print("%d simulations in %.1fs" % (len(res), time.time() - t))
@@ -6,31 +6,55 @@ import numpy as np
 import pandas as pd
 import astroplan
 
-from astropy.coordinates import SkyCoord, EarthLocation, AltAz, get_moon
+from astropy.coordinates import SkyCoord, EarthLocation, AltAz, Longitude, \
+    FK5
 import astropy.units as u
 from astropy.io import fits
 import os
 import sys
 import psycopg2.extras
+import psycopg2.pool
 import psycopg2
 import time
+import threading
 from utils import obstimes
 from utils import sedmpy_import
 import sqlite3
 from sky.growth.marshal import Interface
 from sky.sextractor import run
+from sky.scheduler.night_grid import NightGrid
+from sky.scheduler.request_journal import open_journal
+from sky.scheduler.overhead_model import OverheadModel
+from sky.scheduler.night_simulator import NightSimulator
+from sky.scheduler.queue_snapshot import load_snapshot, save_snapshot
 import SEDM_robot_version as Version
 
 from astropy.time import Time, TimeDelta
 from astropy.utils.iers import conf
 conf.auto_max_age = None
 
+# Degrees of hour angle per day
+SIDEREAL_RATE = 360.98564736629
+
 
 # noinspection SqlNoDataSourceInspection
 class Scheduler:
     def __init__(self, config='schedulerconfig.json',
                  site_name='Palomar', obsdatetime=None,
-                 save_as="targets.json"):
+                 save_as="targets.json", snapshot=None, writers=True):
+        """
+
+        :param config:
+        :param site_name:
+        :param obsdatetime:
+        :param save_as:
+        :param snapshot: sqlite or csv file from save_snapshot, the
+                         requests are read from it instead of the database
+                         and nothing is written back (offline simulations)
+        :param writers: start the request journal writer and the marshal
+                        outbox sender, False for scripts that only read
+                        the queue
+        """
 
         self.scheduler_config_file = config
         with open(os.path.join(Version.CONFIG_DIR, config)) as data_file:
@@ -38,7 +62,9 @@ class Scheduler:
         self.path = self.params["standard_db"]
         self.target_dir = self.params["target_dir"]
         self.standard_dict = {}
-        self.standard_star_list = []
+        self.standard_names = []
+        self.standard_coords = None
+        self.standards_stamp = None
 
         self.site_name = site_name
         self.times = obstimes.ScheduleNight()
@@ -49,9 +75,66 @@ class Scheduler:
         self.obsdatetime = obsdatetime
         self.running_obs_time = None
         self.save_as = save_as
-        self.dbconn = psycopg2.connect(**self.params["dbconn"])
-        self.ph_db = sedmpy_import.dbconnect()
-        self.growth = Interface()
+        self.night_grid = None
+        self.grid_step = self.params.get('grid_step', 300)
+        self.target_cache = None
+        self.cache_enddate = None
+        self.last_sync = None
+        self.last_full_sync = 0
+        self.full_sync_interval = self.params.get('target_full_sync', 3600)
+        self.target_lock = threading.Lock()
+        # Target selection, simulations and the night grid are shared by
+        # the sky server's handler and look-ahead threads
+        self.scheduler_lock = threading.RLock()
+        self.target_version = 0
+        self.sync_boundary = set()
+        self.local_status = {}
+        self.prepared = {}
+        self.snapshot = None
+        if snapshot:
+            self.snapshot = load_snapshot(snapshot)
+            self.db_pool = None
+            self.journal = None
+            self.ph_db = None
+            self.growth = None
+        else:
+            self.db_pool = psycopg2.pool.ThreadedConnectionPool(
+                1, self.params.get('db_pool_size', 4),
+                **self.params["dbconn"])
+            self.journal = None
+            if writers:
+                self.journal = open_journal(
+                    self.params.get('request_journal',
+                                    os.path.join(self.target_dir,
+                                                 'request_journal.db')),
+                    self.db_pool,
+                    sequence=self.params.get('request_id_sequence',
+                                             'request_id_seq'))
+                # Status changes the database has not seen yet
+                self.local_status = self.journal.pending_status()
+            self.ph_db = sedmpy_import.dbconnect()
+            # Without writers marshal updates are sent as they are made
+            self.growth = Interface() if writers else \
+                Interface(outbox_file=None)
+        self.overheads = OverheadModel(
+            self.params.get('overhead_model',
+                            os.path.join(self.target_dir,
+                                         'overhead_model.json')),
+            self.params['rc_images_dir'],
+            nights=self.params.get('overhead_nights', 14))
+        self.overhead_refit = self.params.get('overhead_refit', 86400)
+        # Set by the sky server, which measures every guider frame
+        self.fwhm_index = None
+        # Last target marked ACTIVE, where the telescope is pointing
+        self.pointing = None
+        self.slew_rates = (self.params.get('slew_rate_ha', 1.0),
+                           self.params.get('slew_rate_dec', 1.0),
+                           self.params.get('dome_rate', 1.5))
+        self.slew_settle = self.params.get('slew_settle', 10)
+        self.slew_bin = self.params.get('slew_bin', 60)
+        # Let slews also reorder the low priority targets
+        self.slew_low = self.params.get('slew_low_priority', False)
+        self.refit_overheads()
         self.query = Template(
             "SELECT r.id AS req_id, r.object_id AS obj_id, \n"
             "r.user_id, r.marshal_id, r.exptime, r.maxairmass,\n"
@@ -104,33 +187,46 @@ class Scheduler:
 
     def __load_targets_from_db(self):
         """
-        Open the sqlite database of targets
-        pacfic
+        Load the sqlite database of standard stars, only when the file
+        has changed since the last load
 
         :return:
         """
-        print(self.path)
+        st = os.stat(self.path)
+        stamp = (st.st_mtime, st.st_size)
+        if stamp == self.standards_stamp:
+            return
+        print("Loading standards from %s" % self.path)
         conn = sqlite3.connect(self.path)
         cur = conn.cursor()
 
         results = cur.execute("SELECT * FROM standards")
         standards = results.fetchall()
+        conn.close()
+
+        standard_dict = {}
+        names = []
         for ss in standards:
-            name, ra, dec, exptime = ss[0].rstrip().encode(
-                'utf8'), ss[3], ss[4], ss[5]
+            name, ra, dec, exptime = ss[0].rstrip(), ss[3], ss[4], ss[5]
 
             if name.upper() == 'LB227':
                 continue
-            coords = SkyCoord(ra=ra, dec=dec, unit='deg')
-            obj = astroplan.FixedTarget(name=name, coord=coords)
-            self.standard_star_list.append(obj)
-            self.standard_dict[name] = {
+            names.append(name)
+            standard_dict[name] = {
                 'name': name,
                 'ra': ra,
                 'dec': dec,
                 'exptime': exptime
             }
 
+        self.standard_coords = SkyCoord(
+            ra=np.array([standard_dict[n]['ra'] for n in names], dtype=float),
+            dec=np.array([standard_dict[n]['dec'] for n in names],
+                         dtype=float), unit='deg')
+        self.standard_names = names
+        self.standard_dict = standard_dict
+        self.standards_stamp = stamp
+
     def get_standard(self, name=None, obsdate=None):
         """
         If the name is not given find the closest standard star to zenith
@@ -146,23 +242,22 @@ class Scheduler:
 
         if not name:
             name = 'zenith'
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
         print("Finding standard: %s" % name)
         if name.lower() == 'zenith':
-            sairmass = 100
-            for standard in self.standard_star_list:
-                print(standard)
-                airmass = self.obs_site_plan.altaz(obsdate, standard).secz
-
-                if sairmass > airmass > 0:
-                    target = standard
-                    sairmass = airmass
-                    name = target.name
-        if type(name) == str:
-            name = name.encode('UTF-8')
-        std = self.standard_dict[name]
-        std['name'] = std['name'].decode('utf-8')
+            # Highest standard, the one with the lowest airmass
+            alt = self.standard_coords.transform_to(
+                AltAz(obstime=Time(obsdate), location=self.site)).alt.deg
+            if not len(alt) or alt.max() <= 0:
+                return {'elaptime': time.time() - start,
+                        'error': 'No standard above the horizon'}
+            name = self.standard_names[int(np.argmax(alt))]
+        if name not in self.standard_dict:
+            return {'elaptime': time.time() - start,
+                    'error': 'Unknown standard %s' % name}
         return {'elaptime': time.time() - start,
-                'data': std}
+                'data': dict(self.standard_dict[name])}
 
     def _set_obs_seq(self, row):
         """
@@ -185,6 +280,11 @@ class Scheduler:
         rc_filter_list = ['r', 'g', 'i', 'u']
         ifu_exptime = 0
 
+        # Readout and slew overheads measured from past nights
+        ifu_overhead = self.overheads.exposure('ifu')
+        rc_overhead = self.overheads.exposure('rc')
+        setup = self.overheads.setup()
+
         # 1. First we extract the filter sequence
 
         seq = list(obs_seq_list)
@@ -207,20 +307,22 @@ class Scheduler:
         # and we should exit
 
         if not seq:
-            ifu_total = ifu_exptime
+            if ifu:
+                ifu_total = ifu_exptime + ifu_overhead
             obs_seq_dict = {
                 'ifu': ifu,
                 'ifu_exptime': ifu_exptime,
-                'ifu_total': ifu_total + 47,
+                'ifu_total': ifu_total,
                 'rc': rc,
                 'rc_obs_dict': None,
                 'rc_total': 0,
-                'total': abs(ifu_total + 47 + (rc_total * repeat))
+                'setup': setup,
+                'total': abs(setup + ifu_total + (rc_total * repeat))
             }
             return obs_seq_dict
 
         if ifu:
-            ifu_total = ifu_exptime
+            ifu_total = ifu_exptime + ifu_overhead
 
         # 4. If we are still here then we need to get the photometry sequence
         obs_order_list = []
@@ -242,7 +344,8 @@ class Scheduler:
                         obs_order_list.append(flt)
                         obs_exptime_list.append(str(flt_exptime))
                         obs_repeat_list.append(str(flt_repeat))
-                        rc_total += ((flt_exptime + 47) * flt_repeat)
+                        rc_total += ((flt_exptime + rc_overhead) *
+                                     flt_repeat)
             else:
                 continue
 
@@ -266,59 +369,184 @@ class Scheduler:
             'rc': rc,
             'rc_obs_dict': obs_dict,
             'rc_total': rc_total * repeat,
-            'total': abs(ifu_total + (rc_total * repeat))
+            'setup': setup,
+            'total': abs(setup + ifu_total + (rc_total * repeat))
         }
 
         return obs_seq_dict
 
-    def _set_fixed_targets(self, row):
+    def refit_overheads(self, force=False):
         """
-        Add a column of SkyCoords to pandas dataframe
-        :return:
-        """
-
-        return astroplan.FixedTarget(name=row['objname'],
-                                     coord=row['SkyCoords'])
+        Refit the overhead model in the background once it is older than
+        overhead_refit seconds
 
-    def _set_end_time(self, row):
-        return row['start_obs'] + TimeDelta(row['obs_seq']['total'],
-                                            format='sec')
-
-    def _set_start_altaz(self, row):
-        return row['SkyCoords'].transform_to(AltAz(obstime=row['start_obs'],
-                                                   location=self.site)).alt
-
-    def _set_end_altaz(self, row):
-        return row['SkyCoords'].transform_to(AltAz(obstime=row['end_obs'],
-                                                   location=self.site)).alt
-
-    def _set_start_airmass(self, row):
-        return row['SkyCoords'].transform_to(AltAz(obstime=row['start_obs'],
-                                                   location=self.site)).secz
-
-    def _set_end_airmass(self, row):
-        return row['SkyCoords'].transform_to(AltAz(obstime=row['end_obs'],
-                                                   location=self.site)).secz
-
-    def _set_start_ha(self, row):
-        return self.obs_site_plan.target_hour_angle(row['start_obs'],
-                                                    row['fixed_object'])
-
-    def _set_end_ha(self, row):
-        return self.obs_site_plan.target_hour_angle(row['end_obs'],
-                                                    row['fixed_object'])
+        :param force: refit now whatever its age
+        :return: True if a fit was started
+        """
+        if self.snapshot is not None or \
+                (not force and self.overheads.age() < self.overhead_refit):
+            return False
+        threading.Thread(target=self.overheads.fit, daemon=True).start()
+        return True
 
-    def _set_rise_time(self, row):
-        return self.obs_site_plan.target_rise_time(row['start_obs'],
-                                                   row['fixed_object'],
-                                                   horizon=15 * u.degree,
-                                                   which="next")
+    def get_night_grid(self, obstime=None):
+        """
+        Altitude grid for the night containing obstime, built the first
+        time it is needed each night
 
-    def _set_set_time(self, row):
-        return self.obs_site_plan.target_set_time(row['start_obs'],
-                                                  row['fixed_object'],
-                                                  horizon=15 * u.degree,
-                                                  which="next")
+        :param obstime: time that must be inside the grid
+        :return: NightGrid
+        """
+        if obstime is None:
+            obstime = datetime.datetime.utcnow()
+        jd = Time(obstime).jd
+
+        with self.scheduler_lock:
+            if self.night_grid is not None and self.night_grid.covers(jd):
+                return self.night_grid
+            return self._build_night_grid(obstime, jd)
+
+    def _build_night_grid(self, obstime, jd):
+        # Span the whole night with room for targets that run past dawn
+        start_time = self.obs_times['sun_set'] - TimeDelta(1800, format='sec')
+        end_time = self.obs_times['sun_rise'] + TimeDelta(7200, format='sec')
+        if not start_time.jd <= jd <= end_time.jd:
+            self.obs_times = self.times.get_observing_times_by_date()
+            start_time = self.obs_times['sun_set'] - \
+                TimeDelta(1800, format='sec')
+            end_time = self.obs_times['sun_rise'] + \
+                TimeDelta(7200, format='sec')
+        if not start_time.jd <= jd <= end_time.jd:
+            # Not tonight (e.g. simulating another date)
+            start_time = Time(obstime)
+            end_time = start_time + TimeDelta(16 * 3600, format='sec')
+
+        print("Building night grid %s to %s" % (start_time.iso, end_time.iso))
+        self.refit_overheads()
+        self.night_grid = NightGrid(self.obs_site_plan, start_time, end_time,
+                                    step=self.grid_step)
+        return self.night_grid
+
+    def _set_coords_batch(self, df, obstime):
+        """
+        Compute start/end altitude, airmass and hour angle for every row
+        of the target table, from the night grid when the times fall
+        inside it and otherwise with a single AltAz transform
+
+        :param df: target dataframe with ra, dec and obs_total columns
+        :param obstime: start time of the observation
+        :return: the same dataframe with the coordinate columns filled in,
+                 altitudes in degrees and hour angles in hours 0-24
+        """
+        if len(df) == 0:
+            return df
+
+        nrows = len(df)
+        totals = df['obs_total'].values.astype(float)
+        ra = df['ra'].values.astype(float)
+        dec = df['dec'].values.astype(float)
+
+        end_obs = Time(obstime) + TimeDelta(totals, format='sec')
+        grid = self.get_night_grid(obstime)
+        if grid.covers(end_obs.jd):
+            jd = np.concatenate([np.full(nrows, Time(obstime).jd),
+                                 end_obs.jd])
+            alt, secz, hour_angle = grid.lookup(np.tile(ra, 2),
+                                                np.tile(dec, 2), jd)
+            hour_angle = hour_angle / 15.
+        else:
+            # Outside the night grid, evaluate the start and end of every
+            # target in one transform
+            obstimes = Time(obstime) + TimeDelta(
+                np.concatenate([np.zeros(nrows), totals]), format='sec')
+            coords = SkyCoord(ra=np.tile(ra, 2), dec=np.tile(dec, 2),
+                              unit="deg")
+            altaz = coords.transform_to(AltAz(obstime=obstimes,
+                                              location=self.site))
+            alt = altaz.alt.deg
+            secz = np.asarray(altaz.secz)
+            lst = self.obs_site_plan.local_sidereal_time(obstimes)
+            hour_angle = Longitude(lst - coords.ra).hour
+
+        df['start_mjd'] = Time(obstime).mjd
+        df['end_mjd'] = end_obs.mjd
+        df['start_alt'] = alt[:nrows]
+        df['end_alt'] = alt[nrows:]
+        df['start_airmass'] = secz[:nrows]
+        df['end_airmass'] = secz[nrows:]
+        df['start_ha'] = hour_angle[:nrows]
+        df['end_ha'] = hour_angle[nrows:]
+
+        return df
+
+    def _rise_set_times(self, ra, dec, start_mjd, horizon=15.,
+                        start_alt=None):
+        """
+        Next rise and set through horizon after start_mjd for every
+        target, from the hour angle at which each one crosses that
+        altitude.  Agrees with astroplan's target_rise_time and
+        target_set_time (which="next") to within two minutes.  Nutation
+        and aberration are left out, which matters most for targets that
+        graze the horizon, whose altitude changes slowly.
+
+        :param ra: J2000 right ascensions in degrees
+        :param dec: J2000 declinations in degrees
+        :param start_mjd: search start, a scalar or one per target
+        :param horizon: apparent altitude in degrees
+        :param start_alt: altitudes at start_mjd from a full AltAz
+                          transform.  A target within the approximation of
+                          the horizon at the start is taken to be on the
+                          side these say, so it is not seen to rise (or
+                          set) again minutes after the start.
+        :return: (rise mjd, set mjd) arrays, NaN for targets that are
+                 always above or always below the horizon
+        """
+        ra = np.asarray(ra, dtype=float)
+        dec = np.asarray(dec, dtype=float)
+        start_mjd = np.broadcast_to(np.asarray(start_mjd, dtype=float),
+                                    ra.shape)
+        if not ra.size:
+            return np.empty(0), np.empty(0)
+
+        # Sidereal time refers to the equinox of date
+        times, inverse = np.unique(start_mjd, return_inverse=True)
+        coords = SkyCoord(ra=ra, dec=dec, unit="deg").transform_to(
+            FK5(equinox=Time(times.mean(), format='mjd')))
+        ra = coords.ra.deg
+        dec = np.deg2rad(coords.dec.deg)
+        lst = self.obs_site_plan.local_sidereal_time(
+            Time(times, format='mjd')).deg[inverse]
+
+        # Refraction lifts the target, find the true altitude that
+        # appears at the horizon
+        pressure = self.obs_site_plan.pressure
+        if pressure is not None and pressure.to_value(u.hPa) > 0:
+            temperature = self.obs_site_plan.temperature
+            temperature = 10. if temperature is None else \
+                temperature.to_value(u.deg_C, equivalencies=u.temperature())
+            refraction = pressure.to_value(u.hPa) / 1010. * \
+                283. / (273. + temperature) / \
+                np.tan(np.deg2rad(horizon + 7.31 / (horizon + 4.4))) / 60.
+            horizon = horizon - refraction
+
+        lat = np.deg2rad(self.site.lat.deg)
+        cos_ha = (np.sin(np.deg2rad(horizon)) - np.sin(lat) * np.sin(dec)) / \
+            (np.cos(lat) * np.cos(dec))
+        with np.errstate(invalid='ignore'):
+            crossing = np.rad2deg(np.arccos(cos_ha))
+
+        ha = lst - ra
+        rise = start_mjd + ((-crossing - ha) % 360.) / SIDEREAL_RATE
+        set_time = start_mjd + ((crossing - ha) % 360.) / SIDEREAL_RATE
+
+        if start_alt is not None:
+            # Up at the start if the next set comes before the next rise
+            above = np.asarray(start_alt, dtype=float) >= horizon
+            rise = np.where(above & (rise < set_time),
+                            rise + 360. / SIDEREAL_RATE, rise)
+            set_time = np.where(~above & (set_time < rise),
+                                set_time + 360. / SIDEREAL_RATE, set_time)
+        return rise, set_time
 
     def _convert_row_to_json(self, row, fields=('name', 'ra', 'dec',
                                                 'obj_id', 'req_id',
@@ -338,21 +566,32 @@ class Scheduler:
                     req_id=row.req_id, obj_id=row.obj_id,
                     obs_dict=row.obs_seq, marshal_id=row.marshal_id)
 
-    def simulate_night(self, start_time='', end_time='', do_focus=True,
-                       do_standard=True, target_list=None,
-                       return_type='html', sort_columns=('priority',
-                                                         'start_alt'),
-                       sort_order=(False, False), ):
+    def simulate_night(self, *args, **kwargs):
+        """Simulate the night, see _simulate_night"""
+        with self.scheduler_lock:
+            return self._simulate_night(*args, **kwargs)
+
+    def _simulate_night(self, start_time='', end_time='', do_focus=True,
+                        do_standard=True, target_list=None,
+                        return_type='html', sort_columns=('priority',
+                                                          'start_alt'),
+                        sort_order=(False, False), airmass=(1, 2.8),
+                        altitude_min=15, do_moon_sep=True):
         """
+        Simulate the rest of the night with the NightSimulator
 
         :param start_time:
         :param end_time:
         :param do_focus:
         :param do_standard:
         :param target_list:
-        :param return_type:
+        :param return_type: 'html' for the web page table, otherwise the
+                            structured result in 'data'
         :param sort_columns:
         :param sort_order:
+        :param airmass:
+        :param altitude_min:
+        :param do_moon_sep:
         :return:
         """
 
@@ -366,8 +605,6 @@ class Scheduler:
         if not end_time:
             end_time = self.obs_times['morning_astronomical']
 
-        self.running_obs_time = start_time
-
         if not isinstance(target_list, pd.DataFrame) and not target_list:
             print("sn: Making a new target list for night simulation")
             ret = self.get_active_targets()
@@ -376,15 +613,30 @@ class Scheduler:
             else:
                 return ret
 
-            target_list = self.initialize_targets(targets)['data']
+            target_list = self.initialize_targets(targets,
+                                                  obstime=start_time)['data']
 
         if len(target_list) == 0:
             return {'data': False, 'elaptime': time.time() - start}
 
-        # obsdatetime = self.running_obs_time
+        # 2. Go through the targets until we fill up the night
+        simulator = NightSimulator(self, target_list, airmass=airmass,
+                                   altitude_min=altitude_min,
+                                   do_moon_sep=do_moon_sep,
+                                   sort_columns=sort_columns,
+                                   sort_order=sort_order)
+        result = simulator.run(start_time, end_time, do_focus=do_focus,
+                               do_standard=do_standard)
+        print("sn: %d targets in %.1fs" % (result['summary']['targets'],
+                                           time.time() - start))
 
         if return_type == 'html':
-            html_str = """<table class='table'><tr><th>Expected Obs Time</th>
+            return self._simulation_html(result)
+        return {'elaptime': time.time() - start, 'data': result}
+
+    def _simulation_html(self, result):
+        """Web page table of a simulate_night result"""
+        html_str = """<table class='table'><tr><th>Expected Obs Time</th>
                               <th>Object Name</th>
                               <th>Priority</th>
                               <th>Project ID</th>
@@ -399,89 +651,220 @@ class Scheduler:
                               <th>Update Request</th>
                               <th>Priority 4+ reject<br>reasons</th>
                               </tr>"""
+        for e in result['schedule']:
+            if e['type'] != 'science':
+                if e['type'] == 'focus':
+                    continue
+                html_str += self.tr_row.substitute(
+                    {'allocation': "", 'obstime': e['start'],
+                     'objname': e['objname'], 'priority': "",
+                     'project': "Calib", 'ra': "", 'dec': "",
+                     'start_airmass': "", 'end_airmass': "", 'moon_dist': "",
+                     'ifu_exptime': int(e['duration']), 'rc_seq': "",
+                     'rc_exptime': "", 'total': int(e['duration']),
+                     'request_id': "NA", 'rejects': ""})
+                continue
+            html_str += self.tr_row.substitute(
+                {'allocation': e['allocation_id'], 'obstime': e['start'],
+                 'objname': e['objname'], 'priority': e['priority'],
+                 'project': e['program'], 'ra': "%.7f" % e['ra'],
+                 'dec': "%+.7f" % e['dec'],
+                 'start_airmass': "%.4f" % e['start_airmass'],
+                 'end_airmass': "%.4f" % e['end_airmass'],
+                 'moon_dist': "%.2f" % e['moon_dist'],
+                 'ifu_exptime': e['ifu_exptime'],
+                 'rc_seq': e['rc_seq'] or 'NA',
+                 'rc_exptime': e['rc_exptime'] or 'NA',
+                 'total': e['total'], 'request_id': e['req_id'],
+                 'rejects': ""})
+        html_str += "</table><br>Last Updated:%s UT" % \
+            datetime.datetime.utcnow()
+        return html_str
+
+    def save_snapshot(self, path, enddate=None):
+        """
+        Freeze the pending requests ending on or after enddate to a sqlite
+        or csv file for offline simulations, see Scheduler(snapshot=...)
+
+        :param path: file to write, csv if it ends in .csv
+        :param enddate: defaults to today
+        :return:
+        """
+        start = time.time()
+        if not enddate:
+            enddate = datetime.datetime.utcnow().strftime("%Y-%m-%d")
+        q = self.query.substitute(
+            where_statement="WHERE r.enddate >= $1 AND r.object_id > 100",
+            and_statement="AND r.status = 'PENDING'",
+            group_statement="", order_statement="")
+        df = self._read_sql(q, name='targets_full', params=(str(enddate),))
+        return {'elaptime': time.time() - start,
+                'data': save_snapshot(df, path)}
+
+    def close(self):
+        """Flush and stop the request journal and marshal outbox writers"""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.growth is not None:
+            self.growth.close()
+
+    def night_times(self, night):
+        """
+        Twilight times of the night starting on the evening of a date
+
+        :param night: 'YYYY-MM-DD' local date of the evening
+        :return: dict like obs_times
+        """
+        # 07:00 UT the next day is the middle of the Palomar night
+        midnight = Time(night) + TimeDelta(31 * 3600, format='sec')
+        return self.times.get_observing_times_by_date(midnight)
+
+    def _read_sql(self, sql, name=None, params=()):
+        """
+        Run a query on a pooled connection.  Named queries are prepared
+        once per connection and then executed with params ($1, $2, ...).
+
+        :param sql: query text
+        :param name: prepared statement name, None to run sql directly
+        :param params: values for the prepared statement
+        :return: DataFrame of the result
+        """
+        if name:
+            query = "EXECUTE %s" % name
+            if params:
+                query += " (%s)" % ', '.join(['%s'] * len(params))
         else:
-            html_str = ""
-
-        # 2. Get all targets
-        targets = target_list
-
-        # 3. Go through all the targets until we fill up the night
-        current_time = start_time
-
-        while current_time <= end_time:
-            targets = self.update_targets_coords(targets, current_time)['data']
-            targets = targets.sort_values(list(sort_columns),
-                                          ascending=list(sort_order))
-            print("sn: Using input datetime of", current_time.iso)
-            # Include focus time?
-            if do_focus:
-                current_time += TimeDelta(300, format='sec')
-                do_focus = False
-            if do_standard:
-                current_time += TimeDelta(300, format='sec')
-                do_standard = False
-
-            time_remaining = end_time - current_time
-
-            if time_remaining.sec <= 0:
-                break
+            query = sql
+
+        # A pooled connection may have been dropped by the server since it
+        # was last used, so a broken connection gets one more try
+        for attempt in range(2):
+            conn = self.db_pool.getconn()
+            ok = True
+            try:
+                conn.autocommit = True
+                prepared = self.prepared.setdefault(id(conn), set())
+                if name and name not in prepared:
+                    with conn.cursor() as cur:
+                        cur.execute("PREPARE %s AS %s" % (name, sql))
+                    prepared.add(name)
+                return pd.read_sql_query(query, conn, params=params or None)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                ok = False
+                if attempt:
+                    raise
+            except psycopg2.ProgrammingError as e:
+                # The statement went with a connection that was replaced
+                if e.pgcode != '26000' or attempt:
+                    raise
+                self.prepared.pop(id(conn), None)
+            finally:
+                if not ok:
+                    # Its prepared statements go with it
+                    self.prepared.pop(id(conn), None)
+                self.db_pool.putconn(conn, close=not ok)
+
+    @staticmethod
+    def _first_column(df, name):
+        """The request table has repeated names, use the first (request)"""
+        col = df[name]
+        if isinstance(col, pd.DataFrame):
+            col = col.iloc[:, 0]
+        return col
+
+    def _sync_targets(self, enddate):
+        """
+        Bring the cached request table up to date.  Only requests modified
+        since the last sync are fetched, with a periodic full reload to
+        catch deleted requests.
 
-            self.running_obs_time = current_time
-
-            z = self.get_next_observable_target(targets,
-                                                obsdatetime=current_time,
-                                                update_coords=False,
-                                                return_type=return_type,
-                                                do_sort=False)
-
-            # targets = self.remove_setting_targets(
-            #       targets, start_time=current_time, end_time=end_time)
-
-            idx, t = z
-
-            if not idx:
-                print("sn:", len(targets))
-                if return_type == 'html':
-                    html_str += self.tr_row.substitute(
-                        {
-                            'allocation': "",
-                            'obstime': current_time.iso,
-                            'objname': "Standard",
-                            'priority': "",
-                            'project': "Calib",
-                            'ra': "",
-                            'dec': "",
-                            'start_airmass': "",
-                            'end_airmass': "",
-                            'moon_dist': "",
-                            'ifu_exptime': 300,
-                            'rc_seq': "",
-                            'rc_exptime': "",
-                            'total': 300,
-                            'request_id': "NA",
-                            'rejects': ""
-                        }
-                    )
-                current_time += TimeDelta(300, format='sec')
-            else:
-                if return_type == 'html':
-                    html_str += t[1]
-                    t = t[0]
+        :param enddate: earliest request end date of interest
+        :return: list of req_ids fetched by an incremental sync
+        """
+        enddate = str(enddate)
+        full = (self.target_cache is None or self.last_sync is None or
+                enddate < self.cache_enddate or self.snapshot is not None or
+                time.time() - self.last_full_sync > self.full_sync_interval)
+
+        if full:
+            name = 'targets_full'
+            where_statement = "WHERE r.enddate >= $1 AND r.object_id > 100"
+            and_statement = "AND r.status = 'PENDING'"
+            value = enddate
+        else:
+            # >= so rows committed with the watermark time are not missed
+            name = 'targets_delta'
+            where_statement = ("WHERE r.lastmodified >= $1 "
+                               "AND r.object_id > 100")
+            and_statement = ""
+            value = str(self.last_sync)
 
-                targets = targets[targets.req_id != idx]
-                # Adding overhead
-                # current_time += TimeDelta(t['total']*1.2 + 120, format='sec')
-                current_time += TimeDelta(t['total'] + 60, format='sec')
+        q = self.query.substitute(where_statement=where_statement,
+                                  and_statement=and_statement,
+                                  group_statement="", order_statement="")
 
-        if return_type == 'html':
-            html_str += "</table><br>Last Updated:%s UT" % \
-                        datetime.datetime.utcnow()
-            return html_str
+        if self.snapshot is not None:
+            # Filtered on status and enddate below
+            df = self.snapshot
+        else:
+            df = self._read_sql(q, name=name, params=(value,))
+
+        if full:
+            cache = df
+            changed = []
+            self.cache_enddate = enddate
+            self.last_full_sync = time.time()
+        else:
+            # Rows at the watermark were already merged last time
+            seen = (df['lastmodified'] == self.last_sync) & \
+                df['req_id'].isin(self.sync_boundary)
+            changed = list(df['req_id'][~seen])
+            cache = self.target_cache[
+                ~self.target_cache['req_id'].isin(df['req_id'])]
+            cache = pd.concat([cache, df], ignore_index=True)
+
+        # Completed, canceled or expired requests leave the table
+        cache = cache[(cache['status'] == 'PENDING') &
+                      (pd.to_datetime(self._first_column(cache, 'enddate'))
+                       >= pd.Timestamp(enddate))]
+
+        # New or edited pending requests can change the next target,
+        # requests leaving the queue cannot change it unless chosen
+        if full or cache['req_id'].isin(changed).any():
+            self.target_version += 1
+
+        last_modified = df['lastmodified'].max()
+        if pd.notnull(last_modified):
+            self.last_sync = last_modified
+            self.sync_boundary = set(
+                df['req_id'][df['lastmodified'] == last_modified])
+        elif full:
+            self.last_sync = None
+            self.sync_boundary = set()
+
+        # Status changes the database has caught up with
+        for req_id, status in zip(df['req_id'], df['status']):
+            if self.local_status.get(req_id) == status:
+                del self.local_status[req_id]
+
+        print("Target sync (%s): %d fetched, %d cached" %
+              ('full' if full else 'incremental', len(df), len(cache)))
+        self.target_cache = cache
+        return changed
 
     def get_active_targets(self, startdate=None, enddate=None,
                            where_statement="", and_statement="",
                            group_statement="", order_statement="",
                            save_copy=True):
+        """
+        Pending requests active between startdate and enddate.  With the
+        default statements the result comes from a cached request table
+        that is synced incrementally on the request lastmodified column.
+
+        :return: dict with the request table in 'data' and the req_ids
+                 changed since the previous sync in 'updated'
+        """
 
         start = time.time()
 
@@ -498,6 +881,25 @@ class Scheduler:
             enddate = (datetime.datetime.utcnow() +
                        datetime.timedelta(days=1)).strftime("%Y-%m-%d")
 
+        if not (where_statement or and_statement or group_statement or
+                order_statement):
+            with self.target_lock:
+                updated = self._sync_targets(enddate)
+                df = self.target_cache
+                # Status changes still in the request journal
+                done = [req_id for req_id, status in self.local_status.items()
+                        if status != 'PENDING']
+            if done:
+                df = df[~df['req_id'].isin(done)]
+            df = df[pd.to_datetime(self._first_column(df, 'inidate')) <=
+                    pd.Timestamp(startdate)]
+
+            if save_copy:
+                df.to_csv(os.path.join(self.target_dir, self.save_as))
+
+            return {"data": df, "updated": updated,
+                    "elaptime": time.time() - start}
+
         if not where_statement:
             where_statement = ("WHERE r.enddate >= '%s' AND r.object_id > 100 "
                                "AND r.inidate <= '%s'" % (enddate, startdate))
@@ -510,9 +912,7 @@ class Scheduler:
                                   group_statement=group_statement,
                                   order_statement=order_statement)
 
-        self.dbconn = psycopg2.connect(**self.params["dbconn"])
-
-        df = pd.read_sql_query(q, self.dbconn)
+        df = self._read_sql(q)
 
         if save_copy:
             df.to_csv(os.path.join(self.target_dir, self.save_as))
@@ -520,53 +920,44 @@ class Scheduler:
         return {"data": df, "elaptime": time.time() - start}
 
     def initialize_targets(self, target_df_in, obstime=''):
+        """
+        Set up the target table.  Coordinates, times and constraint values
+        are kept as float columns (ra/dec in degrees, times as MJD, hour
+        angles in hours), astropy objects are made only where needed.
+
+        :param target_df_in: requests from get_active_targets
+        :param obstime: time to compute the coordinates for
+        :return:
+        """
         start = time.time()
         # filter out all non-fixed typedesig objects
-        target_df = target_df_in[target_df_in['typedesig'] == 'f']
+        target_df = target_df_in[target_df_in['typedesig'] == 'f'].copy()
+        target_df['ra'] = target_df['ra'].astype(float)
+        target_df['dec'] = target_df['dec'].astype(float)
 
-        target_df['SkyCoords'] = False
-        target_df['SkyCoords'] = SkyCoord(ra=target_df['ra'],
-                                          dec=target_df['dec'],
-                                          unit="deg")
-        target_df['start_obs'] = False
         if not obstime:
             obstime = datetime.datetime.utcnow()
 
-        target_df['start_obs'] = Time(obstime)
-
         target_df['obs_seq'] = target_df.apply(self._set_obs_seq, axis=1)
-        target_df['end_obs'] = target_df.apply(self._set_end_time, axis=1)
-        target_df['start_alt'] = target_df.apply(self._set_start_altaz,
-                                                 axis=1)
-        target_df['end_alt'] = target_df.apply(self._set_end_altaz, axis=1)
-        target_df['fixed_object'] = target_df.apply(self._set_fixed_targets,
-                                                    axis=1)
-        target_df['start_ha'] = target_df.apply(self._set_start_ha, axis=1)
-        target_df['end_ha'] = target_df.apply(self._set_end_ha, axis=1)
-        target_df['start_airmass'] = target_df.apply(self._set_start_airmass,
-                                                     axis=1)
-        target_df['end_airmass'] = target_df.apply(self._set_end_airmass,
-                                                   axis=1)
-        target_df['rise_time'] = target_df.apply(self._set_rise_time, axis=1)
-        target_df['set_time'] = target_df.apply(self._set_set_time, axis=1)
+        target_df['obs_total'] = np.array(
+            [seq['total'] for seq in target_df['obs_seq']], dtype=float)
+        target_df = self._set_coords_batch(target_df, obstime)
+        if len(target_df):
+            target_df['rise_time'], target_df['set_time'] = \
+                self._rise_set_times(target_df['ra'].values,
+                                     target_df['dec'].values,
+                                     target_df['start_mjd'].values,
+                                     start_alt=target_df['start_alt'].values)
 
         return {'data': target_df, 'elaptime': time.time() - start}
 
     def update_targets_coords(self, df, obstime=None):
         start = time.time()
-        df['start_obs'] = False
 
         if not obstime:
             obstime = datetime.datetime.utcnow()
 
-        df['start_obs'] = Time(obstime)
-        df['end_obs'] = df.apply(self._set_end_time, axis=1)
-        df['start_alt'] = df.apply(self._set_start_altaz, axis=1)
-        df['end_alt'] = df.apply(self._set_end_altaz, axis=1)
-        df['start_ha'] = df.apply(self._set_start_ha, axis=1)
-        df['end_ha'] = df.apply(self._set_end_ha, axis=1)
-        df['start_airmass'] = df.apply(self._set_start_airmass, axis=1)
-        df['end_airmass'] = df.apply(self._set_end_airmass, axis=1)
+        df = self._set_coords_batch(df, obstime)
         return {'data': df, 'elaptime': time.time() - start}
 
     def look_for_new_targets(self, df, startdate=None, enddate=None,
@@ -592,6 +983,13 @@ class Scheduler:
 
         dropped_targets = (list(set(df[field]) - set(new_df[field])))
 
+        # Requests edited since the last sync are dropped and set up again
+        updated = list(set(ret.get('updated', [])) & set(df[field]) &
+                       set(new_df[field]))
+        if len(updated) >= 1:
+            df = df[-df[field].isin(updated)]
+            new_targets += updated
+
         if len(new_targets) >= 1:
             new_df = new_df[new_df['req_id'].isin(new_targets)]
             ret = self.initialize_targets(new_df)
@@ -604,18 +1002,173 @@ class Scheduler:
 
         return {'data': df, 'elaptime': time.time() - start}
 
-    def get_next_observable_target(self, target_list=None, obsdatetime=None,
-                                   airmass=(1, 2.8), moon_sep=(5, 180),
-                                   altitude_min=15, ha=(18.75, 5.75),
-                                   return_type='', do_airmass=True,
-                                   do_sort=True, do_moon_sep=True,
-                                   do_fwhm=False,
-                                   sort_columns=('priority', 'set_time'),
-                                   sort_order=(False, False), save=False,
-                                   save_as='',
-                                   check_end_of_night=True, update_coords=True):
+    def _check_constraints(self, targets, obsdatetime, airmass=(1, 2.8),
+                           altitude_min=15, do_airmass=True,
+                           min_moon_sep=None, resolution=360.):
+        """
+        Evaluate the observing constraints of every target at once on a
+        time grid spanning each target's observation, the same test
+        astroplan.is_observable makes one target at a time
+
+        :param targets: target dataframe
+        :param obsdatetime: Time the observations would start
+        :param airmass: (min, max) airmass, a target's maxairmass wins
+        :param altitude_min: minimum altitude in degrees
+        :param do_airmass: apply the airmass constraint
+        :param min_moon_sep: minimum moon distance in degrees, None to skip
+        :param resolution: time grid resolution in seconds
+        :return: dict of boolean arrays, one per constraint ('Alt', 'Air',
+                 'Moon') true if it alone is met at some time, and
+                 'observable' true if all are met at the same time
+        """
+        totals = targets['obs_total'].values.astype(float)
+        ra = targets['ra'].values.astype(float)
+        dec = targets['dec'].values.astype(float)
+
+        # Sample start, start + resolution, ... up to the end of each
+        # observation, always including the start
+        offsets = np.arange(max(np.ceil(totals.max() / resolution), 1)) * \
+            resolution
+        valid = offsets[None, :] < totals[:, None]
+        valid[:, 0] = True
+        jd = obsdatetime.jd + np.broadcast_to(offsets / 86400., valid.shape)
+
+        grid = self.get_night_grid(obsdatetime)
+        alt, secz, _ = grid.lookup(ra, dec, jd)
+
+        checks = {'Alt': alt >= altitude_min}
+        if do_airmass:
+            max_airmass = pd.to_numeric(targets['maxairmass'],
+                                        errors='coerce').values
+            max_airmass = np.where(np.isnan(max_airmass), airmass[1],
+                                   max_airmass)
+            checks['Air'] = (airmass[0] <= secz) & \
+                (secz <= max_airmass[:, None])
+        if min_moon_sep is not None:
+            checks['Moon'] = grid.moon_separation(
+                ra[:, None], dec[:, None], jd) >= min_moon_sep
+
+        allowed = valid.copy()
+        for ok in checks.values():
+            allowed &= ok
+        ret = {con: (ok & valid).any(axis=1) for con, ok in checks.items()}
+        ret['observable'] = allowed.any(axis=1)
+        return ret
+
+    @staticmethod
+    def _azimuth(ha, dec, lat):
+        """Azimuth in degrees east of north from hour angle and dec"""
+        ha = np.deg2rad(ha)
+        dec = np.deg2rad(dec)
+        lat = np.deg2rad(lat)
+        az = np.arctan2(np.sin(ha), np.cos(ha) * np.sin(lat) -
+                        np.tan(dec) * np.cos(lat))
+        return (np.rad2deg(az) + 180.) % 360.
+
+    def estimate_slew(self, ra, dec, obsdatetime, pointing=None):
+        """
+        Time to move the telescope and the dome from the current pointing
+        to each target.  The axes and the dome move at the same time so
+        the slowest one sets the time.
+
+        :param ra: array of right ascensions in degrees
+        :param dec: array of declinations in degrees
+        :param obsdatetime: time of the slew
+        :param pointing: (ra, dec) in degrees, defaults to the last target
+                         marked ACTIVE
+        :return: array of seconds or None if the pointing is not known
+        """
+        if pointing is None:
+            pointing = self.pointing
+        if pointing is None:
+            return None
+        obsdatetime = Time(obsdatetime)
+        lst = self.get_night_grid(obsdatetime).lst_at(obsdatetime.jd)
+        ra = np.asarray(ra, dtype=float)
+        dec = np.asarray(dec, dtype=float)
+        p_ra, p_dec = float(pointing[0]), float(pointing[1])
+
+        # Hour angles in -180..180, the mount does not wrap through 12h
+        ha = (lst - ra + 180.) % 360. - 180.
+        p_ha = (lst - p_ra + 180.) % 360. - 180.
+        lat = self.site.lat.deg
+        d_az = (self._azimuth(ha, dec, lat) -
+                self._azimuth(p_ha, p_dec, lat) + 180.) % 360. - 180.
+
+        ha_rate, dec_rate, dome_rate = self.slew_rates
+        telescope = np.maximum(np.abs(ha - p_ha) / ha_rate,
+                               np.abs(dec - p_dec) / dec_rate)
+        return np.maximum(telescope, np.abs(d_az) / dome_rate) + \
+            self.slew_settle
+
+    def _min_moon_sep(self, obsdatetime):
+        """Minimum moon distance in degrees for the moon phase"""
+        moon_illum = float(
+            self.obs_site_plan.moon_illumination(obsdatetime)) * 100.
+        if moon_illum > 75.:
+            return 5.0 + (moon_illum - 75.)
+        # TODO: adjust minimum based on phase of moon
+        return 5.0
+
+    def _rank_order(self, priority, s_ha, slew):
+        """
+        Order to try the targets in, given in their sorted order.  High
+        priority (> 2) targets keep that order except that within one
+        priority level shorter slews (in slew_bin second steps) go first.
+        The rest follow sorted on start hour angle, setting first.  With
+        slew_low set they go by priority instead, then in slew steps
+        shortest first, setting first within a step.
+
+        :param priority: array of priorities
+        :param s_ha: array of start hour angles in hours
+        :param slew: array of slew times in seconds
+        :return: array of indices
+        """
+        if self.slew_bin:
+            slew_bin = np.floor(slew / self.slew_bin)
+        else:
+            slew_bin = np.zeros(len(priority))
+
+        # We are into the low priority objects after the high priority
+        # ones, just sort those on HA
+        high = np.flatnonzero(priority > 2)
+        low = np.flatnonzero(priority <= 2)
+        level = np.cumsum(np.diff(priority[high],
+                                  prepend=priority[high][:1]) != 0)
+        high = high[np.lexsort((np.arange(len(high)), slew_bin[high],
+                                level))]
+        if self.slew_low:
+            low = low[np.lexsort((np.arange(len(low)), -s_ha[low],
+                                  slew_bin[low], -priority[low]))]
+        else:
+            low = low[np.argsort(-s_ha[low], kind='stable')]
+        return np.concatenate([high, low]).astype(int)
+
+    def get_next_observable_target(self, *args, **kwargs):
+        """
+        Best target to observe next, see _get_next_observable_target.
+        One caller at a time, the look-ahead runs beside the handlers.
+        """
+        with self.scheduler_lock:
+            return self._get_next_observable_target(*args, **kwargs)
+
+    def _get_next_observable_target(self, target_list=None,
+                                    obsdatetime=None, airmass=(1, 2.8),
+                                    moon_sep=(5, 180), altitude_min=15,
+                                    ha=(18.75, 5.75), return_type='',
+                                    do_airmass=True, do_sort=True,
+                                    do_moon_sep=True, do_fwhm=False,
+                                    sort_columns=('priority', 'set_time'),
+                                    sort_order=(False, False), save=False,
+                                    save_as='', check_end_of_night=True,
+                                    update_coords=True, pointing=None):
         """
 
+        :param pointing: (ra, dec) of the telescope in degrees, defaults to
+                         the last target marked ACTIVE.  Within a high
+                         priority level targets are ranked by slew time
+                         from here, slews within slew_bin seconds of each
+                         other keep the usual order, see _rank_order.
         :return:
         """
         if check_end_of_night:
@@ -659,182 +1212,160 @@ class Scheduler:
         if do_sort:
             target_list = target_list.sort_values(list(sort_columns),
                                                   ascending=list(sort_order))
+        # Only 'fixed' targets can be scheduled
+        target_list = target_list[target_list['typedesig'] == 'f']
         rej_html = ""
-        target_reorder = False
-        # print(target_list['typedesig'])
-
-        # loop over target list
-        for row in target_list.itertuples():
-
-            # starting time of observation
-            start = obsdatetime
-            # add all requested exposures and overheads
-            finish = start + TimeDelta(row.obs_seq['total'],
-                                       format='sec')
-            # We are now into the low priority objects, so just sort on HA
-            if row.priority <= 2 and not target_reorder:
-                # print(target_list.keys())
-                target_list = target_list.sort_values('start_ha',
-                                                      ascending=False)
-                target_reorder = True
+
+        # Requested moon distance constraint, the illumination is the same
+        # for every target
+        min_moon_sep = None
+        if do_moon_sep and len(target_list):
+            min_moon_sep = self._min_moon_sep(obsdatetime)
+            print("gnot: min moon sep = %.2f" % min_moon_sep)
+
+        if len(target_list):
+            checks = self._check_constraints(target_list, obsdatetime,
+                                             airmass=airmass,
+                                             altitude_min=altitude_min,
+                                             do_airmass=do_airmass,
+                                             min_moon_sep=min_moon_sep)
+            s_ha = target_list['start_ha'].values.astype(float)
+            e_ha = target_list['end_ha'].values.astype(float)
+            priority = target_list['priority'].values.astype(float)
+
+            slew = self.estimate_slew(target_list['ra'].values,
+                                      target_list['dec'].values,
+                                      obsdatetime, pointing=pointing)
+            if slew is None:
+                slew = np.zeros(len(target_list))
+            order = self._rank_order(priority, s_ha, slew)
+            rows = list(target_list.itertuples())
+        else:
+            order = []
+
+        cur_fwhm = None
+        # loop over target list, all the constraints are already evaluated
+        for i in order:
+            row = rows[i]
+            print("gnot:", row.objname)
+
+            # Are we observable within given constraints?
+            if not checks['observable'][i]:
+                print("gnot: Not observable, priority = %d" % row.priority)
+                if row.priority >= 4:
+                    num = []
+                    reas = []
+                    for count, con in enumerate(cons):
+                        if con in checks and not checks[con][i]:
+                            num.append(str(count))
+                            reas.append(con)
+                            print("gnot:", False, con)
+                    if return_type == 'html' and len(num) >= 1:
+                        rej_html += """%s: %s<br>""" % (row.objname,
+                                                        ','.join(reas))
+                    elif return_type == 'json' and len(num) >= 1:
+                        rej_html += ','.join(num)
+                sys.stdout.flush()
                 continue
 
-            # Must have altitude constraint
-            constraint = [astroplan.AltitudeConstraint(
-                min=altitude_min * u.deg)]
-            # Requested airmass constraint
-            if do_airmass:
-                if row.maxairmass is not None:
-                    maxairmass = row.maxairmass
-                else:
-                    maxairmass = airmass[1]
-                constraint.append(astroplan.AirmassConstraint(min=airmass[0],
-                                                              max=maxairmass))
-            # Requested moon distance constraint
-            if do_moon_sep:
-                moon_illum = float(
-                    self.obs_site_plan.moon_illumination(start)) * 100.
-                if moon_illum > 75.:
-                    min_moon_sep = 5.0 + (moon_illum - 75.)
-                else:
-                    min_moon_sep = 5.0
-                print("gnot: min moon sep = %.2f" % min_moon_sep)
-                # TODO: adjust minimum based on phase of moon
-                constraint.append(astroplan.MoonSeparationConstraint(
-                    min=min_moon_sep * u.degree))
-
-            # Are we a 'fixed' target?
-            if row.typedesig == 'f':
-                print("gnot:", row.objname)
-                # Are we observable within given constraints?
-                if astroplan.is_observable(constraint, self.obs_site_plan,
-                                           row.fixed_object,
-                                           times=[start, finish],
-                                           time_grid_resolution=0.1 * u.hour):
-
-                    s_ha = float(row.start_ha.to_string(unit=u.hour,
-                                                        decimal=True))
-                    e_ha = float(row.end_ha.to_string(unit=u.hour,
-                                                      decimal=True))
-                    s_air = float(row.start_airmass)
-                    e_air = float(row.end_airmass)
-                    if s_ha > 12.:
-                        s_ha_ew = -(24. - s_ha)
-                    else:
-                        s_ha_ew = s_ha
-
-                    if e_ha > 12.:
-                        e_ha_ew = -(24. - e_ha)
-                    else:
-                        e_ha_ew = e_ha
-
-                    # Skip targets that start or end outside HA range
-                    if 18.75 > s_ha > 5.25:
-                        print("gnot: HA start outside range: %.4f" % s_ha_ew)
-                        continue
-                    if 18.75 > e_ha > 5.25:
-                        print("gnot: HA end outside range: %.4f" % e_ha_ew)
-                        continue
-                    # Skip extreme airmass at either end
-                    if s_air > 3.5:
-                        print("gnot: Airmass start outside range: %.3f" % s_air)
-                        continue
-                    if e_air > 3.5:
-                        print("gnot: Airmass end outside range: %.3f" % e_air)
-                        continue
-                    if do_fwhm:
-                        # Skip target if curr FWHM more that max FWHM requested
-                        cur_fwhm = self.get_recent_fwhm()
-                        if cur_fwhm['data'] != -1 and \
-                                cur_fwhm['data'] > max(5, row.max_fwhm):
-                            print("gnot: Current FWHM (%.3f) > Requested FWHM "
-                                  "(%.3f)" % (cur_fwhm['data'], row.max_fwhm))
-                            continue
-
-                    # Here is our target!
-                    moon_coords = get_moon(obsdatetime,
-                                           location=self.obs_site_plan.location)
-                    tc = row.SkyCoords
-                    moon_dist = moon_coords.separation(tc).deg
-                    print("gnot: %s %.1f %.6f %.6f %.3f %.3f %.2f %s %s " %
-                          (row.objname, row.priority, row.ra, row.dec,
-                           row.start_airmass, row.end_airmass, moon_dist,
-                           row.start_ha, row.end_ha), row.start_obs)
-                    if return_type == 'html':
-                        if row.obs_seq['rc']:
-                            rc_seq = row.obs_seq['rc_obs_dict']['obs_order'],
-                            rc_exptime = row.obs_seq['rc_obs_dict'][
-                                             'obs_exptime'],
-                        else:
-                            rc_seq = 'NA'
-                            rc_exptime = 'NA'
-
-                        html = self.tr_row.substitute(
-                            {'allocation': row.allocation_id,
-                             'obstime': start.iso,
-                             'objname': row.objname,
-                             'priority': row.priority,
-                             'project': row.designator,
-                             'ra': "%.7f" % row.ra,
-                             'dec': "%+.7f" % row.dec,
-                             'start_airmass': "%.4f" % row.start_airmass,
-                             'end_airmass': "%.4f" % row.end_airmass,
-                             'moon_dist': "%.2f" % moon_dist,
-                             'ifu_exptime': row.obs_seq['ifu_exptime'],
-                             'rc_seq': rc_seq,
-                             'rc_exptime': rc_exptime,
-                             'total': row.obs_seq['total'],
-                             'request_id': row.req_id,
-                             'rejects': rej_html}
-                        )
-                        return row.req_id, (row.obs_seq, html)
-                    elif return_type == 'json':
-                        targ = self._convert_row_to_json(row)
-
-                        if save:
-                            if not save_as:
-                                save_as = os.path.join(
-                                    self.target_dir,
-                                    "next_target_%s.json" %
-                                    datetime.datetime.utcnow().strftime(
-                                        "%Y%m%d_%H_%M_%S"))
-
-                            with open(save_as, 'w') as outfile:
-                                outfile.write(json.dumps(targ))
-
-                        return {"elaptime": time.time() - st, "data": targ}
-                    else:
-                        return row.req_id, row.obs_seq
+            s_air = float(row.start_airmass)
+            e_air = float(row.end_airmass)
+            s_ha_ew = s_ha[i] - 24. if s_ha[i] > 12. else s_ha[i]
+            e_ha_ew = e_ha[i] - 24. if e_ha[i] > 12. else e_ha[i]
+
+            # Skip targets that start or end outside HA range
+            if 18.75 > s_ha[i] > 5.25:
+                print("gnot: HA start outside range: %.4f" % s_ha_ew)
+                continue
+            if 18.75 > e_ha[i] > 5.25:
+                print("gnot: HA end outside range: %.4f" % e_ha_ew)
+                continue
+            # Skip extreme airmass at either end
+            if s_air > 3.5:
+                print("gnot: Airmass start outside range: %.3f" % s_air)
+                continue
+            if e_air > 3.5:
+                print("gnot: Airmass end outside range: %.3f" % e_air)
+                continue
+            if do_fwhm:
+                # Skip target if curr FWHM more that max FWHM requested
+                if cur_fwhm is None:
+                    cur_fwhm = self.get_recent_fwhm()
+                if cur_fwhm['data'] != -1 and \
+                        cur_fwhm['data'] > max(5, row.max_fwhm):
+                    print("gnot: Current FWHM (%.3f) > Requested FWHM "
+                          "(%.3f)" % (cur_fwhm['data'], row.max_fwhm))
+                    continue
+
+            # Here is our target!
+            moon_dist = float(self.get_night_grid(obsdatetime).moon_separation(
+                row.ra, row.dec, obsdatetime.jd))
+            print("gnot: %s %.1f %.6f %.6f %.3f %.3f %.2f %.3f %.3f %.0fs " %
+                  (row.objname, row.priority, row.ra, row.dec,
+                   row.start_airmass, row.end_airmass, moon_dist,
+                   row.start_ha, row.end_ha, slew[i]),
+                  Time(row.start_mjd, format='mjd').iso)
+            if return_type == 'html':
+                if row.obs_seq['rc']:
+                    rc_seq = row.obs_seq['rc_obs_dict']['obs_order'],
+                    rc_exptime = row.obs_seq['rc_obs_dict'][
+                                     'obs_exptime'],
                 else:
-                    print("gnot: Not observable, priority = %d" % row.priority)
-                    if row.priority >= 4:
-                        count = 1
-                        num = []
-                        reas = []
-                        for con in constraint:
-                            ret = astroplan.is_observable(
-                                [con], self.obs_site_plan,
-                                row.fixed_object, times=[start, finish],
-                                time_grid_resolution=0.1 * u.hour)
-                            # print(ret, con)
-                            if not ret:
-                                num.append(str(count))
-                                reas.append(cons[count])
-                                print("gnot:", ret, cons[count])
-                            count += 1
-                        if return_type == 'html' and len(num) >= 1:
-                            rej_html += """%s: %s<br>""" % (row.objname,
-                                                            ','.join(reas))
-                        elif return_type == 'json' and len(num) >= 1:
-                            rej_html += ','.join(num)
-            sys.stdout.flush()
+                    rc_seq = 'NA'
+                    rc_exptime = 'NA'
+
+                html = self.tr_row.substitute(
+                    {'allocation': row.allocation_id,
+                     'obstime': obsdatetime.iso,
+                     'objname': row.objname,
+                     'priority': row.priority,
+                     'project': row.designator,
+                     'ra': "%.7f" % row.ra,
+                     'dec': "%+.7f" % row.dec,
+                     'start_airmass': "%.4f" % row.start_airmass,
+                     'end_airmass': "%.4f" % row.end_airmass,
+                     'moon_dist': "%.2f" % moon_dist,
+                     'ifu_exptime': row.obs_seq['ifu_exptime'],
+                     'rc_seq': rc_seq,
+                     'rc_exptime': rc_exptime,
+                     'total': row.obs_seq['total'],
+                     'request_id': row.req_id,
+                     'rejects': rej_html}
+                )
+                return row.req_id, (row.obs_seq, html)
+            elif return_type == 'json':
+                targ = self._convert_row_to_json(row)
+
+                if save:
+                    if not save_as:
+                        save_as = os.path.join(
+                            self.target_dir,
+                            "next_target_%s.json" %
+                            datetime.datetime.utcnow().strftime(
+                                "%Y%m%d_%H_%M_%S"))
+
+                    with open(save_as, 'w') as outfile:
+                        outfile.write(json.dumps(targ))
+
+                return {"elaptime": time.time() - st, "data": targ}
+            else:
+                return row.req_id, row.obs_seq
 
         if return_type == 'json':
             return {"elaptime": time.time() - st, "error": "No targets found"}
         return False, False
 
     def get_recent_fwhm(self):
+        """
+        Mean FWHM of the recent guider frames, from the sky server's
+        FWHM index when it runs, otherwise measured now
+
+        :return: {'elaptime':, 'data': fwhm in arcsec or -1}
+        """
         start = time.time()
+        if self.fwhm_index is not None:
+            return {"elaptime": time.time() - start,
+                    "data": self.fwhm_index.recent()}
         extractor = run.sextractor()
         rcfiles = sorted(
             glob.glob(os.path.join(self.params['rc_images_dir'], "%s/rc*.fits" %
@@ -1019,6 +1550,22 @@ class Scheduler:
                 print(message)
                 return object_id
 
+    def _add_request(self, request_dict):
+        """
+        Queue a new request in the journal and return its id without
+        waiting for the database.  Falls back to a direct insert when no
+        id can be reserved.
+
+        :param request_dict: request column values
+        :return: request id
+        """
+        request_id = None
+        if self.journal:
+            request_id = self.journal.add_request(request_dict)
+        if request_id is None:
+            request_id = self.ph_db.add_request(request_dict)[0]
+        return request_id
+
     def get_manual_request_id(self, name="", typedesig="f", ra=None, dec=None,
                               epoch=2000., magnitude=None, exptime=180,
                               allocation_id="", obs_seq='{1ifu}'):
@@ -1088,7 +1635,7 @@ class Scheduler:
             'seq_repeats': '1',
             'seq_completed': '0'
         }
-        request_id = self.ph_db.add_request(request_dict)[0]
+        request_id = self._add_request(request_dict)
         return {
             'elaptime': time.time() - start,
             'data': {'object_id': object_id, 'request_id': request_id,
@@ -1129,7 +1676,7 @@ class Scheduler:
                         'max_cloud_cover': '1',
                         'seq_repeats': '1',
                         'seq_completed': '0'}
-        request_id = self.ph_db.add_request(request_dict)[0]
+        request_id = self._add_request(request_dict)
         return {'elaptime': time.time() - start,
                 'data': {'object_id': object_id, 'request_id': request_id}}
 
@@ -1171,7 +1718,7 @@ class Scheduler:
                         'seq_repeats': '1',
                         'seq_completed': '0'}
 
-        ret_id = self.ph_db.add_request(request_dict)[0]
+        ret_id = self._add_request(request_dict)
 
         return {'elaptime': time.time() - start, 'data': ret_id}
 
@@ -1185,17 +1732,28 @@ class Scheduler:
         :return:
         """
         start = time.time()
-        ret = self.ph_db.update_request({'id': request_id,
-                                         'status': status})
-        print("ph_db.update_request status:\n%s" % str(ret))
+        if self.journal is None:
+            return {'elaptime': time.time()-start,
+                    'error': "Scheduler started without the request journal"}
+        # Written to the database in the background, in order with the
+        # request inserts
+        self.journal.update_request(request_id, status)
+        with self.target_lock:
+            self.local_status[int(request_id)] = status
+            # The robot marks a target ACTIVE as it starts on it
+            if status == 'ACTIVE' and self.target_cache is not None:
+                active = self.target_cache[
+                    self.target_cache['req_id'] == int(request_id)]
+                if len(active):
+                    self.pointing = (float(active['ra'].iloc[0]),
+                                     float(active['dec'].iloc[0]))
+        print("request_journal: %s -> %s queued" % (request_id, status))
         if check_growth:
-            ret = self.growth.get_marshal_id_from_dbhost(request_id)
+            # The marshal id is looked up when the outbox is sent
+            ret = self.growth.update_growth_status(request_id=request_id,
+                                                   message=status)
             print(ret)
-            if 'data' in ret:
-                ret = self.growth.update_growth_status(growth_id=ret['data'],
-                                                       message=status)
-                print(ret)
-            else:
+            if 'error' in ret:
                 return {'elaptime': time.time()-start,
                         'data': "No growth presence"}
         return {'elaptime': time.time()-start, 'data': "DB updated"}
@@ -1204,7 +1762,7 @@ class Scheduler:
 if __name__ == "__main__":
     # scheduler_path = '/scr2/sedm/sedmpy/web/static/scheduler/scheduler.html'
     s = time.time()
-    sched = Scheduler()
+    sched = Scheduler(writers=False)
     scheduler_path = sched.params['scheduler_path']
     scheduler_logdir = sched.params['scheduler_logdir']
     # print(x.get_next_observable_target(return_type='json', do_moon_sep=False))
@@ -0,0 +1,150 @@
+import threading
+import numpy as np
+from astropy.coordinates import SkyCoord, AltAz, get_moon
+from astropy.time import Time, TimeDelta
+
+
+class NightGrid:
+    """
+    Altitude and sidereal time of the scheduler targets sampled on a fixed
+    time grid covering one night.
+
+    The expensive astropy transforms are done once per target when it is
+    added, after that altitude, airmass and hour angle at any time inside
+    the night are answered by linear interpolation.
+    """
+
+    def __init__(self, observer, start_time, end_time, step=300):
+        """
+
+        :param observer: astroplan.Observer for the site
+        :param start_time: first grid time
+        :param end_time: last grid time
+        :param step: grid spacing in seconds
+        """
+        self.observer = observer
+        self.step = step
+        start_time = Time(start_time)
+        end_time = Time(end_time)
+        nsteps = max(2, int(np.ceil((end_time - start_time).sec / step)) + 1)
+        self.times = start_time + TimeDelta(np.arange(nsteps) * step,
+                                            format='sec')
+        self.jd = self.times.jd
+        self.step_jd = step / 86400.
+
+        # Sidereal time does not depend on the target, unwrap it so it can
+        # be interpolated across 0h
+        lst = observer.local_sidereal_time(self.times).deg
+        self.lst = np.rad2deg(np.unwrap(np.deg2rad(lst)))
+
+        moon = get_moon(self.times, location=observer.location)
+        self.moon_ra = np.rad2deg(np.unwrap(moon.ra.rad))
+        self.moon_dec = moon.dec.deg
+
+        self.keys = {}
+        self.alt = np.empty((0, nsteps))
+        # Row numbers are handed out and filled under one lock
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def _key(ra, dec):
+        return round(float(ra), 6), round(float(dec), 6)
+
+    def covers(self, jd):
+        """True if every time in jd lies inside the grid"""
+        jd = np.asarray(jd)
+        return bool(jd.size) and self.jd[0] <= jd.min() and \
+            jd.max() <= self.jd[-1]
+
+    def add_targets(self, ra, dec):
+        """
+        Sample the altitude of any targets not yet in the grid
+
+        :param ra: array of right ascensions in degrees
+        :param dec: array of declinations in degrees
+        :return: number of targets added
+        """
+        with self.lock:
+            return self._add_targets(ra, dec)
+
+    def _add_targets(self, ra, dec):
+        new = []
+        seen = set()
+        for r, d in zip(ra, dec):
+            key = self._key(r, d)
+            if key not in self.keys and key not in seen:
+                seen.add(key)
+                new.append(key)
+        if not new:
+            return 0
+
+        nsteps = len(self.jd)
+        new_ra, new_dec = np.array(new).T
+        coords = SkyCoord(ra=np.repeat(new_ra, nsteps),
+                          dec=np.repeat(new_dec, nsteps), unit="deg")
+        obstimes = self.times[np.tile(np.arange(nsteps), len(new))]
+        altaz = coords.transform_to(AltAz(obstime=obstimes,
+                                          location=self.observer.location))
+        first = self.alt.shape[0]
+        self.alt = np.vstack([self.alt,
+                              altaz.alt.deg.reshape(len(new), nsteps)])
+        # Only now the rows exist
+        for i, key in enumerate(new):
+            self.keys[key] = first + i
+        return len(new)
+
+    def lookup(self, ra, dec, jd):
+        """
+        Interpolated altitude, airmass and hour angle
+
+        :param ra: array of right ascensions in degrees
+        :param dec: array of declinations in degrees
+        :param jd: julian dates, a scalar, one per target or a 2D array
+                   with one row of times per target
+        :return: (alt in degrees, airmass, hour angle in degrees 0-360)
+                 shaped like jd broadcast against the targets
+        """
+        ra = np.asarray(ra, dtype=float)
+        with self.lock:
+            self.add_targets(ra, dec)
+            rows = np.array([self.keys[self._key(r, d)]
+                             for r, d in zip(ra, dec)], dtype=int)
+            table = self.alt
+        jd = np.asarray(jd, dtype=float)
+        extra = (1,) * max(jd.ndim - 1, 0)
+        rows = rows.reshape(rows.shape + extra)
+        ra = ra.reshape(ra.shape + extra)
+        jd = np.broadcast_to(jd, np.broadcast(ra, jd).shape)
+
+        pos = (jd - self.jd[0]) / self.step_jd
+        idx = np.clip(np.floor(pos).astype(int), 0, len(self.jd) - 2)
+        frac = pos - idx
+        alt = table[rows, idx] * (1 - frac) + table[rows, idx + 1] * frac
+
+        # Same definition as AltAz.secz
+        with np.errstate(divide='ignore'):
+            airmass = 1. / np.sin(np.deg2rad(alt))
+        hour_angle = (np.interp(jd, self.jd, self.lst) - ra) % 360.
+        return alt, airmass, hour_angle
+
+    def lst_at(self, jd):
+        """Interpolated local sidereal time in degrees 0-360"""
+        return np.interp(jd, self.jd, self.lst) % 360.
+
+    def moon_separation(self, ra, dec, jd):
+        """
+        Interpolated angular distance to the moon
+
+        :param ra: right ascensions in degrees
+        :param dec: declinations in degrees
+        :param jd: julian dates, broadcast against ra and dec
+        :return: separation in degrees
+        """
+        moon_ra = np.deg2rad(np.interp(jd, self.jd, self.moon_ra))
+        moon_dec = np.deg2rad(np.interp(jd, self.jd, self.moon_dec))
+        ra = np.deg2rad(ra)
+        dec = np.deg2rad(dec)
+        # Haversine form, well behaved at small separations
+        hav = np.sin((dec - moon_dec) / 2) ** 2 + np.cos(dec) * \
+            np.cos(moon_dec) * np.sin((ra - moon_ra) / 2) ** 2
+        return np.rad2deg(2 * np.arcsin(np.sqrt(np.clip(hav, 0, 1))))
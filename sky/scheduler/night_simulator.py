@@ -0,0 +1,237 @@
+import numpy as np
+import pandas as pd
+from astropy.time import Time
+
+# Sort columns that change with time, the rest come from the target table
+TIME_COLUMNS = ('start_alt', 'end_alt', 'start_airmass', 'end_airmass',
+                'start_ha', 'end_ha')
+
+
+def shutter_time(obs_seq):
+    """Seconds of open shutter in an obs_seq dict"""
+    total = float(obs_seq['ifu_exptime']) if obs_seq['ifu'] else 0.
+    rc = obs_seq.get('rc_obs_dict')
+    if obs_seq['rc'] and rc:
+        exptimes = [float(e) for e in str(rc['obs_exptime']).split(',')]
+        repeats = [int(r) for r in str(rc['obs_repeat_filter']).split(',')]
+        total += int(rc['obs_repeat_seq']) * sum(
+            e * r for e, r in zip(exptimes, repeats))
+    return total
+
+
+class NightSimulator:
+    """
+    Event driven simulation of one night of the queue.
+
+    The clock jumps from the start of one observation straight to its
+    end: exposures and readouts, plus the slew and acquisition from the
+    previous target.  Altitudes, hour angles and moon distances come from
+    the scheduler's night grid and the targets are chosen with the same
+    constraints and ranking as Scheduler.get_next_observable_target, so
+    each step is a handful of array operations.
+    """
+
+    def __init__(self, scheduler, targets, airmass=(1, 2.8),
+                 altitude_min=15, do_moon_sep=True,
+                 sort_columns=('priority', 'start_alt'),
+                 sort_order=(False, False), idle_step=300, calib_time=300):
+        """
+
+        :param scheduler: Scheduler whose constraints and ranking are used
+        :param targets: target table from Scheduler.initialize_targets
+        :param airmass: (min, max) airmass, a target's maxairmass wins
+        :param altitude_min: minimum altitude in degrees
+        :param do_moon_sep: apply the moon distance constraint
+        :param sort_columns: columns the targets are sorted on each step
+        :param sort_order: True for ascending, one per sort column
+        :param idle_step: seconds spent on a standard when nothing is
+                          observable
+        :param calib_time: seconds for the focus and the first standard
+        """
+        self.scheduler = scheduler
+        self.targets = targets[targets['typedesig'] == 'f'].reset_index(
+            drop=True)
+        self.airmass = airmass
+        self.altitude_min = altitude_min
+        self.do_moon_sep = do_moon_sep
+        self.sort_columns = list(sort_columns)
+        self.sort_order = list(sort_order)
+        self.idle_step = idle_step
+        self.calib_time = calib_time
+
+        self.ra = self.targets['ra'].values.astype(float)
+        self.dec = self.targets['dec'].values.astype(float)
+        self.priority = self.targets['priority'].values.astype(float)
+        self.totals = self.targets['obs_total'].values.astype(float)
+        self.setup = np.array([seq.get('setup', 0.)
+                               for seq in self.targets['obs_seq']],
+                              dtype=float)
+        # The request query repeats these names
+        self.obj_id = scheduler._first_column(self.targets, 'obj_id').values
+        self.allocation_id = scheduler._first_column(
+            self.targets, 'allocation_id').values
+
+    def _sort(self, idx, coords):
+        """Positions of idx in the order of sort_columns"""
+        keys = [np.arange(len(idx))]
+        for col, ascending in zip(reversed(self.sort_columns),
+                                  reversed(self.sort_order)):
+            values = coords[col] if col in TIME_COLUMNS else \
+                self.targets[col].values[idx]
+            keys.append(pd.Series(values).rank(
+                method='min', ascending=ascending,
+                na_option='bottom').values)
+        return np.lexsort(keys)
+
+    def _step(self, mjd, remaining, pointing):
+        """
+        Best target to start at mjd
+
+        :return: (target index, dict of its values at mjd) or None
+        """
+        sched = self.scheduler
+        idx = np.flatnonzero(remaining)
+        obstime = Time(mjd, format='mjd')
+        grid = sched.get_night_grid(obstime)
+
+        jd = np.stack([np.full(len(idx), obstime.jd),
+                       obstime.jd + self.totals[idx] / 86400.], axis=1)
+        alt, secz, ha = grid.lookup(self.ra[idx], self.dec[idx], jd)
+        coords = {'start_alt': alt[:, 0], 'end_alt': alt[:, 1],
+                  'start_airmass': secz[:, 0], 'end_airmass': secz[:, 1],
+                  'start_ha': ha[:, 0] / 15., 'end_ha': ha[:, 1] / 15.}
+
+        min_moon_sep = sched._min_moon_sep(obstime) if self.do_moon_sep \
+            else None
+        checks = sched._check_constraints(
+            self.targets.iloc[idx], obstime, airmass=self.airmass,
+            altitude_min=self.altitude_min, min_moon_sep=min_moon_sep)
+
+        # The hour angle and extreme airmass limits of the target loop
+        s_ha, e_ha = coords['start_ha'], coords['end_ha']
+        ok = checks['observable'] & \
+            ~((18.75 > s_ha) & (s_ha > 5.25)) & \
+            ~((18.75 > e_ha) & (e_ha > 5.25)) & \
+            (coords['start_airmass'] <= 3.5) & (coords['end_airmass'] <= 3.5)
+        if not ok.any():
+            return None
+
+        # Not the live telescope pointing before the first target
+        if pointing is None:
+            slew = np.zeros(len(idx))
+        else:
+            slew = sched.estimate_slew(self.ra[idx], self.dec[idx], obstime,
+                                       pointing=pointing)
+        base = self._sort(idx, coords)
+        order = base[sched._rank_order(self.priority[idx][base], s_ha[base],
+                                       slew[base])]
+        best = order[ok[order]][0]
+
+        values = {k: float(v[best]) for k, v in coords.items()}
+        values['slew'] = float(slew[best])
+        values['moon_dist'] = float(grid.moon_separation(
+            self.ra[idx][best], self.dec[idx][best], obstime.jd))
+        return idx[best], values
+
+    @staticmethod
+    def _calib(name, mjd, duration, kind=None):
+        return {'type': kind or name.lower(), 'objname': name,
+                'start': Time(mjd, format='mjd').iso,
+                'end': Time(mjd + duration / 86400., format='mjd').iso,
+                'duration': float(duration), 'shutter': 0.}
+
+    def run(self, start_time, end_time, do_focus=True, do_standard=True):
+        """
+        Fill the night from start_time to end_time
+
+        :return: dict with the 'schedule', a list of one dict per
+                 observation in time order, and a 'summary' of it
+        """
+        start = Time(start_time).mjd
+        end = Time(end_time).mjd
+        mjd = start
+        schedule = []
+        for name, wanted in (('Focus', do_focus), ('Standard', do_standard)):
+            if wanted:
+                schedule.append(self._calib(name, mjd, self.calib_time))
+                mjd += self.calib_time / 86400.
+
+        remaining = np.ones(len(self.targets), dtype=bool)
+        pointing = None
+        while mjd < end and remaining.any():
+            pick = self._step(mjd, remaining, pointing)
+            if pick is None:
+                # Nothing is up, the robot does a standard
+                schedule.append(self._calib('Standard', mjd, self.idle_step,
+                                            kind='idle'))
+                mjd += self.idle_step / 86400.
+                continue
+
+            i, values = pick
+            row = self.targets.iloc[i]
+            obs_seq = row['obs_seq']
+            rc = obs_seq['rc_obs_dict'] if obs_seq['rc'] else None
+            # The fitted setup is a typical slew and acquisition, only a
+            # longer slew costs extra
+            duration = self.totals[i] - self.setup[i] + \
+                max(self.setup[i], values['slew'])
+            entry = {
+                'type': 'science',
+                'req_id': int(row['req_id']),
+                'obj_id': int(self.obj_id[i]),
+                'objname': row['objname'],
+                'priority': float(row['priority']),
+                'program': row['designator'],
+                'allocation_id': int(self.allocation_id[i]),
+                'ra': float(self.ra[i]),
+                'dec': float(self.dec[i]),
+                'start': Time(mjd, format='mjd').iso,
+                'end': Time(mjd + duration / 86400., format='mjd').iso,
+                'duration': float(duration),
+                'shutter': shutter_time(obs_seq),
+                'ifu_exptime': int(obs_seq['ifu_exptime']),
+                'rc_seq': rc['obs_order'] if rc else '',
+                'rc_exptime': rc['obs_exptime'] if rc else '',
+                'total': float(self.totals[i])
+            }
+            entry.update(values)
+            schedule.append(entry)
+
+            remaining[i] = False
+            pointing = (self.ra[i], self.dec[i])
+            mjd += duration / 86400.
+
+        return {'start': Time(start, format='mjd').iso,
+                'end': Time(end, format='mjd').iso,
+                'schedule': schedule,
+                'summary': self.summary(schedule, (end - start) * 86400.)}
+
+    @staticmethod
+    def summary(schedule, night_length):
+        """
+        Figures of merit of a simulated night
+
+        :param schedule: list of observations from run
+        :param night_length: seconds from the start to the end of the night
+        :return: dict
+        """
+        science = [e for e in schedule if e['type'] == 'science']
+        shutter = sum(e['shutter'] for e in science)
+        airmass = [(e['start_airmass'] + e['end_airmass']) / 2.
+                   for e in science]
+        priorities = {}
+        for e in science:
+            priorities[e['priority']] = priorities.get(e['priority'], 0) + 1
+        return {
+            'targets': len(science),
+            'science_time': sum(e['duration'] for e in science),
+            'idle_time': sum(e['duration'] for e in schedule
+                             if e['type'] == 'idle'),
+            'shutter_time': shutter,
+            'open_shutter_fraction': shutter / night_length
+            if night_length > 0 else 0.,
+            'mean_airmass': float(np.mean(airmass)) if airmass else None,
+            'mean_slew': float(np.mean([e['slew'] for e in science]))
+            if science else None,
+            'priorities': priorities
+        }
@@ -0,0 +1,217 @@
+import os
+import glob
+import json
+import time
+import datetime
+import threading
+import numpy as np
+from astropy.io import fits
+
+# Values used until enough archived frames have been seen
+DEFAULT_EXPOSURE = 47.
+DEFAULT_SETUP = 60.
+
+# Frames that belong to an observation of a request
+SCIENCE_TYPES = ('science', 'standard')
+
+
+class OverheadModel:
+    """
+    Observing overheads measured from the headers of archived frames.
+
+    The per exposure overhead is ELAPTIME - EXPTIME, the time spent
+    reading out and writing the frame, grouped by camera and readout
+    speed.  The per target setup is the time from the end of the last
+    frame of one request to the start of the first science frame of the
+    next one, which covers the slew, acquisition and settling.  Both are
+    medians over the last few nights so a night of bad weather or a
+    restart does not skew them.
+    """
+
+    def __init__(self, model_file, image_dir, nights=14, min_samples=5,
+                 max_setup=900):
+        """
+
+        :param model_file: json file the fitted values are kept in
+        :param image_dir: directory holding one YYYYMMDD directory per night
+        :param nights: number of past nights to fit
+        :param min_samples: frames needed before a fitted value is used
+        :param max_setup: longer gaps between requests are idle time and
+                          are left out of the setup fit
+        """
+        self.model_file = model_file
+        self.image_dir = image_dir
+        self.nights = nights
+        self.min_samples = min_samples
+        self.max_setup = max_setup
+        self.lock = threading.Lock()
+        self.model = {}
+
+        if os.path.exists(model_file):
+            try:
+                with open(model_file) as data_file:
+                    self.model = json.load(data_file)
+            except ValueError as e:
+                print("overhead_model: unable to read %s: %s" %
+                      (model_file, str(e)))
+
+    @staticmethod
+    def _key(camera, readout=None):
+        if readout is None:
+            return camera
+        return "%s_%.1f" % (camera, float(readout))
+
+    def _fitted(self, group, key):
+        value = self.model.get(group, {}).get(key)
+        if value and value['n'] >= self.min_samples:
+            return value['median']
+        return None
+
+    def exposure(self, camera, readout=None, default=DEFAULT_EXPOSURE):
+        """
+        Seconds added to the exposure time of every frame
+
+        :param camera: 'rc' or 'ifu'
+        :param readout: readout speed in MHz, None for the science frames
+                        of the camera at whatever speed they were taken
+        :param default: value used when there is no fit
+        :return:
+        """
+        value = self._fitted('exposure', self._key(camera, readout))
+        return default if value is None else value
+
+    def setup(self, default=DEFAULT_SETUP):
+        """Seconds from the end of one request to the start of the next"""
+        value = self._fitted('setup', 'target')
+        return default if value is None else value
+
+    def age(self):
+        """Seconds since the model was last fitted"""
+        if 'fitted' not in self.model:
+            return float('inf')
+        return time.time() - self.model['fitted']
+
+    def to_dict(self):
+        """
+        Fitted values with enough samples behind them, in the form sent
+        to the robot
+
+        :return: {'fitted': unix time, 'exposure': {'rc_2.0': seconds, ...},
+                  'setup': seconds or None}
+        """
+        exposure = {}
+        for key in self.model.get('exposure', {}):
+            value = self._fitted('exposure', key)
+            if value is not None:
+                exposure[key] = value
+        return {'fitted': self.model.get('fitted'),
+                'exposure': exposure,
+                'setup': self._fitted('setup', 'target')}
+
+    def _read_frames(self, night_dir):
+        frames = []
+        for f in glob.glob(os.path.join(night_dir, '*.fits')):
+            name = os.path.basename(f)
+            if name.startswith('rc'):
+                camera = 'rc'
+            elif name.startswith('ifu'):
+                camera = 'ifu'
+            else:
+                continue
+            try:
+                hdr = fits.getheader(f)
+                frames.append({
+                    'camera': camera,
+                    'jd': float(hdr['JD']),
+                    'elaptime': float(hdr['ELAPTIME']),
+                    'exptime': float(hdr['EXPTIME']),
+                    'readout': float(hdr.get('ADCSPEED', -1)),
+                    'imgtype': str(hdr.get('IMGTYPE', '')).lower(),
+                    'req_id': hdr.get('REQ_ID', -999)})
+            except (OSError, KeyError, TypeError, ValueError):
+                continue
+        return sorted(frames, key=lambda x: x['jd'])
+
+    def _setup_times(self, frames):
+        """Gaps between consecutive requests within one night"""
+        gaps = []
+        last_end = None
+        last_req = None
+        current = None
+        for frame in frames:
+            end = frame['jd'] + frame['elaptime'] / 86400.
+            if frame['req_id'] != last_req:
+                current = last_end
+            if current is not None and frame['imgtype'] in SCIENCE_TYPES:
+                gap = (frame['jd'] - current) * 86400.
+                if 0 < gap <= self.max_setup:
+                    gaps.append(gap)
+                current = None
+            last_req = frame['req_id']
+            last_end = end
+        return gaps
+
+    def fit(self, end_date=None):
+        """
+        Fit the overheads to the frames of the nights before end_date and
+        save them
+
+        :param end_date: datetime of the last night, defaults to today
+        :return: the fitted model
+        """
+        if not self.lock.acquire(blocking=False):
+            return self.model
+        try:
+            start = time.time()
+            end_date = end_date or datetime.datetime.utcnow()
+            exposure = {}
+            setup = []
+            nights = []
+            for i in range(self.nights):
+                night = (end_date - datetime.timedelta(days=i)).strftime(
+                    '%Y%m%d')
+                night_dir = os.path.join(self.image_dir, night)
+                if not os.path.isdir(night_dir):
+                    continue
+                frames = self._read_frames(night_dir)
+                if not frames:
+                    continue
+                nights.append(night)
+                setup += self._setup_times(frames)
+                for frame in frames:
+                    overhead = frame['elaptime'] - frame['exptime']
+                    if not 0 <= overhead <= 600:
+                        continue
+                    keys = [self._key(frame['camera'], frame['readout'])]
+                    if frame['imgtype'] in SCIENCE_TYPES:
+                        keys.append(frame['camera'])
+                    for key in keys:
+                        exposure.setdefault(key, []).append(overhead)
+
+            model = {
+                'fitted': time.time(),
+                'nights': nights,
+                'exposure': {k: {'median': float(np.median(v)), 'n': len(v)}
+                             for k, v in exposure.items()},
+                'setup': {}
+            }
+            if setup:
+                model['setup']['target'] = {'median': float(np.median(setup)),
+                                            'n': len(setup)}
+            self.model = model
+
+            with open(self.model_file, 'w') as outfile:
+                json.dump(model, outfile, indent=1)
+            print("overhead_model: fitted %d nights in %.1fs: %s" %
+                  (len(nights), time.time() - start, model['exposure']))
+            return model
+        finally:
+            self.lock.release()
+
+
+if __name__ == "__main__":
+    import sys
+    m = OverheadModel('/tmp/overheads.json',
+                      sys.argv[1] if len(sys.argv) > 1 else '/home/sedm/images')
+    print(m.fit())
+    print(m.exposure('rc'), m.exposure('ifu'), m.setup())
@@ -0,0 +1,81 @@
+import json
+import decimal
+import datetime
+import sqlite3
+import pandas as pd
+
+TABLE = 'requests'
+
+
+def _plain(value):
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def _encode(value):
+    if isinstance(value, (list, tuple)):
+        return json.dumps(_plain(value), default=str)
+    return _plain(value)
+
+
+def _decode(value):
+    if isinstance(value, str) and value.startswith('['):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+
+def save_snapshot(df, path):
+    """
+    Freeze the scheduler request table to a sqlite or csv file so the
+    scheduler can run against it without the database.  Repeated column
+    names keep the first, as the scheduler does.
+
+    :param df: request table from the scheduler's target query
+    :param path: file to write, csv if it ends in .csv, sqlite otherwise
+    :return: number of requests saved
+    """
+    df = df.loc[:, ~df.columns.duplicated()].copy()
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = [_encode(v) for v in df[col]]
+
+    if path.endswith('.csv'):
+        df.to_csv(path, index=False)
+    else:
+        conn = sqlite3.connect(path)
+        try:
+            df.to_sql(TABLE, conn, if_exists='replace', index=False)
+        finally:
+            conn.close()
+    return len(df)
+
+
+def load_snapshot(path):
+    """
+    Read a request table written by save_snapshot
+
+    :param path: csv or sqlite file
+    :return: DataFrame shaped like the target query result
+    """
+    if path.endswith('.csv'):
+        df = pd.read_csv(path)
+    else:
+        conn = sqlite3.connect(path)
+        try:
+            df = pd.read_sql("SELECT * FROM %s" % TABLE, conn)
+        finally:
+            conn.close()
+
+    # Array columns such as obs_seq and exptime were stored as json
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = [_decode(v) for v in df[col]]
+    return df
@@ -0,0 +1,370 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import weakref
+import psycopg2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reserved_ids (
+    id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS dead_letter (
+    seq INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL,
+    failed REAL NOT NULL,
+    error TEXT
+);
+"""
+
+# Columns of the request dicts built by the scheduler
+REQUEST_COLUMNS = ('object_id', 'user_id', 'marshal_id', 'allocation_id',
+                   'obs_seq', 'exptime', 'priority', 'inidate', 'enddate',
+                   'maxairmass', 'status', 'max_fwhm', 'min_moon_dist',
+                   'max_moon_illum', 'max_cloud_cover', 'seq_repeats',
+                   'seq_completed')
+
+# Replaying an insert that already reached the database is harmless
+STATEMENTS = {
+    'journal_add_request': (
+        "INSERT INTO request (id, %s, creationdate, lastmodified) "
+        "VALUES (%s, now(), now()) ON CONFLICT (id) DO NOTHING" %
+        (', '.join(REQUEST_COLUMNS),
+         ', '.join('$%d' % i for i in range(1, len(REQUEST_COLUMNS) + 2)))),
+    'journal_update_request': (
+        "UPDATE request SET status = $2, lastmodified = now() "
+        "WHERE id = $1")
+}
+
+# One writer per journal file in a process, see open_journal
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def open_journal(journal_file, db_pool, **kwargs):
+    """
+    The running journal for journal_file, started if there is none, so
+    two schedulers in one process never flush the same entries
+
+    :param journal_file: sqlite file holding the journal
+    :param db_pool: psycopg2 connection pool for a new journal
+    :param kwargs: other RequestJournal arguments for a new journal
+    :return: RequestJournal
+    """
+    key = os.path.abspath(journal_file)
+    with _journals_lock:
+        journal = _journals.get(key)
+        if journal is None or journal.stopped.is_set():
+            journal = RequestJournal(journal_file, db_pool, **kwargs)
+            _journals[key] = journal
+        return journal
+
+
+class RequestJournal:
+    """
+    Durable write-behind queue for request inserts and status updates.
+
+    Entries are stored in a local sqlite journal and written to the
+    database in order, in batches, by a background thread, so a slow or
+    unreachable database does not hold up the caller.  New requests get
+    their id immediately from a block reserved ahead of time on the
+    request id sequence.  Pending entries and unused ids survive a restart.
+
+    An entry the database rejects outright, such as a foreign key or bad
+    value error, is moved to the dead_letter table so it does not hold up
+    the ones behind it.  Only lost connections are retried.
+    """
+
+    def __init__(self, journal_file, db_pool, sequence='request_id_seq',
+                 block_size=50, batch_size=100, flush_interval=1.0):
+        """
+
+        :param journal_file: sqlite file holding the journal
+        :param db_pool: psycopg2 connection pool
+        :param sequence: database sequence request ids are drawn from
+        :param block_size: number of ids to keep reserved
+        :param batch_size: maximum entries written per transaction
+        :param flush_interval: seconds between flushes
+        """
+        self.journal_file = journal_file
+        self.db_pool = db_pool
+        self.sequence = sequence
+        self.block_size = block_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Statements prepared on each pooled connection, dropped with it
+        self.prepared = weakref.WeakKeyDictionary()
+        self.failures = 0
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.conn = sqlite3.connect(journal_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = FULL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _insert(self, kind, payload):
+        self.conn.execute(
+            "INSERT INTO journal (kind, payload, created) VALUES (?, ?, ?)",
+            (kind, json.dumps(payload), time.time()))
+
+    def _reserved(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT count(*) FROM reserved_ids").fetchone()[0]
+
+    def reserve(self, n=None):
+        """
+        Reserve a block of request ids from the database sequence
+
+        :param n: number of ids, defaults to block_size
+        :return: number reserved
+        """
+        n = n or self.block_size
+        conn = self.db_pool.getconn()
+        ok = True
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute("SELECT nextval(%s::regclass) "
+                            "FROM generate_series(1, %s)", (self.sequence, n))
+                ids = [(r[0],) for r in cur.fetchall()]
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            ok = False
+            raise
+        finally:
+            self.db_pool.putconn(conn, close=not ok)
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO reserved_ids (id) VALUES (?)", ids)
+            self.conn.commit()
+        return len(ids)
+
+    def add_request(self, request_dict):
+        """
+        Queue a new request under the lowest reserved id, reserving a new
+        block first if none are left
+
+        :param request_dict: request column values
+        :return: id the request will have or None if no id is available
+        """
+        payload = {k: request_dict.get(k) for k in REQUEST_COLUMNS}
+        for attempt in range(2):
+            with self.lock:
+                request_id = self.conn.execute(
+                    "SELECT min(id) FROM reserved_ids").fetchone()[0]
+                if request_id is not None:
+                    # Claiming the id and queueing the insert is atomic
+                    payload['id'] = request_id
+                    self.conn.execute("DELETE FROM reserved_ids WHERE id = ?",
+                                      (request_id,))
+                    self._insert('add_request', payload)
+                    self.conn.commit()
+            if request_id is not None:
+                self.wake.set()
+                return request_id
+            if attempt:
+                break
+            try:
+                self.reserve()
+            except psycopg2.Error as e:
+                print("request_journal: unable to reserve ids: %s" % str(e))
+                break
+        return None
+
+    def update_request(self, request_id, status):
+        """Queue a request status change"""
+        with self.lock:
+            self._insert('update_request', {'id': int(request_id),
+                                            'status': status})
+            self.conn.commit()
+        self.wake.set()
+
+    def pending(self):
+        """Number of entries not yet written to the database"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT count(*) FROM journal").fetchone()[0]
+
+    @staticmethod
+    def _args(kind, payload):
+        if kind == 'add_request':
+            return [payload['id']] + [payload[k] for k in REQUEST_COLUMNS]
+        return [payload['id'], payload['status']]
+
+    def pending_status(self):
+        """
+        Request statuses still waiting in the journal, so a restarted
+        scheduler does not show them as they are in the database
+
+        :return: dict of request id to its last queued status
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT payload FROM journal WHERE kind = 'update_request' "
+                "ORDER BY seq").fetchall()
+        status = {}
+        for payload, in rows:
+            payload = json.loads(payload)
+            status[int(payload['id'])] = payload['status']
+        return status
+
+    def dead_letters(self):
+        """(seq, kind, payload, error) of the entries the database refused"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT seq, kind, payload, error FROM dead_letter "
+                "ORDER BY seq").fetchall()
+
+    def _prepared(self, conn, cur):
+        """
+        Names of the statements prepared on conn, read from the server
+        the first time the connection is seen
+        """
+        prepared = self.prepared.get(conn)
+        if prepared is None:
+            cur.execute("SELECT name FROM pg_prepared_statements")
+            prepared = set(r[0] for r in cur.fetchall())
+            self.prepared[conn] = prepared
+        return prepared
+
+    @staticmethod
+    def _execute(cur, name, args, prepared):
+        """Run a journal statement, preparing it first where needed"""
+        for attempt in range(2):
+            if name not in prepared:
+                cur.execute("PREPARE %s AS %s" % (name, STATEMENTS[name]))
+                prepared.add(name)
+            try:
+                cur.execute("EXECUTE %s (%s)" %
+                            (name, ', '.join(['%s'] * len(args))), args)
+                return
+            except psycopg2.ProgrammingError as e:
+                # The statement is gone from the session, prepare it again
+                if e.pgcode != '26000' or attempt:
+                    raise
+                cur.execute("ROLLBACK TO SAVEPOINT journal_entry")
+                prepared.discard(name)
+
+    def flush(self):
+        """
+        Write the oldest journal entries to the database in one
+        transaction, in journal order.  Each entry runs under a savepoint
+        so one the database refuses is set aside without the rest.
+
+        :return: number of entries taken off the journal
+        """
+        with self.flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self.lock:
+            entries = self.conn.execute(
+                "SELECT seq, kind, payload, created FROM journal ORDER BY seq "
+                "LIMIT ?", (self.batch_size,)).fetchall()
+        if not entries:
+            return 0
+
+        dead = []
+        conn = self.db_pool.getconn()
+        ok = True
+        try:
+            conn.autocommit = False
+            with conn.cursor() as cur:
+                prepared = self._prepared(conn, cur)
+                for seq, kind, payload, created in entries:
+                    name = 'journal_' + kind
+                    if name not in STATEMENTS:
+                        dead.append((seq, kind, payload, created,
+                                     "unknown entry kind"))
+                        continue
+                    cur.execute("SAVEPOINT journal_entry")
+                    try:
+                        args = self._args(kind, json.loads(payload))
+                        self._execute(cur, name, args, prepared)
+                    except (psycopg2.OperationalError,
+                            psycopg2.InterfaceError):
+                        raise
+                    except (psycopg2.Error, KeyError, ValueError) as e:
+                        cur.execute("ROLLBACK TO SAVEPOINT journal_entry")
+                        print("request_journal: entry %d %s refused: %s"
+                              % (seq, kind, str(e).strip()))
+                        dead.append((seq, kind, payload, created,
+                                     str(e).strip()))
+                        continue
+                    cur.execute("RELEASE SAVEPOINT journal_entry")
+            conn.commit()
+        except psycopg2.Error:
+            # Forget what was prepared, the rollback may undo it
+            self.prepared.pop(conn, None)
+            ok = not conn.closed
+            if ok:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    ok = False
+            raise
+        finally:
+            self.db_pool.putconn(conn, close=not ok)
+
+        with self.lock:
+            now = time.time()
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO dead_letter (seq, kind, payload, "
+                "created, failed, error) VALUES (?, ?, ?, ?, ?, ?)",
+                [(seq, kind, payload, created, now, error)
+                 for seq, kind, payload, created, error in dead])
+            self.conn.execute("DELETE FROM journal WHERE seq <= ?",
+                              (entries[-1][0],))
+            self.conn.commit()
+        return len(entries)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            # Back off while the database is unavailable
+            self.wake.wait(min(self.flush_interval * 2 ** self.failures, 30))
+            self.wake.clear()
+            try:
+                while self.flush() == self.batch_size:
+                    pass
+                if self._reserved() < self.block_size // 2:
+                    self.reserve()
+                self.failures = 0
+            except psycopg2.Error as e:
+                self.failures = min(self.failures + 1, 5)
+                print("request_journal: database write failed, %d pending: "
+                      "%s" % (self.pending(), str(e)))
+            except Exception as e:
+                self.failures = min(self.failures + 1, 5)
+                print("request_journal: %s" % str(e))
+
+    def close(self):
+        """Stop the writer after a last flush attempt"""
+        with _journals_lock:
+            if _journals.get(os.path.abspath(self.journal_file)) is self:
+                del _journals[os.path.abspath(self.journal_file)]
+        self.stopped.set()
+        self.wake.set()
+        self.thread.join(timeout=10)
+        try:
+            self.flush()
+        except psycopg2.Error as e:
+            print("request_journal: %d entries left for the next start: %s"
+                  % (self.pending(), str(e)))
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,114 @@
+import os
+import time
+import datetime
+import threading
+from collections import deque
+from astropy.io import fits
+from sky.guider.frame_watcher import FrameWatcher
+
+
+class FwhmIndex:
+    """
+    Rolling table of the seeing measured on guider frames.
+
+    A background thread measures the FWHM of each new RC guider frame
+    once, as it lands in tonight's image directory, and keeps
+    (time, fwhm, airmass).  Asking for the recent seeing only averages
+    the stored values.
+    """
+
+    def __init__(self, image_dir, extractor, keep=500, window=3600,
+                 min_frames=20, fallback_frames=50, logger=None):
+        """
+
+        :param image_dir: directory holding one YYYYMMDD directory per night
+        :param extractor: sextractor used to measure the frames
+        :param keep: number of measurements kept
+        :param window: seconds of frames averaged for the recent seeing
+        :param min_frames: frames needed in the window, otherwise the
+                           last fallback_frames are averaged
+        :param fallback_frames:
+        :param logger:
+        """
+        self.image_dir = image_dir
+        self.extractor = extractor
+        self.window = window
+        self.min_frames = min_frames
+        self.fallback_frames = fallback_frames
+        self.logger = logger
+        self.table = deque(maxlen=keep)
+        self.lock = threading.Lock()
+        self.night = None
+        self.watcher = None
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _log(self, msg):
+        if self.logger:
+            self.logger.info(msg)
+        else:
+            print(msg)
+
+    @staticmethod
+    def _frame_time(path):
+        """Shutter open time from an rcYYYYMMDD_HH_MM_SS.fits name"""
+        return datetime.datetime.strptime(
+            os.path.basename(path)[2:-5], '%Y%m%d_%H_%M_%S').replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+
+    def add(self, frame_time, fwhm, airmass=None):
+        """Store one measurement"""
+        with self.lock:
+            self.table.append((frame_time, fwhm, airmass))
+
+    def _recent(self):
+        if not self.table:
+            return -1
+        start = time.time() - self.window
+        values = [f for t, f, _ in self.table if t >= start]
+        if len(values) < self.min_frames:
+            values = [f for _, f, _ in self.table][-self.fallback_frames:]
+        return sum(values) / len(values)
+
+    def recent(self):
+        """Mean FWHM in arcsec of the recent guider frames, -1 if none"""
+        with self.lock:
+            return self._recent()
+
+    def measurements(self, since=0):
+        """(time, fwhm, airmass) of the frames taken after since"""
+        with self.lock:
+            return [m for m in self.table if m[0] > since]
+
+    def _measure(self, path):
+        try:
+            hdr = fits.getheader(path)
+            if 'Guider' not in str(hdr.get('IMGTYPE', '')):
+                return
+            frame_time = self._frame_time(path)
+            fwhm = self.extractor.get_star_fwhm(path)
+            airmass = hdr.get('AIRMASS')
+        except Exception as e:
+            self._log("fwhm_index: unable to measure %s: %s" % (path, str(e)))
+            return
+        if fwhm and fwhm > 0:
+            self.add(frame_time, float(fwhm), airmass)
+
+    def _run(self):
+        while True:
+            try:
+                night = datetime.datetime.utcnow().strftime('%Y%m%d')
+                if night != self.night:
+                    if self.watcher is not None:
+                        self.watcher.close()
+                    self.night = night
+                    self.watcher = FrameWatcher(
+                        os.path.join(self.image_dir, night), prefix='rc',
+                        poll_interval=5.0)
+                path = self.watcher.get(timeout=5.0)
+                if path:
+                    self._measure(path)
+            except Exception as e:
+                self._log("fwhm_index: %s" % str(e))
+                time.sleep(5)
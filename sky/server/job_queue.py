@@ -0,0 +1,96 @@
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobQueue:
+    def __init__(self, max_workers=2, keep_jobs=200, logger=None):
+        """
+        Bounded worker pool for long sky server requests.  Jobs are
+        identified by an id returned at submission so clients can poll or
+        fetch the result later, on any connection.
+
+        :param max_workers: number of jobs run at once
+        :param keep_jobs: number of finished jobs to remember
+        :param logger:
+        """
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.keep_jobs = keep_jobs
+        self.logger = logger
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, name, func, **kwargs):
+        """
+        Queue func(**kwargs), which must return a sky server style dict
+
+        :return: job id
+        """
+        job_id = uuid.uuid4().hex
+        job = {'name': name, 'status': 'queued', 'submitted': time.time(),
+               'done': threading.Event(), 'result': None}
+        with self.lock:
+            self.jobs[job_id] = job
+            self._trim()
+        self.pool.submit(self._run, job_id, job, func, kwargs)
+        return job_id
+
+    def _trim(self):
+        while len(self.jobs) > self.keep_jobs:
+            oldest = next(iter(self.jobs))
+            if not self.jobs[oldest]['done'].is_set():
+                break
+            self.jobs.popitem(last=False)
+
+    def _run(self, job_id, job, func, kwargs):
+        start = time.time()
+        job['status'] = 'running'
+        job['started'] = start
+        try:
+            result = func(**kwargs)
+        except Exception as e:
+            if self.logger:
+                self.logger.error("Job %s (%s) failed", job_id, job['name'],
+                                  exc_info=True)
+            result = {'elaptime': time.time() - start, 'error': str(e)}
+        if not isinstance(result, dict):
+            result = {'elaptime': time.time() - start, 'data': result}
+        job['result'] = result
+        job['finished'] = time.time()
+        job['status'] = 'error' if 'error' in result else 'done'
+        job['done'].set()
+
+    def _get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def status(self, job_id):
+        """Current state of a job without waiting"""
+        start = time.time()
+        job = self._get(job_id)
+        if job is None:
+            return {'elaptime': time.time() - start,
+                    'error': "Unknown job %s" % job_id}
+        info = {k: v for k, v in job.items() if k not in ('done', 'result')}
+        return {'elaptime': time.time() - start, 'data': info}
+
+    def result(self, job_id, timeout=0):
+        """
+        Result of a job, waiting up to timeout seconds for it to finish
+
+        :return: the job's own return dict with job_id added, or an error
+        """
+        start = time.time()
+        job = self._get(job_id)
+        if job is None:
+            return {'elaptime': time.time() - start,
+                    'error': "Unknown job %s" % job_id}
+        if not job['done'].wait(timeout):
+            return {'elaptime': time.time() - start, 'job_id': job_id,
+                    'status': job['status'],
+                    'error': "Job %s not finished" % job_id}
+        ret = dict(job['result'])
+        ret['job_id'] = job_id
+        return ret
@@ -1,6 +1,7 @@
 import socket
 import time
 import json
+from utils import framing
 
 
 class Sky:
@@ -37,12 +38,11 @@ class Sky:
                 self.timeout = self.default_timeout
 
             if parameters:
-                send_str = json.dumps({'command': cmd,
-                                       'parameters': parameters})
+                message = {'command': cmd, 'parameters': parameters}
             else:
-                send_str = json.dumps({'command': cmd})
+                message = {'command': cmd}
 
-            self.socket.send(b"%s" % send_str.encode('utf-8'))
+            framing.send_message(self.socket, message)
 
             if return_before_done:
 
@@ -50,16 +50,10 @@ class Sky:
                         "command": cmd,
                         "data": "exiting the loop early"}
 
-            data = self.socket.recv(2048)
-            counter = 0
-            while not data:
-                time.sleep(.1)
-                data = self.socket.recv(2048)
-                counter += 1
-                if counter > 100:
-                    break
-
-            ret_dict = json.loads(data.decode('utf-8'))
+            ret_dict = framing.recv_message(self.socket)
+            if ret_dict is None:
+                return {'elaptime': time.time() - start,
+                        'error': 'socket disconnect'}
             if isinstance(ret_dict, dict):
                 if 'command' not in ret_dict:
                     ret_dict['command'] = cmd
@@ -82,6 +76,38 @@ class Sky:
                                    return_before_done=return_before_done,
                                    parameters=parameters)
 
+    def submit_offset(self, raw_image, overwrite=True,
+                      parse_directory_from_file=False,
+                      base_dir='/data2/sedm/'):
+        """
+        Queue an astrometry solve on the server
+
+        :return: dict with the job id in 'data'
+        """
+        parameters = {
+            'raw_image': raw_image, 'overwrite': overwrite,
+            'parse_directory_from_file': parse_directory_from_file,
+            'base_dir': base_dir
+        }
+
+        return self.__send_command(cmd="SUBMITOFFSETS",
+                                   parameters=parameters)
+
+    def job_status(self, job_id):
+        return self.__send_command(cmd="JOBSTATUS",
+                                   parameters={'job_id': job_id})
+
+    def job_result(self, job_id, timeout=180):
+        """
+        Result of a queued job, waiting up to timeout seconds on the server
+
+        :return: the job's return dict (e.g. offsets in 'data')
+        """
+        self.timeout = max(self.default_timeout, timeout + 30)
+        return self.__send_command(cmd="JOBRESULT",
+                                   parameters={'job_id': job_id,
+                                               'timeout': timeout})
+
     def check_socket(self):
         """
         Try sending a command to the camera program
@@ -125,6 +151,17 @@ class Sky:
                                    parameters=parameters,
                                    return_before_done=return_before_done)
 
+    def guider_frame(self, filename):
+        """
+        Hand a new RC frame to a running guider.  Must be sent on a
+        connection other than the one that started the guider.
+
+        :param filename: full path of the frame on the sky server host
+        :return:
+        """
+        return self.__send_command(cmd="GUIDERFRAME",
+                                   parameters={'filename': filename})
+
     def get_standard(self, name="zenith", obsdate=""):
         """
 
@@ -149,7 +186,8 @@ class Sky:
                                    sort_columns=('priority', 'start_alt'),
                                    sort_order=(False, False), save=True,
                                    save_as='',
-                                   check_end_of_night=True, update_coords=True):
+                                   check_end_of_night=True, update_coords=True,
+                                   pointing=None):
         parameters = {
             'target_list': target_list,
             'obsdatetime': obsdatetime,
@@ -165,12 +203,68 @@ class Sky:
             'save': save,
             'save_as': save_as,
             'check_end_of_night': check_end_of_night,
-            'update_coords': update_coords
+            'update_coords': update_coords,
+            'pointing': pointing
         }
 
         return self.__send_command(cmd="GETTARGET",
                                    parameters=parameters)
 
+    def prepare_next_target(self, obsdatetime=None, target_list=None,
+                            airmass=(1, 3.0), moon_sep=(25, 180),
+                            altitude_min=10, ha=(18.75, 5.75),
+                            return_type='json', do_sort=True, do_fwhm=False,
+                            sort_columns=('priority', 'start_alt'),
+                            sort_order=(False, False), save=True,
+                            save_as='', check_end_of_night=True,
+                            update_coords=True, pointing=None):
+        """
+        Have the server work out the next target for obsdatetime in the
+        background.  A get_next_observable_target call with the same
+        parameters near that time returns the answer without waiting.
+
+        :param obsdatetime: iso time the current observation should end
+        :param pointing: (ra, dec) the telescope will be at, defaults to
+                         the target last marked ACTIVE
+        :return:
+        """
+        parameters = {
+            'target_list': target_list,
+            'obsdatetime': obsdatetime,
+            'airmass': airmass,
+            'moon_sep': moon_sep,
+            'altitude_min': altitude_min,
+            'ha': ha,
+            'return_type': return_type,
+            'do_sort': do_sort,
+            'do_fwhm': do_fwhm,
+            'sort_columns': sort_columns,
+            'sort_order': sort_order,
+            'save': save,
+            'save_as': save_as,
+            'check_end_of_night': check_end_of_night,
+            'update_coords': update_coords,
+            'pointing': pointing
+        }
+
+        return self.__send_command(cmd="PREPARETARGET",
+                                   parameters=parameters)
+
+    def get_recent_fwhm(self):
+        """
+        Mean FWHM in arcsec of the recent guider frames, -1 if none
+        """
+        return self.__send_command(cmd="GETFWHM")
+
+    def get_overheads(self):
+        """
+        Readout and setup overheads fitted from past nights
+
+        :return: dict with 'exposure' seconds keyed by camera and readout
+                 speed (e.g. 'rc_2.0') and 'setup' seconds per target
+        """
+        return self.__send_command(cmd="GETOVERHEADS")
+
     def get_best_focus(self, files, ifu=False):
         parameters = {
             'files': files,
@@ -325,15 +419,10 @@ class Sky:
         return ret, offsets
 
     def listen(self):
-        data = self.socket.recv(2048)
-        counter = 0
-        while not data:
-            time.sleep(.1)
-            data = self.socket.recv(2048)
-            counter += 1
-            if counter > 100:
-                break
-        return json.loads(data.decode('utf-8'))
+        data = framing.recv_message(self.socket)
+        if data is None:
+            return {'error': 'socket disconnect'}
+        return data
 
 
 if __name__ == '__main__':
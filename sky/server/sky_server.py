@@ -4,14 +4,18 @@ import logging
 import json
 from logging.handlers import TimedRotatingFileHandler
 import time
+import datetime
 import socket
 import threading
+from astropy.time import Time
 from sky.astrometry import solver
 from sky.scheduler import dbscheduler
 from sky.sextractor import run
 from sky.guider import rcguider
-from sky.growth import marshal
+from sky.server.job_queue import JobQueue
+from sky.server.fwhm_index import FwhmIndex
 import SEDM_robot_version as Version
+from utils import framing
 
 with open(os.path.join(Version.CONFIG_DIR, 'logging.json')) as data_file:
     params = json.load(data_file)
@@ -39,7 +43,18 @@ logger.info("Starting Logger: Logger file is %s", 'sky_server.log')
 
 
 class SkyServer:
-    def __init__(self, hostname, port, do_connect=True):
+    def __init__(self, hostname, port, do_connect=True, astrometry_workers=2,
+                 lookahead_tolerance=300, lookahead_max_age=3600):
+        """
+
+        :param hostname:
+        :param port:
+        :param do_connect:
+        :param astrometry_workers: number of astrometry jobs run at once
+        :param lookahead_tolerance: seconds a GETTARGET time may differ from
+                                    the time the next target was prepared for
+        :param lookahead_max_age: seconds a prepared target stays usable
+        """
         self.hostname = hostname
         self.port = port
         self.socket = ""
@@ -47,8 +62,101 @@ class SkyServer:
         self.sex = run.sextractor()
         self.do_connect = do_connect
         self.scheduler = dbscheduler.Scheduler()
-        self.growth = marshal.Interface()
+        self.growth = self.scheduler.growth
+        self.fwhm = FwhmIndex(self.scheduler.params['rc_images_dir'],
+                              run.sextractor(), logger=logger)
+        self.scheduler.fwhm_index = self.fwhm
         self.guider = rcguider.guide(do_connect=do_connect)
+        self.jobs = JobQueue(max_workers=astrometry_workers, logger=logger)
+        self.lookahead = None
+        self.lookahead_lock = threading.Lock()
+        self.lookahead_tolerance = lookahead_tolerance
+        self.lookahead_max_age = lookahead_max_age
+
+    @staticmethod
+    def _lookahead_key(parameters):
+        return json.dumps({k: v for k, v in parameters.items()
+                           if k != 'obsdatetime'}, sort_keys=True, default=str)
+
+    def prepare_target(self, **parameters):
+        """
+        Start working out the next target in the background for
+        obsdatetime, normally the expected end of the running exposure.
+        A later GETTARGET with the same parameters gets the answer.
+        """
+        start = time.time()
+        if not parameters.get('obsdatetime'):
+            parameters['obsdatetime'] = datetime.datetime.utcnow().isoformat()
+        lookahead = {'key': self._lookahead_key(parameters),
+                     'obstime': Time(parameters['obsdatetime']),
+                     'created': time.time(), 'done': threading.Event(),
+                     'result': None, 'version': None}
+
+        def run():
+            try:
+                result = self.scheduler.get_next_observable_target(
+                    **parameters)
+            except Exception as e:
+                logger.error("Look-ahead target failed", exc_info=True)
+                result = {'error': str(e)}
+            # The queue state the answer was computed from
+            lookahead['version'] = self.scheduler.target_version
+            lookahead['result'] = result
+            lookahead['done'].set()
+            logger.info("Look-ahead target for %s: %s",
+                        parameters['obsdatetime'], result)
+
+        with self.lookahead_lock:
+            self.lookahead = lookahead
+        threading.Thread(target=run, daemon=True).start()
+        return {'elaptime': time.time()-start,
+                'data': 'Preparing target for %s' % parameters['obsdatetime']}
+
+    def _lookahead_answer(self, parameters):
+        """Prepared answer if it still holds for these parameters"""
+        with self.lookahead_lock:
+            lookahead = self.lookahead
+            self.lookahead = None
+        if lookahead is None or \
+                self._lookahead_key(parameters) != lookahead['key']:
+            return None
+        if time.time() - lookahead['created'] > self.lookahead_max_age:
+            return None
+        obstime = Time(parameters.get('obsdatetime') or
+                       datetime.datetime.utcnow())
+        if abs((obstime - lookahead['obstime']).sec) > \
+                self.lookahead_tolerance:
+            logger.info("Look-ahead was for %s, not %s",
+                        lookahead['obstime'].iso, obstime.iso)
+            return None
+        # Still running, waiting beats starting over
+        lookahead['done'].wait()
+        result = lookahead['result']
+        if not isinstance(result, dict) or \
+                not isinstance(result.get('data'), dict):
+            return None
+
+        # Cheap incremental sync to see whether the queue changed since
+        active = self.scheduler.get_active_targets(save_copy=False)
+        if 'data' not in active or \
+                self.scheduler.target_version != lookahead['version']:
+            logger.info("Queue changed, look-ahead target dropped")
+            return None
+        if result['data']['req_id'] not in set(active['data']['req_id']):
+            logger.info("Look-ahead target no longer pending")
+            return None
+        return result
+
+    def get_target(self, **parameters):
+        """Prepared next target when valid, otherwise compute it now"""
+        start = time.time()
+        result = self._lookahead_answer(parameters)
+        if result is not None:
+            result = dict(result)
+            result['elaptime'] = time.time() - start
+            result['lookahead'] = True
+            return result
+        return self.scheduler.get_next_observable_target(**parameters)
 
     def handle(self, connection, address):
         if address is not None:
@@ -57,31 +165,44 @@ class SkyServer:
             response = {'test': 'test'}
             try:
                 start = time.time()
-                data = connection.recv(2048)
-
-                data = data.decode("utf8")
-                logger.info("Received: %s", data)
-
-                if not data:
-                    break
                 try:
-
-                    data = json.loads(data)
-                except Exception as e:
+                    data = framing.recv_message(connection)
+                except framing.FramingError:
+                    logger.error("Connection lost mid-message", exc_info=True)
+                    break
+                except ValueError as e:
                     logger.error("Load error", exc_info=True)
-                    error_dict = json.dumps({'elaptime': time.time()-start,
-                                             "error": "error message %s" %
-                                                      str(e)})
-                    connection.sendall(error_dict)
+                    framing.send_message(connection,
+                                         {'elaptime': time.time()-start,
+                                          "error": "error message %s"
+                                                   % str(e)})
+                    break
+                logger.info("Received: %s", data)
+
+                if data is None:
                     break
 
                 if 'command' in data:
                     if data['command'].upper() == 'GETOFFSETS':
                         response = solver.calculate_offset(**data['parameters'])
+                    elif data['command'].upper() == 'SUBMITOFFSETS':
+                        job_id = self.jobs.submit('offsets',
+                                                  solver.calculate_offset,
+                                                  **data['parameters'])
+                        response = {'elaptime': time.time()-start,
+                                    'data': job_id}
+                    elif data['command'].upper() == 'JOBSTATUS':
+                        response = self.jobs.status(**data['parameters'])
+                    elif data['command'].upper() == 'JOBRESULT':
+                        response = self.jobs.result(**data['parameters'])
                     elif data['command'].upper() == 'REINT':
                         self.sex = run.sextractor()
+                        self.scheduler.close()
                         self.scheduler = dbscheduler.Scheduler()
-                        self.growth = marshal.Interface()
+                        self.growth = self.scheduler.growth
+                        self.scheduler.fwhm_index = self.fwhm
+                        with self.lookahead_lock:
+                            self.lookahead = None
                         self.guider = rcguider.guide(do_connect=self.do_connect)
                         response = {'elaptime': time.time()-start,
                                     'data': 'System reinitialized'}
@@ -108,9 +229,19 @@ class SkyServer:
                         _ = self.guider.start_guider(**data['parameters'])
                         response = {"elaptime": time.time()-start,
                                     "data": "guider started"}
+                    elif data['command'].upper() == 'GUIDERFRAME':
+                        ret = self.guider.notify_frame(**data['parameters'])
+                        response = {"elaptime": time.time()-start,
+                                    "data": ret}
                     elif data['command'].upper() == 'GETTARGET':
-                        response = self.scheduler.get_next_observable_target(
-                            **data['parameters'])
+                        response = self.get_target(**data['parameters'])
+                    elif data['command'].upper() == 'PREPARETARGET':
+                        response = self.prepare_target(**data['parameters'])
+                    elif data['command'].upper() == 'GETFWHM':
+                        response = self.scheduler.get_recent_fwhm()
+                    elif data['command'].upper() == 'GETOVERHEADS':
+                        response = {'elaptime': time.time()-start,
+                                    'data': self.scheduler.overheads.to_dict()}
                     elif data['command'].upper() == 'PING':
                         response = {'elaptime': time.time()-start,
                                     'data': 'PONG'}
@@ -120,6 +251,12 @@ class SkyServer:
                     elif data['command'].upper() == "UPDATEREQUEST":
                         response = self.scheduler.update_request(
                             **data['parameters'])
+                        # A request back in the queue may beat the
+                        # prepared target
+                        if data['parameters'].get('status',
+                                                   'PENDING') == 'PENDING':
+                            with self.lookahead_lock:
+                                self.lookahead = None
                     elif data['command'].upper() == "GETGROWTHID":
                         response = self.growth.get_marshal_id_from_dbhost(
                             **data['parameters'])
@@ -130,8 +267,7 @@ class SkyServer:
                 else:
                     response = {'elaptime': time.time()-start,
                                 'error': "Command not found"}
-                jsonstr = json.dumps(response)
-                connection.sendall(jsonstr.encode('utf-8'))
+                framing.send_message(connection, response)
             except Exception as e:
                 logger.warning(str(e))
                 logger.error("Big error", exc_info=True)
@@ -0,0 +1,301 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+
+# Same 3x3 detection filter as config/sedm_sextractor_config/default.conv
+DEFAULT_CONV = np.array([[1., 2., 1.],
+                         [2., 4., 2.],
+                         [1., 2., 1.]])
+
+# SExtractor FLAGS bits
+FLAG_BLENDED = 2
+FLAG_SATURATED = 4
+FLAG_TRUNCATED = 8
+
+CATALOG_COLUMNS = ['NUMBER', 'X_IMAGE', 'Y_IMAGE', 'MAG_BEST', 'MAGERR_BEST',
+                   'FLUX_BEST', 'FWHM_IMAGE', 'ELLIPTICITY', 'BACKGROUND',
+                   'FLAGS', 'A_IMAGE', 'B_IMAGE', 'THETA_IMAGE',
+                   'ISOAREA_IMAGE']
+
+
+def read_conv(conv_file):
+    """Kernel of a SExtractor .conv filter file"""
+    rows = []
+    with open(conv_file) as conv:
+        for line in conv:
+            line = line.strip()
+            if not line or line.startswith('#') or line.startswith('CONV'):
+                continue
+            rows.append([float(v) for v in line.split()])
+    return np.array(rows)
+
+
+def read_config(sex_file):
+    """
+    extract_sources arguments from the settings of a SExtractor .sex file
+
+    :param sex_file: SExtractor configuration file
+    :return: dict of extract_sources keyword arguments
+    """
+    settings = {}
+    with open(sex_file) as config:
+        for line in config:
+            line = line.split('#')[0].split()
+            if len(line) >= 2:
+                settings[line[0]] = ' '.join(line[1:])
+
+    kwargs = {}
+    for key, arg, kind in (('DETECT_THRESH', 'thresh', float),
+                           ('DETECT_MINAREA', 'minarea', int),
+                           ('BACK_SIZE', 'back_size', int),
+                           ('BACK_FILTERSIZE', 'back_filtersize', int),
+                           ('DEBLEND_NTHRESH', 'deblend_nthresh', int),
+                           ('DEBLEND_MINCONT', 'deblend_mincont', float),
+                           ('SATUR_LEVEL', 'satur_level', float),
+                           ('MAG_ZEROPOINT', 'mag_zeropoint', float)):
+        if key in settings:
+            # Only the first value of a <width>,<height> pair is used
+            kwargs[arg] = kind(settings[key].split(',')[0])
+
+    if settings.get('FILTER', 'Y').upper().startswith('N'):
+        kwargs['conv'] = None
+    elif 'FILTER_NAME' in settings:
+        conv_file = settings['FILTER_NAME']
+        if not os.path.exists(conv_file):
+            # Installed somewhere else, look next to the .sex file
+            conv_file = os.path.join(os.path.dirname(sex_file),
+                                     os.path.basename(conv_file))
+        if os.path.exists(conv_file):
+            kwargs['conv'] = read_conv(conv_file)
+    return kwargs
+
+
+def background(image, box=64, filter_size=3, nsigma=3.):
+    """
+    Mesh background and global noise, as with BACK_SIZE/BACK_FILTERSIZE
+
+    :param image: 2D float array
+    :param box: mesh size in pixels
+    :param filter_size: median filter size applied to the mesh
+    :param nsigma: clipping level for each mesh
+    :return: (background image, background rms)
+    """
+    ny, nx = image.shape
+    my, mx = max(ny // box, 1), max(nx // box, 1)
+    by, bx = ny // my, nx // mx
+    mesh = image[:my * by, :mx * bx].reshape(my, by, mx, bx)
+    mesh = mesh.transpose(0, 2, 1, 3).reshape(my, mx, by * bx)
+
+    med = np.median(mesh, axis=2)
+    std = np.std(mesh, axis=2)
+    keep = np.abs(mesh - med[..., None]) <= nsigma * std[..., None]
+    clipped = np.where(keep, mesh, np.nan)
+    med = np.nanmedian(clipped, axis=2)
+    std = np.nanstd(clipped, axis=2)
+    if filter_size > 1:
+        med = ndimage.median_filter(med, size=filter_size, mode='nearest')
+
+    # Separable bilinear expansion back to the full frame
+    xi = np.clip((np.arange(nx) + 0.5) / bx - 0.5, 0, mx - 1)
+    x0 = xi.astype(int)
+    x1 = np.minimum(x0 + 1, mx - 1)
+    fx = xi - x0
+    rows = med[:, x0] * (1. - fx) + med[:, x1] * fx
+    yi = np.clip((np.arange(ny) + 0.5) / by - 0.5, 0, my - 1)
+    y0 = yi.astype(int)
+    y1 = np.minimum(y0 + 1, my - 1)
+    fy = (yi - y0)[:, None]
+    bkg = (rows[y0] * (1. - fy) + rows[y1] * fy).astype(np.float32)
+    return bkg, float(np.nanmedian(std))
+
+
+def deblend(detect, labels, nobj, level, nthresh=32, mincont=0.005,
+            minarea=10):
+    """
+    Split blended detections the way SExtractor's multi-threshold
+    deblending does: each detection is cut at nthresh levels spaced
+    exponentially between the threshold and its peak, and a branch that
+    holds at least mincont of the detection's flux becomes an object of
+    its own.  The remaining pixels go to the nearest branch by flooding
+    down from the branch peaks.
+
+    :param detect: filtered, background subtracted image
+    :param labels: detection labels from ndimage.label
+    :param nobj: number of detections
+    :param level: detection threshold in image units
+    :param nthresh: number of deblending sub-thresholds
+    :param mincont: minimum flux fraction of a branch
+    :param minarea: minimum number of pixels of a branch
+    :return: (labels, number of objects, array of True for the objects
+             that were split off or split from)
+    """
+    blended = np.zeros(nobj + 1, dtype=bool)
+    if nthresh <= 1 or mincont >= 1:
+        return labels, nobj, blended
+    labels = labels.copy()
+    eight = np.ones((3, 3))
+    new_ids = []
+    for i, box in enumerate(ndimage.find_objects(labels), 1):
+        if box is None:
+            continue
+        obj = labels[box] == i
+        npix = obj.sum()
+        if npix < 2 * minarea:
+            continue
+        img = np.where(obj, detect[box], 0.)
+        peak = img.max()
+        total = img[obj].sum()
+        if peak <= level or total <= 0:
+            continue
+
+        leaves = [obj]
+        for k in range(1, nthresh):
+            cut = level * (peak / level) ** (k / float(nthresh))
+            split = []
+            for leaf in leaves:
+                sub, n = ndimage.label(leaf & (img > cut), structure=eight)
+                if n < 2:
+                    split.append(leaf)
+                    continue
+                flux = np.bincount(sub.ravel(), weights=img.ravel(),
+                                   minlength=n + 1)
+                area = np.bincount(sub.ravel(), minlength=n + 1)
+                keep = [j for j in range(1, n + 1)
+                        if flux[j] >= mincont * total and area[j] >= minarea]
+                if len(keep) < 2:
+                    split.append(leaf)
+                else:
+                    split.extend(sub == j for j in keep)
+            leaves = split
+        if len(leaves) < 2:
+            continue
+
+        # Flood the rest of the detection from the branches
+        markers = np.zeros(img.shape, dtype=np.int32)
+        for j, leaf in enumerate(leaves, 1):
+            markers[leaf] = j
+        cost = np.round((peak - img) / peak * 65535.).astype(np.uint16)
+        owner = ndimage.watershed_ift(cost, markers, structure=eight)
+        blended[i] = True
+        view = labels[box]
+        for j in range(2, len(leaves) + 1):
+            nobj += 1
+            view[obj & (owner == j)] = nobj
+            new_ids.append(nobj)
+    if new_ids:
+        blended = np.concatenate([blended, np.ones(len(new_ids),
+                                                   dtype=bool)])
+    return labels, nobj, blended
+
+
+def extract_sources(image, thresh=1.5, minarea=10, conv=DEFAULT_CONV,
+                    back_size=64, back_filtersize=3, satur_level=50000.,
+                    mag_zeropoint=0., deblend_nthresh=32,
+                    deblend_mincont=0.005):
+    """
+    Detect sources and measure them in process, producing the catalog
+    columns our SExtractor configuration writes (1-based pixel positions).
+    The defaults are those of daofind.sex, read_config gives the settings
+    of another configuration.
+
+    :param image: 2D image array
+    :param thresh: detection threshold in background sigmas
+    :param minarea: minimum number of pixels above threshold
+    :param conv: detection filter kernel or None
+    :param back_size: background mesh size
+    :param back_filtersize: background mesh median filter size
+    :param satur_level: raw level at which a source is flagged saturated
+    :param mag_zeropoint: magnitude zero point
+    :param deblend_nthresh: number of deblending sub-thresholds
+    :param deblend_mincont: minimum contrast for deblending
+    :return: pandas DataFrame with one row per source
+    """
+    data = np.asarray(image, dtype=np.float32)
+    bkg, rms = background(data, box=back_size, filter_size=back_filtersize)
+    sub = data - bkg
+
+    if conv is not None:
+        detect = ndimage.convolve(sub, conv / conv.sum(), mode='nearest')
+    else:
+        detect = sub
+    labels, nobj = ndimage.label(detect > thresh * rms,
+                                 structure=np.ones((3, 3)))
+    if nobj == 0 or rms <= 0:
+        return pd.DataFrame(columns=CATALOG_COLUMNS)
+    labels, nobj, blended = deblend(detect, labels, nobj, thresh * rms,
+                                    nthresh=deblend_nthresh,
+                                    mincont=deblend_mincont, minarea=minarea)
+
+    # Work only on detected pixels; per-object sums via bincount
+    ys, xs = np.nonzero(labels)
+    lab = labels[ys, xs]
+    val = sub[ys, xs]
+    w = np.clip(val, 0, None)
+    nbin = nobj + 1
+
+    npix = np.bincount(lab, minlength=nbin)
+    flux = np.bincount(lab, weights=val, minlength=nbin)
+    wsum = np.bincount(lab, weights=w, minlength=nbin)
+    good = (npix >= minarea) & (wsum > 0) & (flux > 0)
+    good[0] = False
+    wsum[~good] = 1.
+
+    xm = np.bincount(lab, weights=w * xs, minlength=nbin) / wsum
+    ym = np.bincount(lab, weights=w * ys, minlength=nbin) / wsum
+    dx = xs - xm[lab]
+    dy = ys - ym[lab]
+    x2 = np.bincount(lab, weights=w * dx * dx, minlength=nbin) / wsum
+    y2 = np.bincount(lab, weights=w * dy * dy, minlength=nbin) / wsum
+    xy = np.bincount(lab, weights=w * dx * dy, minlength=nbin) / wsum
+
+    # Ellipse parameters from second moments as in SExtractor
+    mean2 = (x2 + y2) / 2.
+    diff = np.sqrt(((x2 - y2) / 2.) ** 2 + xy ** 2)
+    a = np.sqrt(np.clip(mean2 + diff, 0, None))
+    b = np.sqrt(np.clip(mean2 - diff, 0, None))
+    theta = np.degrees(0.5 * np.arctan2(2. * xy, x2 - y2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ellip = np.where(a > 0, 1. - b / a, 0.)
+
+    # FWHM from the area above half of the object peak
+    index = np.arange(nbin)
+    peak = np.zeros(nbin)
+    peak[1:] = ndimage.maximum(sub, labels, index[1:])
+    half = val >= 0.5 * peak[lab]
+    half_area = np.bincount(lab[half], minlength=nbin)
+    fwhm = 2. * np.sqrt(half_area / np.pi)
+
+    flags = np.zeros(nbin, dtype=int)
+    flags[blended] |= FLAG_BLENDED
+    raw_peak = np.zeros(nbin)
+    raw_peak[1:] = ndimage.maximum(data, labels, index[1:])
+    flags[raw_peak >= satur_level] |= FLAG_SATURATED
+    ny, nx = data.shape
+    edge = (xs == 0) | (ys == 0) | (xs == nx - 1) | (ys == ny - 1)
+    flags[np.bincount(lab[edge], minlength=nbin) > 0] |= FLAG_TRUNCATED
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mag = mag_zeropoint - 2.5 * np.log10(flux)
+        magerr = 1.0857 * np.sqrt(npix) * rms / flux
+
+    xc = np.clip(np.rint(xm).astype(int), 0, nx - 1)
+    yc = np.clip(np.rint(ym).astype(int), 0, ny - 1)
+
+    sel = np.nonzero(good)[0]
+    df = pd.DataFrame({
+        'NUMBER': np.arange(1, len(sel) + 1),
+        'X_IMAGE': xm[sel] + 1.,
+        'Y_IMAGE': ym[sel] + 1.,
+        'MAG_BEST': mag[sel],
+        'MAGERR_BEST': magerr[sel],
+        'FLUX_BEST': flux[sel],
+        'FWHM_IMAGE': fwhm[sel],
+        'ELLIPTICITY': ellip[sel],
+        'BACKGROUND': bkg[yc[sel], xc[sel]],
+        'FLAGS': flags[sel],
+        'A_IMAGE': a[sel],
+        'B_IMAGE': b[sel],
+        'THETA_IMAGE': theta[sel],
+        'ISOAREA_IMAGE': npix[sel]}, columns=CATALOG_COLUMNS)
+    return df
@@ -5,10 +5,13 @@ import time
 from astropy.io import ascii, fits
 import json
 import numpy as np
+import pandas as pd
 import subprocess
 import shutil
+import threading
 from matplotlib import pylab as plt
 from utils import rc_focus
+from sky.sextractor import extract
 
 SITE_ROOT = os.path.abspath(os.path.dirname(__file__)+'/../..')
 
@@ -38,6 +41,11 @@ class sextractor:
         self.default_config = params["config_file"]
         self.arc_config = params["arc_config_file"]
         self.default_cat_path = params["default_path"]
+        # Detect sources with numpy instead of the sextractor executable,
+        # with the settings of the same .sex files
+        self.in_process = params.get("in_process", False)
+        self.extract_params = None
+        self.arc_extract_params = None
         self.run_sex_cmd = "%s -c %s " % (self.sex_exec, self.default_config)
         self.run_arc_sex_cmd = "%s -c %s " % (self.sex_exec, self.arc_config)
 
@@ -48,9 +56,66 @@ class sextractor:
         self.arc_y_min = 800
         self.arc_y_max = 1800
 
+    @staticmethod
+    def _extract_params(sex_file):
+        try:
+            return extract.read_config(sex_file)
+        except (OSError, ValueError) as e:
+            print("sex.extract_catalog - unable to read %s, using the "
+                  "daofind defaults: %s" % (sex_file, str(e)))
+            return {}
+
+    def extract_catalog(self, input_image, arc=False):
+        """
+        Build the catalog in process with extract.extract_sources
+
+        :param input_image: fits image to analyze
+        :param arc: arc lamp image, use the arc_config_file settings
+        :return: dict with the catalog DataFrame in 'data'
+        """
+        if arc:
+            print("sex.extract_catalog - extracting arc image")
+            if self.arc_extract_params is None:
+                self.arc_extract_params = self._extract_params(
+                    self.arc_config)
+            kwargs = dict(self.arc_extract_params)
+        else:
+            if self.extract_params is None:
+                self.extract_params = self._extract_params(
+                    self.default_config)
+            kwargs = dict(self.extract_params)
+        start = time.time()
+        try:
+            with fits.open(input_image) as hdul:
+                data = hdul[0].data
+                # SATUR_KEY wins over SATUR_LEVEL as in sextractor
+                kwargs['satur_level'] = hdul[0].header.get(
+                    'SATURATE', kwargs.get('satur_level', 50000.))
+                df = extract.extract_sources(data, **kwargs)
+        except Exception as e:
+            return {"elaptime": time.time()-start,
+                    "error": "Unable to extract %s: %s" % (input_image,
+                                                           str(e))}
+        df.attrs['image'] = input_image
+        return {"elaptime": time.time()-start,
+                "data": df}
+
+    @staticmethod
+    def read_catalog(catalog):
+        """Catalog DataFrame from a run() result or a catalog file"""
+        if isinstance(catalog, pd.DataFrame):
+            return catalog.copy()
+        return ascii.read(catalog).to_pandas()
+
+    @staticmethod
+    def _region_file(catalog):
+        if isinstance(catalog, pd.DataFrame):
+            return catalog.attrs.get('image', 'catalog') + '.reg'
+        return catalog + '.reg'
+
     def run(self, input_image, output_file=None, save_in_seperate_dir=True,
             output_type=None, create_region_file=True, overwrite=False,
-            arc=False):
+            arc=False, in_process=None):
 
         """
 
@@ -61,6 +126,8 @@ class sextractor:
         :param create_region_file:
         :param overwrite:
         :param arc:
+        :param in_process: return a DataFrame from extract_catalog instead
+                           of running sextractor (default from config)
         :return:
         """
         if output_type:
@@ -70,7 +137,12 @@ class sextractor:
         # 1. Start by making sure the input file exists
         if not os.path.exists(input_image):
             return {"elaptime": time.time()-start,
-                    "error": "%s does not exists"}
+                    "error": "%s does not exists" % input_image}
+
+        if in_process is None:
+            in_process = self.in_process
+        if in_process:
+            return self.extract_catalog(input_image, arc=arc)
 
         # 2. If no output file is given then we append to the original file
         # name
@@ -92,9 +164,13 @@ class sextractor:
 
         # 3. If we made it here then it's time to run the command.
 
+        # Each run writes its own catalog, runs from other threads (the
+        # FWHM index, focus jobs) would otherwise clobber a shared one
+        cat_path = "%s.%d.%d" % (self.default_cat_path, os.getpid(),
+                                 threading.get_ident())
         # Let's just make sure there are no old files in place
-        if os.path.exists(self.default_cat_path):
-            os.remove(self.default_cat_path)
+        if os.path.exists(cat_path):
+            os.remove(cat_path)
 
         if arc:
             print("sex.run - running sextractor on arc image")
@@ -102,6 +178,7 @@ class sextractor:
         else:
             print("sex.run - running sextractor on star image")
             run_sex_cmd = self.run_sex_cmd
+        run_sex_cmd += "-CATALOG_NAME %s " % cat_path
         # Run the sextractor command
         try:
             subprocess.call("%s %s" % (run_sex_cmd, input_image),
@@ -114,11 +191,11 @@ class sextractor:
 
         # 4. If everything ran successfully
         # we should have a new file called image.cat
-        if not os.path.exists(self.default_cat_path):
+        if not os.path.exists(cat_path):
             return {'elaptime': time.time()-start,
                     'error': "Unable to run the sextractor command"}
         print("sex.run - putting catalog in", output_file)
-        shutil.move(self.default_cat_path, output_file)
+        shutil.move(cat_path, output_file)
 
         if create_region_file:
             reg_file = output_file + '.reg'
@@ -137,12 +214,10 @@ class sextractor:
 
         start = time.time()
 
-        if not os.path.exists(catalog):
+        if isinstance(catalog, str) and not os.path.exists(catalog):
             return {"elaptime": time.time()-start,
                     "error": "%s does not exist" % catalog}
-        cdata = ascii.read(catalog)
-
-        df = cdata.to_pandas()
+        df = self.read_catalog(catalog)
         df = df[(df['Y_IMAGE'] < self.arc_y_max) &
                 (df['Y_IMAGE'] > self.arc_y_min)]
         df = df[(df['X_IMAGE'] < self.arc_x_max) &
@@ -155,7 +230,7 @@ class sextractor:
         df = df[(df['B_IMAGE'] > size_cut_lo)]
 
         if create_region_file:
-            reg_file = catalog + '.reg'
+            reg_file = self._region_file(catalog)
             cdata = open(reg_file, 'w')
             for ind in df.index:
                 cdata.write("circle(%s, %s, %s\n" % (df["X_IMAGE"][ind],
@@ -205,12 +280,10 @@ class sextractor:
 
         start = time.time()
 
-        if not os.path.exists(catalog):
+        if isinstance(catalog, str) and not os.path.exists(catalog):
             return {"elaptime": time.time()-start,
                     "error": "%s does not exist" % catalog}
-        cdata = ascii.read(catalog)
-
-        df = cdata.to_pandas()
+        df = self.read_catalog(catalog)
         mag = df['MAG_BEST'].quantile(mag_quantile)
         ellip = df['ELLIPTICITY'].quantile(ellp_quantile)
         df = df[(df['MAG_BEST'] < mag) & (df['ELLIPTICITY'] < ellip)]
@@ -221,7 +294,7 @@ class sextractor:
         df = df[(df['FWHM_IMAGE'] < size_cut)]
 
         if create_region_file:
-            reg_file = catalog + '.reg'
+            reg_file = self._region_file(catalog)
             cdata = open(reg_file, 'w')
             for ind in df.index:
                 cdata.write("circle(%s, %s, %s\n" % (df["X_IMAGE"][ind],
@@ -245,9 +318,7 @@ class sextractor:
             if 'data' in cret:
                 catalog = cret['data']
         # print(catalog)
-        cdata = ascii.read(catalog)
-
-        df = cdata.to_pandas()
+        df = self.read_catalog(catalog)
         avgfwhm = 0
         print("sex.get_fwhm")
         if do_filter:
@@ -264,7 +335,7 @@ class sextractor:
             df = df[0:5]
 
             if create_region_file:
-                reg_file = catalog + '.reg'
+                reg_file = self._region_file(catalog)
                 rdata = open(reg_file, 'w')
                 for ind in df.index:
                     rdata.write("circle(%s, %s, %s\n" % (df["X_IMAGE"][ind],
@@ -0,0 +1,97 @@
+import os
+import sys
+import json
+import types
+import importlib.util
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+# Modules the scheduler imports at load time
+SCHEDULER_MODULES = ('numpy', 'pandas', 'scipy', 'matplotlib', 'astropy',
+                     'astroplan', 'psycopg2', 'requests')
+
+# Palomar, as in astropy's site registry
+PALOMAR = {'lon': -116.863, 'lat': 33.356, 'height': 1706.}
+
+
+def _request_row(req_id, ra, dec, priority=1., obs_seq=('1ifu',),
+                 exptime=(600,)):
+    return {'req_id': req_id, 'obj_id': 1000 + req_id,
+            'objname': 'target%d' % req_id, 'ra': ra, 'dec': dec,
+            'typedesig': 'f', 'priority': priority,
+            'obs_seq': list(obs_seq), 'exptime': list(exptime),
+            'seq_repeats': 1, 'seq_completed': 0, 'maxairmass': None,
+            'status': 'PENDING', 'inidate': '2020-01-01',
+            'enddate': '2099-12-31', 'lastmodified': '2020-01-01 00:00:00',
+            'allocation_id': 1, 'designator': 'test', 'marshal_id': -1}
+
+
+@pytest.fixture
+def request_table():
+    """Function making a request table like the target query from a list
+    of (ra, dec, priority) tuples"""
+    pd = pytest.importorskip('pandas')
+
+    def make(targets, **kwargs):
+        return pd.DataFrame([_request_row(i + 1, ra, dec, priority, **kwargs)
+                             for i, (ra, dec, priority)
+                             in enumerate(targets)])
+    return make
+
+
+@pytest.fixture
+def scheduler_config(tmp_path, monkeypatch):
+    """Absolute path of a scheduler config whose directories are in
+    tmp_path, the scheduler joins it to the config directory unchanged.
+    The site comes from PALOMAR rather than astropy's online registry and
+    sedmpy's db package, only used with the database, may be missing."""
+    for name in SCHEDULER_MODULES:
+        pytest.importorskip(name)
+    from astropy import units as u
+    from astropy.coordinates import EarthLocation
+    from astropy.utils import iers
+    iers.conf.auto_download = False
+
+    palomar = EarthLocation.from_geodetic(PALOMAR['lon'] * u.deg,
+                                          PALOMAR['lat'] * u.deg,
+                                          PALOMAR['height'] * u.m)
+    of_site = EarthLocation.of_site
+
+    def offline_site(cls, site_name, *args, **kwargs):
+        if site_name.lower() == 'palomar':
+            return palomar
+        return of_site(site_name, *args, **kwargs)
+    monkeypatch.setattr(EarthLocation, 'of_site', classmethod(offline_site))
+
+    if importlib.util.find_spec('db') is None:
+        sedm_db = types.ModuleType('db.SedmDb')
+        sedm_db.SedmDB = None
+        db = types.ModuleType('db')
+        db.SedmDb = sedm_db
+        monkeypatch.setitem(sys.modules, 'db', db)
+        monkeypatch.setitem(sys.modules, 'db.SedmDb', sedm_db)
+
+    params = {'dbconn': {},
+              'standard_db': str(tmp_path / 'standards.sql'),
+              'target_dir': str(tmp_path),
+              'rc_images_dir': str(tmp_path / 'images')}
+    config = tmp_path / 'schedulerconfig.json'
+    config.write_text(json.dumps(params))
+    return str(config)
+
+
+@pytest.fixture
+def offline_scheduler(tmp_path, scheduler_config, request_table):
+    """Function making a Scheduler that reads a request table from a
+    sqlite snapshot instead of the database"""
+    from sky.scheduler.dbscheduler import Scheduler
+    from sky.scheduler.queue_snapshot import save_snapshot
+
+    def make(targets):
+        snapshot = str(tmp_path / 'snapshot.db')
+        save_snapshot(request_table(targets), snapshot)
+        return Scheduler(config=scheduler_config, snapshot=snapshot)
+    return make
@@ -0,0 +1,61 @@
+import csv
+import functools
+import multiprocessing
+import pytest
+
+NIGHT = '2026-03-15'
+# Spread over the sky that is up on a March night
+TARGETS = [(ra, 20. + ra % 40., 1. + (ra // 30) % 3)
+           for ra in range(60, 300, 15)]
+SUMMARY_FIELDS = ('targets', 'science_time', 'idle_time', 'shutter_time',
+                  'open_shutter_fraction', 'mean_airmass', 'mean_slew',
+                  'priorities')
+
+
+@pytest.fixture
+def snapshot(tmp_path, scheduler_config, request_table):
+    from sky.scheduler.queue_snapshot import save_snapshot
+    path = str(tmp_path / 'snapshot.db')
+    assert save_snapshot(request_table(TARGETS), path) == len(TARGETS)
+    return path
+
+
+def test_run_batch(tmp_path, snapshot, scheduler_config, monkeypatch):
+    from concurrent.futures import ProcessPoolExecutor
+    from sky.scheduler import batch_runner
+    from sky.scheduler.batch_runner import run_batch, write_results
+
+    # The offline site and sedmpy stand-ins only exist in this process
+    monkeypatch.setattr(batch_runner, 'ProcessPoolExecutor', functools.partial(
+        ProcessPoolExecutor, mp_context=multiprocessing.get_context('fork')))
+
+    variants = {'base': {}, 'low_airmass': {'airmass': (1, 1.5)}}
+    results = run_batch(snapshot, [NIGHT], variants, processes=1,
+                        config=scheduler_config)
+
+    assert [(r['night'], r['variant']) for r in results] == \
+        [(NIGHT, 'base'), (NIGHT, 'low_airmass')]
+    for r in results:
+        assert 'error' not in r, r.get('error')
+        summary = r['summary']
+        assert set(SUMMARY_FIELDS) <= set(summary)
+        science = [e for e in r['schedule'] if e['type'] == 'science']
+        assert summary['targets'] == len(science) > 0
+        assert len({e['req_id'] for e in science}) == len(science)
+        assert 0 < summary['open_shutter_fraction'] <= 1
+        assert summary['shutter_time'] <= summary['science_time']
+        assert sum(summary['priorities'].values()) == summary['targets']
+
+    # Targets are taken while they meet the variant's airmass limit
+    for e in results[1]['schedule']:
+        if e['type'] == 'science':
+            assert min(e['start_airmass'], e['end_airmass']) <= 1.6
+    base = results[0]['summary']
+
+    path = str(tmp_path / 'results.csv')
+    write_results(results, path)
+    with open(path) as infile:
+        rows = list(csv.DictReader(infile))
+    assert [row['variant'] for row in rows] == ['base', 'low_airmass']
+    assert int(rows[0]['targets']) == base['targets']
+    assert not any(row['error'] for row in rows)
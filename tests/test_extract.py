@@ -0,0 +1,91 @@
+import os
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+pytest.importorskip('scipy')
+
+from conftest import ROOT_DIR
+from sky.sextractor import extract
+
+SIGMA = 2.5
+FWHM = 2.3548 * SIGMA
+# (x, y, amplitude), 0-based pixel positions
+STARS = [(60.3, 70.6, 2000.), (180.5, 50.2, 1000.), (120.8, 190.4, 4000.)]
+SATURATED = (200.2, 200.7, 60000.)
+EDGE = (1.0, 120.3, 2000.)
+PAIR = [(60.4, 180.5, 2000.), (68.6, 180.3, 2000.)]
+
+
+def _image(stars, seed=7):
+    rng = np.random.default_rng(seed)
+    ny, nx = 256, 256
+    y, x = np.mgrid[:ny, :nx]
+    image = 100. + rng.normal(0., 5., (ny, nx))
+    for x0, y0, amp in stars:
+        image += amp * np.exp(-((x - x0) ** 2 + (y - y0) ** 2) /
+                              (2 * SIGMA ** 2))
+    return np.clip(image, 0, 65535).astype(np.float32)
+
+
+def _match(cat, x0, y0, tol=1.):
+    """Catalog row nearest a 0-based position"""
+    d = np.hypot(cat['X_IMAGE'] - 1 - x0, cat['Y_IMAGE'] - 1 - y0)
+    row = cat.iloc[int(np.argmin(d.values))]
+    assert d.min() < tol
+    return row
+
+
+@pytest.fixture(scope='module')
+def catalog():
+    return extract.extract_sources(
+        _image(STARS + [SATURATED, EDGE] + PAIR), satur_level=50000.)
+
+
+def test_isolated_stars(catalog):
+    assert list(catalog.columns) == extract.CATALOG_COLUMNS
+    assert len(catalog) >= len(STARS) + 4
+    for x0, y0, amp in STARS:
+        row = _match(catalog, x0, y0)
+        assert abs(row['X_IMAGE'] - 1 - x0) < 0.1
+        assert abs(row['Y_IMAGE'] - 1 - y0) < 0.1
+        assert row['FWHM_IMAGE'] == pytest.approx(FWHM, rel=0.15)
+        assert row['ELLIPTICITY'] < 0.1
+        assert row['FLAGS'] == 0
+        assert row['BACKGROUND'] == pytest.approx(100., abs=2.)
+        # The isophote misses only the faint wings
+        total = 2 * np.pi * SIGMA ** 2 * amp
+        assert 0.8 * total < row['FLUX_BEST'] <= 1.05 * total
+
+    mags = [_match(catalog, x0, y0)['MAG_BEST'] for x0, y0, _ in STARS]
+    assert mags[2] < mags[0] < mags[1]
+
+
+def test_flags(catalog):
+    assert _match(catalog, *SATURATED[:2])['FLAGS'] & \
+        extract.FLAG_SATURATED
+    # Half of it is off the image, which pulls the centroid in
+    assert _match(catalog, *EDGE[:2], tol=3.)['FLAGS'] & \
+        extract.FLAG_TRUNCATED
+    for x0, y0, _ in PAIR:
+        row = _match(catalog, x0, y0)
+        assert row['FLAGS'] & extract.FLAG_BLENDED
+        assert abs(row['X_IMAGE'] - 1 - x0) < 0.5
+
+
+def test_blank_image():
+    cat = extract.extract_sources(_image([]))
+    assert len(cat) == 0
+    assert list(cat.columns) == extract.CATALOG_COLUMNS
+
+
+def test_read_config():
+    config_dir = os.path.join(ROOT_DIR, 'config', 'sedm_sextractor_config')
+    kwargs = extract.read_config(os.path.join(config_dir, 'daofind.sex'))
+    assert kwargs['thresh'] == 1.5
+    assert kwargs['minarea'] == 10
+    assert kwargs['back_size'] == 64
+    assert kwargs['deblend_nthresh'] == 32
+    assert kwargs['satur_level'] == 50000.
+    # The installed path does not exist here, the copy beside it is used
+    assert np.array_equal(kwargs['conv'], extract.DEFAULT_CONV)
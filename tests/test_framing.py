@@ -0,0 +1,85 @@
+import socket
+import threading
+import pytest
+from utils import framing
+
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+
+def _send_in_thread(sock, body):
+    # Large bodies would fill the socket buffer before anyone reads
+    t = threading.Thread(target=framing.send_message, args=(sock, body))
+    t.start()
+    return t
+
+
+@pytest.mark.parametrize('body', [
+    {'command': 'STATUS', 'args': [1, 2.5, None], 'name': 'résumé'},
+    [],
+    b'',
+    b'\x00\xff' * 10,
+    b'x' * 70000,
+    {'data': 'y' * 100000},
+])
+def test_round_trip(pair, body):
+    a, b = pair
+    t = _send_in_thread(a, body)
+    assert framing.recv_message(b) == body
+    t.join()
+
+
+def test_messages_keep_their_boundaries(pair):
+    a, b = pair
+    bodies = [{'n': i} if i % 2 else b'%d' % i for i in range(10)]
+    for body in bodies:
+        framing.send_message(a, body)
+    assert [framing.recv_message(b) for _ in bodies] == bodies
+
+
+def test_clean_close_returns_none(pair):
+    a, b = pair
+    a.close()
+    assert framing.recv_message(b) is None
+
+
+def test_short_header(pair):
+    a, b = pair
+    a.sendall(framing.HEADER.pack(framing.JSON_BODY, 10)[:3])
+    a.close()
+    with pytest.raises(framing.FramingError):
+        framing.recv_message(b)
+
+
+def test_short_body(pair):
+    a, b = pair
+    a.sendall(framing.HEADER.pack(framing.BINARY_BODY, 10) + b'12345')
+    a.close()
+    with pytest.raises(framing.FramingError, match='5 of 10'):
+        framing.recv_message(b)
+
+
+def test_bad_body_type(pair):
+    a, b = pair
+    a.sendall(framing.HEADER.pack(b'X', 2) + b'{}')
+    with pytest.raises(framing.FramingError):
+        framing.recv_message(b)
+
+
+def test_oversize_body_is_refused(pair, monkeypatch):
+    a, b = pair
+    monkeypatch.setattr(framing, 'MAX_MESSAGE_SIZE', 16)
+    with pytest.raises(ValueError):
+        framing.send_message(a, b'x' * 17)
+    framing.send_message(a, b'x' * 16)
+    assert framing.recv_message(b) == b'x' * 16
+
+    # A header announcing more than the limit is rejected before reading
+    a.sendall(framing.HEADER.pack(framing.BINARY_BODY, 17))
+    with pytest.raises(framing.FramingError):
+        framing.recv_message(b)
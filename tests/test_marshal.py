@@ -0,0 +1,158 @@
+import re
+import json
+import time
+import threading
+import pytest
+
+pytest.importorskip('requests')
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sky.growth.marshal import Interface
+
+
+class Stub(ThreadingHTTPServer):
+    """The dbhost id lookup and the marshal status page"""
+
+    def __init__(self):
+        super().__init__(('localhost', 0), StubHandler)
+        self.received = 0
+        self.lookups = []
+        self.posts = []
+        # Status codes to answer the next marshal posts with, then 200
+        self.codes = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.url = 'http://localhost:%d' % self.server_port
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        stub = self.server
+        stub.received += 1
+        stub.gate.wait(10)
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path == '/get_marshal_id':
+            request_id = json.loads(body)['request_id']
+            stub.lookups.append(request_id)
+            code, reply = 200, {'marshal_id': 1000 + request_id}
+        else:
+            status = json.loads(
+                re.search(rb'\{[^{}]*"new_status"[^{}]*\}', body).group())
+            stub.posts.append((time.time(), status['request_id'],
+                               status['new_status']))
+            code = stub.codes.pop(0) if stub.codes else 200
+            reply = {}
+        self.send_response(code)
+        self.end_headers()
+        self.wfile.write(json.dumps(reply).encode())
+
+
+@pytest.fixture
+def stub():
+    server = Stub()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.gate.set()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def interface(stub, tmp_path):
+    made = []
+
+    def make(**kwargs):
+        growth = Interface(dbhost_get_url=stub.url + '/get_marshal_id',
+                           growth_url=stub.url + '/update', timeout=5,
+                           outbox_file=str(tmp_path / 'outbox.db'),
+                           **kwargs)
+        made.append(growth)
+        return growth
+    yield make
+    for growth in made:
+        if not growth.stopped.is_set():
+            growth.close()
+
+
+def _wait_for(condition, timeout=10):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def test_updates_coalesce_on_the_growth_id(stub, interface):
+    growth = interface()
+    stub.gate.clear()
+    # The sender holds this one while it looks up the growth id
+    growth.update_growth_status(request_id=7, message='ACTIVE')
+    assert _wait_for(lambda: stub.received == 1)
+    growth.update_growth_status(request_id=7, message='OBSERVED')
+    growth.update_growth_status(growth_id=1007, message='COMPLETED')
+    stub.gate.set()
+
+    assert _wait_for(lambda: growth.pending() == 0)
+    assert [(g, m) for _, g, m in stub.posts] == [(1007, 'COMPLETED')]
+
+    # Known now, queued straight under the growth id
+    lookups = len(stub.lookups)
+    growth.update_growth_status(request_id=7, message='PENDING')
+    assert _wait_for(lambda: growth.pending() == 0)
+    assert len(stub.lookups) == lookups
+    assert stub.posts[-1][1:] == (1007, 'PENDING')
+
+
+def test_retry_with_backoff_on_server_errors(stub, interface):
+    growth = interface(retry_delay=0.2)
+    stub.codes = [503, 502]
+    growth.update_growth_status(growth_id=1001, message='ACTIVE')
+
+    assert _wait_for(lambda: len(stub.posts) == 3 and
+                     growth.pending() == 0)
+    times = [t for t, _, _ in stub.posts]
+    assert times[1] - times[0] >= 0.2
+    assert times[2] - times[1] >= 0.4
+    assert all(m == 'ACTIVE' for _, _, m in stub.posts)
+
+
+def test_gives_up_after_max_attempts(stub, interface):
+    growth = interface(retry_delay=0.1, max_attempts=2)
+    stub.codes = [500] * 5
+    growth.update_growth_status(growth_id=1002, message='ACTIVE')
+    assert _wait_for(lambda: growth.pending() == 0)
+    time.sleep(0.3)
+    assert len(stub.posts) == 2
+
+
+def test_close_keeps_unsent_updates(stub, interface):
+    growth = interface(retry_delay=60)
+    stub.codes = [503]
+    growth.update_growth_status(growth_id=1003, message='ACTIVE')
+    assert _wait_for(lambda: len(stub.posts) == 1)
+    growth.close()
+    assert not growth.sender.is_alive()
+
+    # The next interface on the file takes over and sends it
+    growth = interface()
+    assert growth.sender is not None
+    assert growth.pending() == 1
+    with growth.outbox_lock:
+        growth.outbox.execute("UPDATE outbox SET next_try = 0")
+        growth.outbox.commit()
+    growth.wake.set()
+    assert _wait_for(lambda: growth.pending() == 0)
+    assert stub.posts[-1][1:] == (1003, 'ACTIVE')
+
+
+def test_one_sender_per_file(interface):
+    first = interface()
+    second = interface()
+    assert first.sender is not None and second.sender is None
+    assert second._sender() is first
+    first.close()
+    assert second._sender() is second
@@ -0,0 +1,86 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('astropy')
+astroplan = pytest.importorskip('astroplan')
+
+from astropy import units as u
+from astropy.coordinates import AltAz, EarthLocation, SkyCoord
+from astropy.time import Time, TimeDelta
+from astropy.utils import iers
+from conftest import PALOMAR
+from sky.scheduler.night_grid import NightGrid
+
+iers.conf.auto_download = False
+
+START = Time('2026-03-16 02:00:00')
+END = START + TimeDelta(11 * 3600, format='sec')
+# Clear of the zenith, where altitude curves too fast to interpolate
+RA = np.array([10., 95.5, 150., 201.25, 330.])
+DEC = np.array([-20., 5., 60., 15.5, -5.])
+
+
+@pytest.fixture(scope='module')
+def observer():
+    location = EarthLocation.from_geodetic(PALOMAR['lon'] * u.deg,
+                                           PALOMAR['lat'] * u.deg,
+                                           PALOMAR['height'] * u.m)
+    return astroplan.Observer(location=location)
+
+
+@pytest.fixture(scope='module')
+def grid(observer):
+    return NightGrid(observer, START, END, step=300)
+
+
+def _direct(observer, ra, dec, jd):
+    times = Time(jd, format='jd')
+    altaz = SkyCoord(ra=ra, dec=dec, unit='deg').transform_to(
+        AltAz(obstime=times, location=observer.location))
+    lst = observer.local_sidereal_time(times).deg
+    return altaz.alt.deg, np.asarray(altaz.secz), (lst - ra) % 360.
+
+
+def _ha_diff(a, b):
+    return np.abs((a - b + 180.) % 360. - 180.)
+
+
+@pytest.mark.parametrize('offset', [0., 0.5, 0.37])
+def test_lookup_matches_altaz(observer, grid, offset):
+    # On the grid points and between them
+    jd = grid.jd[3:-3:7] + offset * grid.step_jd
+    for ra, dec in zip(RA, DEC):
+        alt, secz, ha = grid.lookup(np.full(len(jd), ra),
+                                    np.full(len(jd), dec), jd)
+        d_alt, d_secz, d_ha = _direct(observer, ra, dec, jd)
+        tol = 1e-6 if offset == 0 else 0.02
+        assert np.allclose(alt, d_alt, atol=tol, rtol=0)
+        up = d_alt > 15
+        assert np.allclose(secz[up], d_secz[up], rtol=1e-3)
+        assert _ha_diff(ha, d_ha).max() < 1e-3
+
+
+def test_lookup_shapes(grid):
+    jd = np.stack([np.full(len(RA), grid.jd[10]), np.full(len(RA),
+                                                          grid.jd[40])],
+                  axis=1)
+    alt, secz, ha = grid.lookup(RA, DEC, jd)
+    assert alt.shape == secz.shape == ha.shape == (len(RA), 2)
+
+    # A scalar time is shared by every target
+    alt0, _, _ = grid.lookup(RA, DEC, grid.jd[10])
+    assert np.allclose(alt0, alt[:, 0])
+
+
+def test_targets_are_added_once(grid):
+    grid.lookup(RA, DEC, grid.jd[0])
+    rows = grid.alt.shape[0]
+    assert grid.add_targets(RA, DEC) == 0
+    assert grid.add_targets([RA[0], 12.], [DEC[0], 12.]) == 1
+    assert grid.alt.shape[0] == rows + 1 == len(grid.keys)
+
+
+def test_covers(grid):
+    assert grid.covers([grid.jd[0], grid.jd[-1]])
+    assert not grid.covers(grid.jd[-1] + 1e-3)
+    assert not grid.covers([])
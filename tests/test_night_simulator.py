@@ -0,0 +1,68 @@
+import pytest
+
+NIGHT = '2026-03-15'
+
+
+@pytest.fixture
+def night(offline_scheduler):
+    """Scheduler, start and end of the night and the LST at the start"""
+    sched = offline_scheduler([(180., 30., 1.)])
+    times = sched.night_times(NIGHT)
+    start, end = times['evening_nautical'], times['morning_astronomical']
+    lst = float(sched.get_night_grid(start).lst_at(start.jd))
+    return sched, start, end, lst
+
+
+def _simulate(sched, start, end, table, **kwargs):
+    from sky.scheduler.night_simulator import NightSimulator
+    targets = sched.initialize_targets(table, obstime=start)['data']
+    return NightSimulator(sched, targets, **kwargs).run(start, end)
+
+
+def test_fills_the_night(night, request_table):
+    sched, start, end, lst = night
+    # A high priority target on the meridian at the start, a spread of
+    # ordinary ones through the night and one that never rises
+    targets = [(lst, 33., 5.), (0., -80., 5.)] + \
+        [((lst + h * 15.) % 360., 20., 1.) for h in range(0, 11)]
+    result = _simulate(sched, start, end, request_table(targets))
+    schedule = result['schedule']
+
+    assert [e['type'] for e in schedule[:2]] == ['focus', 'standard']
+    for prev, e in zip(schedule, schedule[1:]):
+        assert e['start'] == prev['end']
+
+    science = [e for e in schedule if e['type'] == 'science']
+    assert science[0]['req_id'] == 1
+    assert 2 not in [e['req_id'] for e in science]
+    assert len({e['req_id'] for e in science}) == len(science)
+    for e in science:
+        assert max(e['start_alt'], e['end_alt']) >= 15
+        assert min(e['start_airmass'], e['end_airmass']) <= 2.8
+        assert e['shutter'] == 600.
+        # A slew longer than the fitted setup only adds to the total
+        assert e['duration'] >= e['total']
+
+    summary = result['summary']
+    assert summary['targets'] == len(science)
+    assert summary['shutter_time'] == 600. * len(science)
+    assert summary['science_time'] == pytest.approx(
+        sum(e['duration'] for e in science))
+    assert 0 < summary['open_shutter_fraction'] < 1
+    assert summary['priorities'].get(5., 0) == 1
+
+
+def test_idle_when_nothing_is_up(night, request_table):
+    sched, start, end, lst = night
+    result = _simulate(sched, start, end, request_table([(0., -80., 1.)]),
+                       idle_step=600)
+    schedule = result['schedule']
+    assert {e['type'] for e in schedule[2:]} == {'idle'}
+    assert all(e['duration'] == 600 for e in schedule[2:])
+    assert schedule[-1]['end'] >= result['end']
+
+    summary = result['summary']
+    assert summary['targets'] == 0
+    assert summary['idle_time'] == 600. * (len(schedule) - 2)
+    assert summary['mean_airmass'] is None
+    assert summary['open_shutter_fraction'] == 0
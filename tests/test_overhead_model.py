@@ -0,0 +1,108 @@
+import os
+import datetime
+import pytest
+
+pytest.importorskip('numpy')
+fits = pytest.importorskip('astropy.io.fits')
+
+from sky.scheduler.overhead_model import (OverheadModel, DEFAULT_EXPOSURE,
+                                          DEFAULT_SETUP)
+
+NIGHT = datetime.datetime(2026, 3, 15, 12)
+JD0 = 2461115.
+
+# (gap before in s, req_id, camera, imgtype, readout, exptime, overhead)
+FRAMES = [
+    (0, 1, 'rc', 'science', 2.0, 60, 40),
+    (0, 1, 'rc', 'science', 2.0, 60, 42),
+    (100, 2, 'rc', 'science', 2.0, 60, 44),
+    (0, 2, 'ifu', 'science', 2.0, 900, 60),
+    (150, 3, 'ifu', 'science', 2.0, 900, 62),
+    (0, 3, 'rc', 'science', 2.0, 30, 46),
+    (200, 4, 'rc', 'standard', 2.0, 30, 48),
+    (0, 4, 'ifu', 'standard', 2.0, 120, 64),
+    (300, 5, 'ifu', 'science', 2.0, 900, 66),
+    (400, 6, 'ifu', 'science', 2.0, 900, 68),
+    # Idle for longer than max_setup, not a setup time
+    (1000, 7, 'ifu', 'science', 2.0, 900, 70),
+    # Calibrations at another readout speed, too few to be used
+    (5, -999, 'rc', 'bias', 0.1, 0, 10),
+    (5, -999, 'rc', 'bias', 0.1, 0, 11),
+    (5, -999, 'rc', 'bias', 0.1, 0, 12),
+    # Not a readout overhead
+    (5, -999, 'rc', 'bias', 0.1, 0, 700),
+]
+
+
+@pytest.fixture
+def image_dir(tmp_path):
+    night_dir = tmp_path / 'images' / NIGHT.strftime('%Y%m%d')
+    night_dir.mkdir(parents=True)
+    jd = JD0
+    for i, (gap, req_id, camera, imgtype, readout, exptime, overhead) in \
+            enumerate(FRAMES):
+        jd += gap / 86400.
+        hdu = fits.PrimaryHDU()
+        hdu.header['JD'] = jd
+        hdu.header['EXPTIME'] = exptime
+        hdu.header['ELAPTIME'] = exptime + overhead
+        hdu.header['ADCSPEED'] = readout
+        hdu.header['IMGTYPE'] = imgtype
+        hdu.header['REQ_ID'] = req_id
+        hdu.writeto(str(night_dir / ('%s%s_%03d.fits' % (
+            camera, NIGHT.strftime('%Y%m%d'), i))))
+        jd += (exptime + overhead) / 86400.
+    # Not a camera frame
+    fits.PrimaryHDU().writeto(str(night_dir / 'guider_000.fits'))
+    return str(tmp_path / 'images')
+
+
+def test_fit(tmp_path, image_dir):
+    model_file = str(tmp_path / 'overheads.json')
+    model = OverheadModel(model_file, image_dir, nights=3)
+    assert model.exposure('rc') == DEFAULT_EXPOSURE
+    assert model.setup() == DEFAULT_SETUP
+    assert model.age() == float('inf')
+
+    fitted = model.fit(end_date=NIGHT)
+    assert fitted['nights'] == [NIGHT.strftime('%Y%m%d')]
+    # Science frames of each camera, and every frame by readout speed
+    assert fitted['exposure']['rc'] == {'median': 44., 'n': 5}
+    assert fitted['exposure']['rc_2.0'] == {'median': 44., 'n': 5}
+    assert fitted['exposure']['ifu'] == {'median': 65., 'n': 6}
+    assert fitted['exposure']['rc_0.1'] == {'median': 11., 'n': 3}
+    assert model.exposure('rc') == 44.
+    assert model.exposure('ifu', readout=2.0) == 65.
+
+    # Gaps from the end of one request to its successor's first frame
+    assert fitted['setup']['target']['n'] == 5
+    assert model.setup() == pytest.approx(200.)
+
+    # Fewer frames than min_samples fall back to the defaults
+    assert model.exposure('rc', readout=0.1) == DEFAULT_EXPOSURE
+    assert 'rc_0.1' not in model.to_dict()['exposure']
+    assert model.age() < 60
+
+    # The saved model is used by the next start
+    again = OverheadModel(model_file, image_dir)
+    assert again.to_dict() == model.to_dict()
+
+
+def test_min_samples_and_max_setup(tmp_path, image_dir):
+    model = OverheadModel(str(tmp_path / 'overheads.json'), image_dir,
+                          nights=3, min_samples=6, max_setup=250)
+    fitted = model.fit(end_date=NIGHT)
+    # Only the 100, 150 and 200 s gaps are short enough
+    assert fitted['setup']['target']['n'] == 3
+    assert fitted['setup']['target']['median'] == pytest.approx(150.)
+    assert model.setup() == DEFAULT_SETUP
+    assert model.exposure('rc') == DEFAULT_EXPOSURE
+    assert model.exposure('ifu') == 65.
+
+
+def test_nights_outside_the_window(tmp_path, image_dir):
+    model = OverheadModel(str(tmp_path / 'overheads.json'), image_dir,
+                          nights=3)
+    fitted = model.fit(end_date=NIGHT + datetime.timedelta(days=5))
+    assert fitted['nights'] == []
+    assert fitted['exposure'] == {} and fitted['setup'] == {}
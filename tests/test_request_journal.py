@@ -0,0 +1,178 @@
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+
+from sky.scheduler import request_journal
+from sky.scheduler.request_journal import RequestJournal, open_journal
+
+
+class StatementGone(psycopg2.ProgrammingError):
+    """What the server raises for EXECUTE of an unknown statement"""
+    pgcode = '26000'
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, sql, args=None):
+        conn = self.conn
+        if conn.pool.down:
+            raise psycopg2.OperationalError("server closed the connection")
+        words = sql.split()
+        if words[0] == 'PREPARE':
+            conn.statements.add(words[1])
+        elif words[0] == 'EXECUTE':
+            if words[1] not in conn.statements:
+                raise StatementGone("prepared statement %s does not exist"
+                                    % words[1])
+            conn.pending.append((words[1], list(args)))
+        elif words[0] == 'SAVEPOINT':
+            conn.savepoint = len(conn.pending)
+        elif words[0] == 'ROLLBACK':
+            del conn.pending[conn.savepoint:]
+        elif 'pg_prepared_statements' in sql:
+            self.rows = [(name,) for name in conn.statements]
+        else:
+            self.rows = []
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+        self.autocommit = True
+        self.closed = 0
+        self.pending = []
+        self.savepoint = 0
+        # Prepared statements of the server session
+        self.statements = set()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.pool.executed.extend(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+
+class FakePool:
+    """Records the prepared statements committed, in order.  Every
+    getconn is a new connection unless keep is set."""
+
+    def __init__(self, down=False, keep=False):
+        self.down = down
+        self.keep = keep
+        self.conn = None
+        self.executed = []
+
+    def getconn(self):
+        if self.conn is None or not self.keep:
+            self.conn = FakeConnection(self)
+        return self.conn
+
+    def putconn(self, conn, close=False):
+        pass
+
+
+@pytest.fixture
+def journal_file(tmp_path):
+    return str(tmp_path / 'journal.db')
+
+
+def test_replay_order_after_reopen(journal_file):
+    # The database is away, nothing leaves the journal
+    journal = RequestJournal(journal_file, FakePool(down=True),
+                             flush_interval=60)
+    journal.conn.executemany("INSERT INTO reserved_ids (id) VALUES (?)",
+                             [(10,), (11,)])
+    journal.conn.commit()
+    updates = [(5, 'ACTIVE'), (6, 'COMPLETED'), (5, 'COMPLETED')]
+    assert journal.add_request({'object_id': 100, 'status': 'PENDING'}) == 10
+    for req_id, status in updates:
+        journal.update_request(req_id, status)
+    assert journal.add_request({'object_id': 101, 'status': 'PENDING'}) == 11
+    journal.close()
+
+    pool = FakePool()
+    journal = RequestJournal(journal_file, pool, flush_interval=60)
+    try:
+        assert journal.pending() == 5
+        assert journal.pending_status() == {5: 'COMPLETED', 6: 'COMPLETED'}
+        assert journal.flush() == 5
+        assert journal.pending() == 0
+    finally:
+        journal.close()
+
+    assert [name for name, _ in pool.executed] == \
+        ['journal_add_request'] + ['journal_update_request'] * 3 + \
+        ['journal_add_request']
+    assert [args[0] for _, args in pool.executed] == [10, 5, 6, 5, 11]
+    assert [args for name, args in pool.executed
+            if name == 'journal_update_request'] == \
+        [[req_id, status] for req_id, status in updates]
+
+
+def test_open_journal_shares_one_writer(journal_file):
+    pool = FakePool()
+    journal = open_journal(journal_file, pool, flush_interval=60)
+    try:
+        assert open_journal(journal_file, pool) is journal
+    finally:
+        journal.close()
+    assert journal_file not in request_journal._journals
+    # A closed journal is replaced by a new writer
+    reopened = open_journal(journal_file, pool, flush_interval=60)
+    reopened.close()
+    assert reopened is not journal
+
+
+def _queue_and_flush(journal, updates):
+    """Queue status changes and write them, here or by the writer thread
+    they wake, and return what is left"""
+    for req_id, status in updates:
+        journal.update_request(req_id, status)
+    journal.flush()
+    return journal.pending()
+
+
+def test_new_connection_prepares_again(journal_file):
+    pool = FakePool()
+    journal = RequestJournal(journal_file, pool, flush_interval=60)
+    try:
+        # Each flush gets a connection that has never seen the statements
+        assert _queue_and_flush(journal, [(1, 'ACTIVE')]) == 0
+        assert _queue_and_flush(journal, [(1, 'COMPLETED')]) == 0
+        assert journal.dead_letters() == []
+    finally:
+        journal.close()
+    assert [args for _, args in pool.executed] == \
+        [[1, 'ACTIVE'], [1, 'COMPLETED']]
+
+
+def test_lost_statement_is_prepared_again(journal_file):
+    pool = FakePool(keep=True)
+    journal = RequestJournal(journal_file, pool, flush_interval=60)
+    try:
+        assert _queue_and_flush(journal, [(1, 'ACTIVE')]) == 0
+        # The session dropped its statements behind the journal's back
+        pool.conn.statements.clear()
+        assert _queue_and_flush(journal, [(2, 'ACTIVE'),
+                                          (1, 'COMPLETED')]) == 0
+        assert journal.dead_letters() == []
+    finally:
+        journal.close()
+    assert [args for _, args in pool.executed] == \
+        [[1, 'ACTIVE'], [2, 'ACTIVE'], [1, 'COMPLETED']]
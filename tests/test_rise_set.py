@@ -0,0 +1,89 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+START = '2026-03-16T03:00:00'
+HORIZON = 15.
+# Seconds, astroplan's own grid search is good to about a minute
+TOLERANCE = 120.
+
+
+def _mjd(t):
+    """MJD of an astroplan result, NaN where it found no crossing"""
+    mjd = t.mjd
+    if isinstance(mjd, np.ma.MaskedArray):
+        return mjd.filled(np.nan).astype(float)
+    values = np.array(getattr(mjd, 'unmasked', mjd), dtype=float)
+    mask = np.broadcast_to(np.asarray(getattr(t, 'mask', False)),
+                           values.shape)
+    values[mask] = np.nan
+    return values
+
+
+@pytest.fixture
+def sched(offline_scheduler):
+    return offline_scheduler([(180., 30., 1.)])
+
+
+@pytest.fixture
+def targets(sched):
+    rng = np.random.default_rng(2026)
+    ra = rng.uniform(0., 360., 200)
+    dec = np.degrees(np.arcsin(rng.uniform(-0.7, 1., 200)))
+    # Clear of the declinations that only just reach the horizon
+    lat = sched.site.lat.deg
+    edge = np.minimum(np.abs(dec - (90. - lat + HORIZON)),
+                      np.abs(dec - (lat - 90. + HORIZON)))
+    keep = edge > 1.
+    return ra[keep], dec[keep]
+
+
+def test_matches_astroplan(sched, targets):
+    from astropy import units as u
+    from astropy.coordinates import SkyCoord
+    from astropy.time import Time
+
+    ra, dec = targets
+    start = Time(START)
+    coords = SkyCoord(ra=ra, dec=dec, unit='deg')
+    observer = sched.obs_site_plan
+    a_rise = _mjd(observer.target_rise_time(start, coords, which='next',
+                                            horizon=HORIZON * u.deg))
+    a_set = _mjd(observer.target_set_time(start, coords, which='next',
+                                          horizon=HORIZON * u.deg))
+    alt = observer.altaz(start, coords).alt.deg
+
+    rise, set_time = sched._rise_set_times(ra, dec, start.mjd,
+                                           horizon=HORIZON, start_alt=alt)
+    assert np.array_equal(np.isnan(rise), np.isnan(a_rise))
+    assert np.array_equal(np.isnan(set_time), np.isnan(a_set))
+    ok = ~np.isnan(rise)
+    assert ok.sum() > 100
+    assert np.abs(rise - a_rise)[ok].max() * 86400. < TOLERANCE
+    assert np.abs(set_time - a_set)[ok].max() * 86400. < TOLERANCE
+    assert (rise[ok] > start.mjd).all() and (set_time[ok] > start.mjd).all()
+
+
+def test_crossing_at_the_start(sched):
+    from astropy.time import Time
+    from sky.scheduler.dbscheduler import SIDEREAL_RATE
+
+    start = Time(START).mjd
+    rise, set_time = sched._rise_set_times([213.9], [53.8], start,
+                                           horizon=HORIZON)
+    day = 360. / SIDEREAL_RATE
+    # A few seconds after the start by the approximation
+    assert 0 < rise[0] - start < 600. / 86400.
+
+    # Already up by the exact altitude, the next rise is a day later
+    up_rise, up_set = sched._rise_set_times([213.9], [53.8], start,
+                                            horizon=HORIZON,
+                                            start_alt=[HORIZON + 0.01])
+    assert up_rise[0] == pytest.approx(rise[0] + day)
+    assert up_set[0] == pytest.approx(set_time[0])
+
+    # Still down, nothing changes
+    down = sched._rise_set_times([213.9], [53.8], start, horizon=HORIZON,
+                                 start_alt=[HORIZON - 0.01])
+    assert down[0][0] == pytest.approx(rise[0])
+    assert down[1][0] == pytest.approx(set_time[0])
@@ -0,0 +1,66 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+
+@pytest.fixture
+def sched(offline_scheduler):
+    sched = offline_scheduler([(180., 30., 1.)])
+    sched.slew_bin = 60
+    return sched
+
+
+def test_estimate_slew(sched):
+    times = sched.night_times('2026-03-15')
+    start = times['evening_nautical']
+    lst = float(sched.get_night_grid(start).lst_at(start.jd))
+    ra = np.full(4, lst)
+    dec = np.array([30., 20., -30., 80.])
+
+    slew = sched.estimate_slew(ra, dec, start, pointing=(lst, 30.))
+    settle, _, dec_rate, dome_rate = (sched.slew_settle,) + \
+        tuple(sched.slew_rates)
+    # On the meridian south of the zenith only the declination axis moves
+    assert slew[0] == pytest.approx(settle, abs=1)
+    assert slew[1] == pytest.approx(settle + 10. / dec_rate, abs=1)
+    assert slew[2] == pytest.approx(settle + 60. / dec_rate, abs=1)
+    # North of the zenith the dome turns half way round
+    assert slew[3] == pytest.approx(
+        settle + max(50. / dec_rate, 180. / dome_rate), abs=1)
+
+    sched.pointing = None
+    assert sched.estimate_slew(ra, dec, start) is None
+
+
+def test_nearer_wins_only_within_a_level(sched):
+    # Given in their sorted order, the nearer target of each level second
+    priority = np.array([5., 5., 4., 4.])
+    slew = np.array([300., 20., 400., 10.])
+    order = sched._rank_order(priority, np.zeros(4), slew)
+    assert list(order) == [1, 0, 3, 2]
+
+    # Slews in the same step keep the sorted order
+    slew = np.array([50., 20., 10., 40.])
+    assert list(sched._rank_order(priority, np.zeros(4), slew)) == \
+        [0, 1, 2, 3]
+
+    # No slew steps, no reordering
+    sched.slew_bin = 0
+    slew = np.array([300., 20., 400., 10.])
+    assert list(sched._rank_order(priority, np.zeros(4), slew)) == \
+        [0, 1, 2, 3]
+
+
+def test_low_priority_keeps_hour_angle_order(sched):
+    priority = np.array([2., 1., 2.])
+    s_ha = np.array([1., 3., 2.])
+    slew = np.array([10., 500., 200.])
+    # Setting first, the slews do not matter
+    assert list(sched._rank_order(priority, s_ha, slew)) == [1, 2, 0]
+
+    sched.slew_low = True
+    assert list(sched._rank_order(priority, s_ha, slew)) == [0, 2, 1]
+
+    # High priority targets always come first
+    priority = np.array([2., 3., 1.])
+    assert sched._rank_order(priority, s_ha, slew)[0] == 1
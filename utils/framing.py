@@ -0,0 +1,79 @@
+import json
+import struct
+
+# Every message is a 5 byte header (body type, body length) and the body
+HEADER = struct.Struct('!cI')
+JSON_BODY = b'J'
+BINARY_BODY = b'B'
+MAX_MESSAGE_SIZE = 512 * 1024 * 1024
+
+
+class FramingError(ConnectionError):
+    """Raised when a stream ends mid-message or carries a bad header"""
+    pass
+
+
+def _recv_exactly(sock, size, eof_ok=False):
+    """
+    Read exactly size bytes from sock
+
+    :param sock: connected socket
+    :param size: number of bytes to read
+    :param eof_ok: return None if the peer closed before sending anything
+    :return: bytearray of length size
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    nread = 0
+    while nread < size:
+        n = sock.recv_into(view[nread:], size - nread)
+        if n == 0:
+            if eof_ok and nread == 0:
+                return None
+            raise FramingError("Connection closed after %d of %d bytes"
+                               % (nread, size))
+        nread += n
+    return buf
+
+
+def send_message(sock, body):
+    """
+    Send one framed message.  bytes-like bodies are sent as binary,
+    anything else is JSON encoded.
+
+    :param sock: connected socket
+    :param body: JSON serializable object or bytes
+    """
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        kind = BINARY_BODY
+    else:
+        kind = JSON_BODY
+        body = json.dumps(body).encode('utf-8')
+    size = len(body)
+    if size > MAX_MESSAGE_SIZE:
+        raise ValueError("Message of %d bytes is too large" % size)
+    if size < 65536:
+        sock.sendall(HEADER.pack(kind, size) + bytes(body))
+    else:
+        sock.sendall(HEADER.pack(kind, size))
+        sock.sendall(body)
+
+
+def recv_message(sock):
+    """
+    Receive one framed message
+
+    :param sock: connected socket
+    :return: decoded JSON object, bytes for a binary body, or None if the
+             peer closed the connection cleanly
+    """
+    header = _recv_exactly(sock, HEADER.size, eof_ok=True)
+    if header is None:
+        return None
+    kind, size = HEADER.unpack(header)
+    if kind not in (JSON_BODY, BINARY_BODY) or size > MAX_MESSAGE_SIZE:
+        raise FramingError("Bad message header: %r" % bytes(header))
+    body = _recv_exactly(sock, size)
+    if kind == BINARY_BODY:
+        return bytes(body)
+    return json.loads(body.decode('utf-8'))
@@ -225,6 +225,21 @@ class addHeader():
         else:
             return False, "%s does not exist" % image
 
+        self.update_header(prihdr, obsdict)
+        hdulist.close()
+
+        return {'elaptime': time.time()-start, 'data': image}
+
+    def update_header(self, prihdr, obsdict):
+        """
+        Set the observation keywords on a header in memory, so a camera
+        can write them before the frame goes to disk
+
+        :param prihdr: fits header to update
+        :param obsdict: observation keywords, a numeric 'elaptime' is used
+                        for ELAPTIME instead of the time since 'starttime'
+        :return:
+        """
         # 2: Check that we have everything we need in the obsdict
         obsdict = self._obsdict_check(obsdict=obsdict)
 
@@ -405,11 +420,12 @@ class addHeader():
         prihdr.set("ENDBARPR", obsdict["endbarpr"], "End Atmosphere Pressure")
         prihdr.set("ENDSECPR", obsdict["endsecpr"],
                    "End Secondary Vacuum Pressure")
-        prihdr.set("ELAPTIME",  round(time.time() - obsdict['starttime'], 3),
+        if isinstance(obsdict['elaptime'], (int, float)):
+            elaptime = obsdict['elaptime']
+        else:
+            elaptime = time.time() - obsdict['starttime']
+        prihdr.set("ELAPTIME",  round(elaptime, 3),
                    "Elapsed time of observation")
-        hdulist.close()
-
-        return {'elaptime': time.time()-start, 'data': image}
 
 
 if __name__ == "__main__":
@@ -1,36 +1,182 @@
 import paramiko
 import os
 import time
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _Session:
+    """One authenticated SSH transport and its SFTP channel"""
+    def __init__(self, transport, sftp):
+        self.transport = transport
+        self.sftp = sftp
+        self.last_used = time.time()
+
+    def close(self):
+        for item in (self.sftp, self.transport):
+            try:
+                item.close()
+            except Exception:
+                pass
 
 
 class transfer:
     def __init__(self, remote_computer, remote_port, remote_base_dir,
-                 remote_user, remote_pwd):
+                 remote_user, remote_pwd, pool_size=2, keepalive=30,
+                 max_idle=60):
+        """
+
+        :param remote_computer:
+        :param remote_port:
+        :param remote_base_dir:
+        :param remote_user:
+        :param remote_pwd:
+        :param pool_size: maximum number of open SFTP sessions
+        :param keepalive: seconds between SSH keepalive packets
+        :param max_idle: idle sessions older than this are checked with a
+                         round trip before reuse
+        """
         self.remote_computer = remote_computer
         self.remote_port = remote_port
         self.remote_base_dir = remote_base_dir
         self.remote_user = remote_user
         self.remote_pwd = remote_pwd
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.max_idle = max_idle
+        self.idle = []
+        self.n_sessions = 0
+        self.cond = threading.Condition()
+        self.executor = None
 
-    def send(self, transfer_file):
-        start = time.time()
-        try:
-            t = paramiko.Transport(self.remote_computer, self.remote_port)
+    def get_remote_path(self, transfer_file):
+        """Return the path transfer_file will have on the remote computer"""
+        base_name = os.path.basename(transfer_file)
+        obsdate = base_name.split('_')[0][-8:]
+        remote_path = os.path.join(self.remote_base_dir, obsdate, base_name)
+        return remote_path.replace('\\', '/')
 
+    def _connect(self):
+        t = paramiko.Transport((self.remote_computer, self.remote_port))
+        try:
             t.connect(username=self.remote_user, password=self.remote_pwd)
+            if self.keepalive:
+                t.set_keepalive(self.keepalive)
             sftp = paramiko.SFTPClient.from_transport(t)
+        except Exception:
+            t.close()
+            raise
+        return _Session(t, sftp)
 
-            base_name = os.path.basename(transfer_file)
-            obsdate = base_name.split('_')[0][-8:]
-            remote_path = os.path.join(self.remote_base_dir, obsdate, base_name)
-            remote_path = remote_path.replace('\\', '/')
+    def _healthy(self, session):
+        if not session.transport.is_active():
+            return False
+        if time.time() - session.last_used > self.max_idle:
+            try:
+                session.sftp.normalize('.')
+            except (paramiko.SSHException, socket.error, EOFError):
+                return False
+        return True
 
-            print('sftp.put to:', remote_path, transfer_file)
-            sftp.put(transfer_file, remote_path)
+    @staticmethod
+    def _network_error(e):
+        """
+        True unless e is a file error (no such file, permission) from
+        either end, which a new connection would not cure
+        """
+        if isinstance(e, (paramiko.SSHException, EOFError, ConnectionError,
+                          socket.timeout)):
+            return True
+        return getattr(e, 'errno', None) is None
 
-            sftp.close()
-            t.close()
-        except paramiko.ssh_exception.SSHException:
-            return {'elaptime': time.time() - start, 'error': "SSHException"}
+    def _checkout(self):
+        """Reuse a healthy idle session or open a new one"""
+        while True:
+            with self.cond:
+                while not self.idle and self.n_sessions >= self.pool_size:
+                    self.cond.wait()
+                if not self.idle:
+                    self.n_sessions += 1
+                    break
+                session = self.idle.pop()
+            # The check may be a round trip, other threads must not wait
+            if self._healthy(session):
+                return session
+            session.close()
+            with self.cond:
+                self.n_sessions -= 1
+                self.cond.notify()
+        try:
+            return self._connect()
+        except Exception:
+            with self.cond:
+                self.n_sessions -= 1
+                self.cond.notify()
+            raise
+
+    def _checkin(self, session, ok=True):
+        with self.cond:
+            if ok:
+                session.last_used = time.time()
+                self.idle.append(session)
+            else:
+                session.close()
+                self.n_sessions -= 1
+            self.cond.notify()
+
+    def send(self, transfer_file):
+        start = time.time()
+        if not os.path.isfile(transfer_file):
+            return {'elaptime': time.time() - start,
+                    'error': "No such file: %s" % transfer_file}
+        remote_path = self.get_remote_path(transfer_file)
+        # A pooled session may have died since it was last used, so a
+        # failure on it gets one more try on a fresh connection
+        for attempt in range(2):
+            try:
+                session = self._checkout()
+            except (paramiko.SSHException, socket.error, EOFError):
+                return {'elaptime': time.time() - start,
+                        'error': "SSHException"}
+            try:
+                print('sftp.put to:', remote_path, transfer_file)
+                session.sftp.put(transfer_file, remote_path)
+            except (paramiko.SSHException, socket.error, EOFError) as e:
+                if not self._network_error(e):
+                    # The session is fine, the file is the problem
+                    self._checkin(session)
+                    return {'elaptime': time.time() - start,
+                            'error': str(e)}
+                self._checkin(session, ok=False)
+                continue
+            self._checkin(session)
+            return {'elaptime': time.time() - start, 'data': remote_path}
+
+        return {'elaptime': time.time() - start, 'error': "SSHException"}
+
+    def send_async(self, transfer_file):
+        """
+        Send on a pool thread so several files can move at once
+
+        :return: concurrent.futures.Future resolving to the send return
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.pool_size)
+        return self.executor.submit(self.send, transfer_file)
+
+    def send_many(self, transfer_files):
+        """Send a list of files concurrently, returns in the same order"""
+        futures = [self.send_async(f) for f in transfer_files]
+        return [f.result() for f in futures]
 
-        return {'elaptime': time.time() - start, 'data': remote_path}
+    def close(self):
+        """Close every pooled session"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        with self.cond:
+            for session in self.idle:
+                session.close()
+                self.n_sessions -= 1
+            self.idle = []
@@ -0,0 +1,237 @@
+import os
+import time
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class WriteQueue:
+    def __init__(self, transfer=None, max_depth=4, retries=5, retry_wait=5,
+                 keep_status=500, logger=None, transfer_workers=None,
+                 set_header=None):
+        """
+        Background worker that writes finished frames to disk and pushes
+        them to the remote computer so the camera can start the next
+        exposure as soon as readout is done.
+
+        :param transfer: utils.transfer_to_remote.transfer instance or None
+        :param max_depth: number of frames that may be held, written or
+                          sent at once, submit blocks when all are in use
+        :param retries: number of attempts at transferring each file
+        :param retry_wait: seconds to wait between transfer attempts
+        :param keep_status: number of finished files to remember
+        :param logger:
+        :param transfer_workers: files sent concurrently once written,
+                                 defaults to the transfer session pool size
+        :param set_header: function(header, obsdict) used by release to add
+                           the observation keywords to a held frame
+        """
+        self.transfer = transfer
+        self.set_header = set_header
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.keep_status = keep_status
+        self.logger = logger
+        self.queue = queue.Queue()
+        # A slot is taken by submit and given back once the file is sent
+        # or has failed, so transfers count against max_depth too
+        self.slots = threading.BoundedSemaphore(max_depth)
+        self.held = OrderedDict()
+        self.status = OrderedDict()
+        self.lock = threading.Lock()
+        if transfer_workers is None:
+            transfer_workers = getattr(transfer, 'pool_size', 1)
+        self.senders = None
+        if transfer and transfer_workers > 1:
+            self.senders = ThreadPoolExecutor(max_workers=transfer_workers)
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def _log(self, msg, *args, error=False):
+        if self.logger:
+            if error:
+                self.logger.error(msg, *args, exc_info=True)
+            else:
+                self.logger.info(msg, *args)
+        else:
+            print(msg % args)
+
+    def _set_status(self, save_as, **kwargs):
+        key = os.path.basename(save_as)
+        with self.lock:
+            self.status.setdefault(key, {}).update(kwargs)
+            self.status.move_to_end(key)
+            while len(self.status) > self.keep_status:
+                oldest = next(iter(self.status))
+                if self.status[oldest]['status'] not in ('done', 'error'):
+                    break
+                self.status.popitem(last=False)
+
+    def submit(self, hdu, save_as, hold=False):
+        """
+        Queue an HDU to be written to save_as (and sent to the remote
+        computer if a transfer is set up)
+
+        :param hdu: fits HDU ready to be written
+        :param save_as: local path of the file
+        :param hold: keep the frame until release adds its header
+        :return: path the file will have once it is done
+        """
+        if self.transfer:
+            final_path = self.transfer.get_remote_path(save_as)
+        else:
+            final_path = save_as
+        # A frame nobody released would otherwise hold its slot forever
+        with self.lock:
+            stale = list(self.held)
+        for key in stale:
+            self._log("%s was never released, writing it as is", key)
+            self.release(key)
+
+        if not self.slots.acquire(blocking=False):
+            self._log("Write queue full, waiting to queue %s", save_as)
+            self.slots.acquire()
+        if hold:
+            with self.lock:
+                self.held[os.path.basename(save_as)] = (hdu, save_as)
+            self._set_status(save_as, status='held', data=final_path,
+                             queued=time.time())
+        else:
+            self._set_status(save_as, status='queued', data=final_path,
+                             queued=time.time())
+            self.queue.put((hdu, save_as))
+        return final_path
+
+    def release(self, filename, header=None):
+        """
+        Add the observation keywords to a held frame and queue it to be
+        written
+
+        :param filename: local or remote path, or base name of the file
+        :param header: obsdict for set_header, None to write it as is
+        :return: dict with the path the file will have once it is done
+        """
+        key = os.path.basename(filename)
+        with self.lock:
+            item = self.held.pop(key, None)
+        if item is None:
+            return {'error': "%s is not held in the write queue" % key}
+        hdu, save_as = item
+        ret = {'data': self.get_status(save_as).get('data', save_as)}
+        if header and self.set_header:
+            try:
+                self.set_header(hdu.header, header)
+            except Exception as e:
+                self._log("Error setting the header of %s", save_as,
+                          error=True)
+                ret['warning'] = "Header not set: %s" % str(e)
+        self._set_status(save_as, status='queued')
+        self.queue.put((hdu, save_as))
+        return ret
+
+    def get_status(self, filename):
+        """
+        Return the completion status of a submitted file
+
+        :param filename: local or remote path, or base name of the file
+        :return: dict with 'status' of held, queued, writing, transferring,
+                 done or error
+        """
+        key = os.path.basename(filename)
+        with self.lock:
+            if key not in self.status:
+                return {'error': "%s not in write queue" % key}
+            return dict(self.status[key])
+
+    def wait(self, filename, timeout=None):
+        """Block until filename is done or failed and return its status"""
+        start = time.time()
+        ret = self.get_status(filename)
+        while ret.get('status') not in ('done', 'error', None):
+            if timeout is not None and time.time() - start > timeout:
+                break
+            time.sleep(.05)
+            ret = self.get_status(filename)
+        return ret
+
+    def flush(self):
+        """Block until every queued file has been written and sent"""
+        with self.lock:
+            held = list(self.held)
+        for key in held:
+            self.release(key)
+        self.queue.join()
+
+    def shutdown(self):
+        """Flush the queue and stop the worker thread"""
+        self.flush()
+        self.queue.put(None)
+        self.worker.join()
+        if self.senders:
+            self.senders.shutdown(wait=True)
+
+    def _send(self, save_as):
+        ret = self.transfer.send(save_as)
+        retries = 1
+        while 'error' in ret and retries < self.retries:
+            self._log("Transfer ERROR: %s, wait %ss, try again", ret,
+                      self.retry_wait)
+            time.sleep(self.retry_wait)
+            ret = self.transfer.send(save_as)
+            if 'error' in ret:
+                self._log("Transfer try %d failed", retries)
+                retries += 1
+            else:
+                self._log("Transfer succeeded after %d retries", retries)
+        return ret
+
+    def _finish(self):
+        self.slots.release()
+        self.queue.task_done()
+
+    def _transfer(self, save_as):
+        """Send a written file and record the outcome"""
+        try:
+            self._set_status(save_as, status='transferring')
+            ret = self._send(save_as)
+            if 'data' in ret:
+                self._set_status(save_as, status='done', data=ret['data'])
+            else:
+                # The file is still good locally
+                self._log("Unable to transfer %s to remote", save_as)
+                self._set_status(save_as, status='error', data=save_as,
+                                 error="Unable to transfer %s to "
+                                       "remote" % save_as)
+        except Exception as e:
+            self._log("Error sending %s", save_as, error=True)
+            self._set_status(save_as, status='error', data=save_as,
+                             error=str(e))
+        finally:
+            self._finish()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            hdu, save_as = item
+            try:
+                self._set_status(save_as, status='writing')
+                hdu.writeto(save_as, output_verify="fix", )
+                self._log("%s created", save_as)
+            except Exception as e:
+                self._log("Error writing %s", save_as, error=True)
+                self._set_status(save_as, status='error', data=None,
+                                 error=str(e))
+                self._finish()
+                continue
+            if not self.transfer:
+                self._set_status(save_as, status='done', data=save_as)
+                self._finish()
+            elif self.senders:
+                # Keep writing the next frame while this one is sent
+                self.senders.submit(self._transfer, save_as)
+            else:
+                self._transfer(save_as)